@@ -1,8 +1,14 @@
 import sys
+import argparse
 from qtpy.QtWidgets import QApplication
 from relocker.gui.main import MainWindow
 
-app = QApplication(sys.argv)
-window = MainWindow()
+parser = argparse.ArgumentParser()
+parser.add_argument('--monitor-port',type=int,default=None,
+                    help='serve lock status on http://127.0.0.1:<port>/')
+args, qt_args = parser.parse_known_args()
+
+app = QApplication(sys.argv[:1]+qt_args)
+window = MainWindow(monitor_port=args.monitor_port)
 window.show()
-app.exec()
\ No newline at end of file
+app.exec()
@@ -0,0 +1,120 @@
+"""
+*   Clocks used by all timers and scope acquisitions. The wall Clock is used
+    in the lab; a VirtualClock can be swapped in (set_clock, or passing clock=
+    to the objects that take one) to run relock timing deterministically and
+    much faster than real time.
+"""
+
+import time
+import heapq
+import threading
+
+class Clock():
+    """Wall clock."""
+    is_virtual = False
+
+    def time(self):
+        return time.time()
+
+    def localtime(self):
+        return time.localtime(self.time())
+
+    def sleep(self,seconds):
+        time.sleep(seconds)
+
+    def wait(self,seconds):
+        """Waits without blocking the Qt event loop if Qt is available."""
+        try:
+            from qtpy import QtTest
+        except ImportError:
+            return self.sleep(seconds)
+        QtTest.QTest.qWait(int(seconds*1000))
+
+    def call_later(self,delay,callback,*args):
+        """Calls callback(*args) after delay seconds from a timer thread."""
+        timer = threading.Timer(delay,callback,args)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+class VirtualClock(Clock):
+    """Discrete-event clock. Time only moves when sleep(), advance() or run()
+    is called, and any callbacks scheduled with call_later() fall due in time
+    order as it does, so a simulation driven by it is deterministic.
+
+    If speed is None time advances instantly, otherwise advancing also sleeps
+    for the elapsed virtual time divided by speed.
+
+    Only one thread advances the clock at a time (e.g. several counter
+    threads sleeping on it). Callbacks run on the advancing thread unless
+    post(callback,args) is given, which hands them on instead, e.g. to the
+    Qt main thread through a queued signal.
+    """
+    is_virtual = True
+
+    def __init__(self,start=0.0,speed=None,post=None):
+        self.now = start
+        self.speed = speed
+        self.post = post
+        self.events = [] # heap of (time, order, callback, args)
+        self.order = 0
+        self.lock = threading.RLock()
+        self.advancing = threading.RLock()
+
+    def time(self):
+        return self.now
+
+    def _set_time(self,t):
+        if (self.speed is not None) and (t > self.now):
+            time.sleep((t-self.now)/self.speed)
+        self.now = max(self.now,t)
+
+    def call_at(self,t,callback,*args):
+        with self.lock:
+            heapq.heappush(self.events,(t,self.order,callback,args))
+            self.order += 1
+
+    def call_later(self,delay,callback,*args):
+        self.call_at(self.now+delay,callback,*args)
+
+    def advance(self,seconds):
+        """Moves time forward, running callbacks that fall due on the way."""
+        with self.advancing:
+            self.run(until=self.now+seconds)
+
+    def sleep(self,seconds):
+        self.advance(seconds)
+
+    def wait(self,seconds):
+        self.advance(seconds)
+
+    def run(self,until=None):
+        """Runs scheduled callbacks in order until there are none left or the
+        next one is later than until. Returns the number of callbacks run."""
+        count = 0
+        with self.advancing:
+            while True:
+                with self.lock:
+                    if (not self.events) or ((until is not None) and (self.events[0][0] > until)):
+                        break
+                    t, _, callback, args = heapq.heappop(self.events)
+                self._set_time(t)
+                if self.post is None:
+                    callback(*args)
+                else:
+                    self.post(callback,args)
+                count += 1
+            if until is not None:
+                self._set_time(until)
+        return count
+
+_clock = Clock()
+
+def get_clock():
+    """Returns the clock used by default throughout the package."""
+    return _clock
+
+def set_clock(clock):
+    """Replaces the default clock, e.g. with a VirtualClock in tests."""
+    global _clock
+    _clock = clock
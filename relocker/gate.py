@@ -0,0 +1,221 @@
+"""
+*   Lock-status gate for the experiment sequencer. The GUI keeps one status
+    word per laser in a small memory-mapped file, updated on every lock
+    check and state change, and a sequencer process checks them before each
+    shot without talking to the GUI, e.g.
+        gate = LockGate()
+        if not gate.wait_locked(['Rb repump','Rb cooler'],timeout=0.5):
+            skip_shot()
+
+    A plain file mapping is used rather than multiprocessing.shared_memory
+    so that the gate also works on Python 3.6. Each record is a name, a
+    32-bit status word (written in one store), an update count, the time
+    of the last update and a heartbeat, the wall-clock time of the last lock
+    check. A laser whose heartbeat is older than max_age counts as unlocked,
+    so the sequencer does not carry on if the GUI crashes or freezes.
+"""
+
+import os
+import mmap
+import time as _time
+import tempfile
+
+import numpy as np
+
+from .locking.state import STATES, PID_STATES, RELOCK_STATES
+from .locking.polling import MAX_INTERVAL
+
+MAGIC = b'RLKG'
+VERSION = 2
+CAPACITY = 64 # lasers
+MAX_AGE = 2*MAX_INTERVAL # [s] longer than the longest poll interval plus the debounce checks
+PATH = os.path.join(tempfile.gettempdir(),'relocker_lock_gate.bin')
+
+# status word bits, the state index is in bits 8-15
+LOCKED = 1
+PID_ON = 2
+RELOCKING = 4
+PARKED = 8
+AUTORELOCK = 16
+STATE_SHIFT = 8
+
+HEADER = np.dtype([('magic','S4'),('version','<u4'),('capacity','<u4'),('pad','<u4')])
+RECORD = np.dtype([('name','S40'),('word','<u4'),('count','<u4'),('time','<f8'),
+                   ('heartbeat','<f8')])
+
+def status_word(state,autorelock=False):
+    """Status word for a lock state name."""
+    word = STATES.index(state) << STATE_SHIFT
+    if state == 'locked':
+        word |= LOCKED
+    if state in PID_STATES:
+        word |= PID_ON
+    if state in RELOCK_STATES:
+        word |= RELOCKING
+    if state == 'parked':
+        word |= PARKED
+    if autorelock:
+        word |= AUTORELOCK
+    return word
+
+def decode(word):
+    """Dictionary of the fields of a status word."""
+    state = (word >> STATE_SHIFT) & 0xff
+    return {'state': STATES[state] if state < len(STATES) else None,
+            'locked': bool(word & LOCKED),
+            'pid on': bool(word & PID_ON),
+            'relocking': bool(word & RELOCKING),
+            'parked': bool(word & PARKED),
+            'autorelock': bool(word & AUTORELOCK)}
+
+def _encode(name):
+    return name.encode('utf-8')[:RECORD['name'].itemsize]
+
+class _GateFile():
+    def _map(self,access):
+        self.map = mmap.mmap(self.file.fileno(),HEADER.itemsize + self.capacity*RECORD.itemsize,
+                             access=access)
+        self.header = np.ndarray((),HEADER,buffer=self.map)
+        self.records = np.ndarray((self.capacity,),RECORD,buffer=self.map,offset=HEADER.itemsize)
+
+    def close(self):
+        self.header = self.records = self.words = self.heartbeats = None
+        self.map.close()
+        self.file.close()
+
+class LockGateWriter(_GateFile):
+    """Writer side, owned by the GUI. An existing file is cleared in place
+    rather than truncated, so that a sequencer which mapped it before the
+    GUI restarted keeps a valid mapping (of unlocked lasers)."""
+    def __init__(self,path=PATH,capacity=CAPACITY):
+        self.path = path
+        if not os.path.exists(path):
+            open(path,'wb').close()
+        self.file = open(path,'r+b')
+        size = os.path.getsize(path)
+        # never shrink the file under a reader's mapping
+        self.capacity = max(capacity,(size - HEADER.itemsize)//RECORD.itemsize)
+        if size < HEADER.itemsize + self.capacity*RECORD.itemsize:
+            self.file.truncate(HEADER.itemsize + self.capacity*RECORD.itemsize)
+        self._map(mmap.ACCESS_WRITE)
+        self.records['word'] = 0
+        self.records['heartbeat'] = 0
+        self.records['name'] = b''
+        self.header['magic'] = MAGIC
+        self.header['version'] = VERSION
+        self.header['capacity'] = self.capacity
+        self.slots = {} # name: record index
+
+    def register(self,name):
+        """Reserves a record for a laser (not locked until updated)."""
+        if name in self.slots:
+            return self.slots[name]
+        free = [i for i in range(self.capacity) if i not in self.slots.values()]
+        if not free:
+            raise ValueError('lock gate is full ({} lasers)'.format(self.capacity))
+        index = free[0]
+        record = self.records[index]
+        record['word'] = 0
+        record['count'] = 0
+        record['time'] = 0
+        record['heartbeat'] = 0
+        record['name'] = _encode(name)
+        self.slots[name] = index
+        return index
+
+    def update(self,name,state,autorelock=False,time=0):
+        """Writes the status of a laser and refreshes its heartbeat. Call on
+        every lock check, not only on state changes."""
+        index = self.slots.get(name)
+        if index is None:
+            index = self.register(name)
+        record = self.records[index]
+        record['time'] = time
+        record['count'] += 1
+        record['heartbeat'] = _time.time()
+        record['word'] = status_word(state,autorelock)
+
+    def remove(self,name):
+        index = self.slots.pop(name,None)
+        if index is not None:
+            self.records[index]['word'] = 0
+            self.records[index]['name'] = b''
+
+class LockGate(_GateFile):
+    """Reader side, for the sequencer. Opening and name lookups are slow
+    compared to reading a word, so keep one gate open between shots."""
+    def __init__(self,path=PATH):
+        self.path = path
+        self.file = open(path,'rb')
+        header = np.frombuffer(self.file.read(HEADER.itemsize),HEADER)[0]
+        if bytes(header['magic']) != MAGIC or int(header['version']) != VERSION:
+            self.file.close()
+            raise ValueError('{} is not a relocker lock gate'.format(path))
+        self.capacity = int(header['capacity'])
+        self._map(mmap.ACCESS_READ)
+        self.words = self.records['word']
+        self.heartbeats = self.records['heartbeat']
+        self._indices = {}
+
+    def names(self):
+        return [bytes(name).decode('utf-8') for name in self.records['name'] if name]
+
+    def indices(self,names):
+        """Record indices of lasers, raising KeyError for unknown names."""
+        key = tuple(names)
+        indices = self._indices.get(key)
+        if indices is None:
+            stored = list(self.records['name'])
+            try:
+                indices = np.array([stored.index(_encode(name)) for name in names],dtype=int)
+            except ValueError:
+                raise KeyError('not all of {} are in the lock gate'.format(list(names)))
+            self._indices[key] = indices
+        elif not all(self.records['name'][i] == _encode(name) for i, name in zip(indices,names)):
+            del self._indices[key] # the GUI has moved a laser
+            return self.indices(names)
+        return indices
+
+    def status(self,name,max_age=MAX_AGE):
+        """Decoded status of one laser, with its update count, time and the
+        age [s] of its heartbeat. locked is False if the heartbeat is older
+        than max_age [s] (None to ignore the heartbeat)."""
+        record = self.records[self.indices([name])[0]]
+        status = decode(int(record['word']))
+        status['count'] = int(record['count'])
+        status['time'] = float(record['time'])
+        status['age'] = _time.time() - float(record['heartbeat'])
+        status['stale'] = (max_age is not None) and not (status['age'] <= max_age)
+        if status['stale']:
+            status['locked'] = False
+        return status
+
+    def _locked(self,indices,max_age):
+        if not np.all(self.words[indices] & LOCKED):
+            return False
+        if max_age is None:
+            return True
+        return bool(np.all(self.heartbeats[indices] >= _time.time() - max_age))
+
+    def all_locked(self,names,max_age=MAX_AGE):
+        """Whether all the named lasers are locked, with heartbeats no older
+        than max_age [s] (None to ignore the heartbeat)."""
+        return self._locked(self.indices(names),max_age)
+
+    def wait_locked(self,names,timeout=None,spin=1e-3,poll=1e-4,max_age=MAX_AGE):
+        """Waits until all the named lasers are locked and returns True, or
+        False once timeout [s] has passed. Spins for the first spin seconds
+        and then polls every poll seconds. Lasers with heartbeats older than
+        max_age [s] count as unlocked."""
+        indices = self.indices(names)
+        if self._locked(indices,max_age):
+            return True
+        start = _time.perf_counter()
+        while True:
+            if self._locked(indices,max_age):
+                return True
+            elapsed = _time.perf_counter() - start
+            if (timeout is not None) and elapsed >= timeout:
+                return False
+            if elapsed > spin:
+                _time.sleep(poll)
@@ -4,9 +4,11 @@
 """
 
 from qtpy import QtWidgets
-from qtpy.QtCore import QThread, Signal
+from functools import partial
 
-import time
+from qtpy.QtCore import Qt, QObject, QThread, QTimer, Signal
+
+from ..clock import get_clock
 
 class QHLine(QtWidgets.QFrame):
     "Horizontal line class used in the GUI"
@@ -22,19 +24,46 @@ class QVLine(QtWidgets.QFrame):
         self.setFrameShape(QtWidgets.QFrame.VLine)
         self.setFrameShadow(QtWidgets.QFrame.Sunken)
 
+def qt_call_later(delay,callback,*args):
+    """Calls callback(*args) after delay seconds from the event loop of the
+    calling thread (the GUI thread), rather than from a timer thread."""
+    QTimer.singleShot(int(round(delay*1000)),partial(callback,*args))
+
+class result_poster(QObject):
+    """Hands results from worker threads to callbacks on the thread the 
+    poster was created in (the GUI thread). Delivery is always queued, so 
+    posting from the GUI thread itself defers the callback until control 
+    returns to the event loop."""
+    signal = Signal(object,object)
+    def __init__(self):
+        super(result_poster, self).__init__()
+        self.signal.connect(self._deliver,Qt.QueuedConnection)
+
+    def post(self,callback,result):
+        self.signal.emit(callback,result)
+
+    def call(self,callback,args):
+        """Calls callback(*args) on the poster's thread, e.g. as the post of
+        a VirtualClock."""
+        self.signal.emit(lambda args: callback(*args),args)
+
+    def _deliver(self,callback,result):
+        callback(result)
+
 class counter_thread(QThread):
     """External counter object to prevent GUI freezing before counter has 
     reached max. value.
     """
     signal = Signal(int)
-    def __init__(self,refresh_time=10):
+    def __init__(self,refresh_time=10,clock=None):
         super(counter_thread, self).__init__()
         self.refresh_time = refresh_time
+        self.clock = get_clock() if clock is None else clock
 
     def __del__(self):
         self.wait()
 
     def run(self):
         for i in range(101):
-            time.sleep(self.refresh_time/101)
+            self.clock.sleep(self.refresh_time/101)
             self.signal.emit(i)
\ No newline at end of file
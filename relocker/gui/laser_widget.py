@@ -2,8 +2,6 @@ import os
 import time
 import json
 import csv
-import math
-import pickle
 from pathlib import Path
 from datetime import datetime
 from pyrpl import Pyrpl
@@ -16,9 +14,29 @@ from qtpy.QtWidgets import (QMainWindow,QHBoxLayout,QVBoxLayout,QWidget,
                             QListWidget,QLabel)
 from functools import partial
 import pyqtgraph as pg
+import numpy as np
 
 from .helpers import QVLine, QHLine, counter_thread
 from ..redpitaya import RedPitaya
+from ..traces import TraceStore, archive_dir
+from ..traces.bus import TraceBus
+from ..traces.shared import SharedTraceExport
+from ..locking import check_lock, LOCK_THRESHOLD, LOCK_WINDOW
+from ..locking.history import LockHistory, integrator_headroom
+from ..locking.strategies import STRATEGIES, make_strategy
+from ..locking.resonances import find_resonances, ResonanceTracker
+from ..locking.templates import TemplateLibrary, MIN_SCORE
+from ..locking.resonance_map import ResonanceMap
+from ..locking.trend import UnlockPredictor, WARNING_TIME
+from ..locking import backoff
+from ..locking.relock import RelockLogic
+from ..locking.state import LockStateMachine
+from ..locking.polling import AdaptivePoller, lock_margin, MAX_INTERVAL, SAFE_MARGIN
+from ..locking.coordinator import check_dependencies
+from ..locking.analysis import analyse_sweep, analyse_lock
+from .strtypes import error
+
+RESONANCE_MAP_SAVE_INTERVAL = 60 # [s]
 
 class laser(QWidget):
     """Seperate control widget for each laser."""
@@ -26,24 +44,27 @@ class laser(QWidget):
     def __init__(self,main_gui,name):
         super().__init__()
         self.main_gui = main_gui
+        self.clock = main_gui.clock
 
         self.layout = QVBoxLayout()
         self.setLayout(self.layout)
 
         self.name = name
-        self.pid_enabled = False
-        self.sweep_enabled = False
-        self.autorelock = False
+        self.lock_state = LockStateMachine(clock=self.clock)
 
         self.asg_trace = None
         self.input_trace = None
 
-        self.is_locked = False
-        self.is_relocking = False
-        self.has_just_relocked = False
         self.last_locked_time = None
 
         self.prev_lock_point = None
+        self.applied_offset = None
+        self.fast_relock = False
+        self.relock_timings = [] # hardware time [s] of each fast relock
+        self.relock_attempts = [] # outcome and latency of each verified relock
+        self.lock_history = LockHistory()
+        self.resonance_tracker = ResonanceTracker()
+        self.resonances = ([],[])
 
         self.times = None
         self.asg_trace = None
@@ -51,8 +72,45 @@ class laser(QWidget):
         
         self.load_settings_from_file()
         self.ip = self.settings['ip']
+        self.trace_store = TraceStore(archive_dir(self.name))
+        self.trace_bus = TraceBus(self.name,self.clock)
+        # only the lock logic runs before the next acquisition, the other
+        # subscribers are deferred to the event loop and drop frames when busy
+        post = self.main_gui.result_poster.post
+        self.trace_bus.subscribe(self.plot_trace,kinds=['update'],post=post,name='plot')
+        self.trace_bus.subscribe(self.dump_frame,kinds=['update','monitor'],post=post,name='dump')
+        self.trace_bus.subscribe(self.analyse_frame,kinds=['update','monitor'],name='analysis')
+        self.shared_export = None
+        if getattr(self.main_gui,'shared_memory_export',False):
+            try:
+                self.shared_export = SharedTraceExport(self.name)
+                self.trace_bus.subscribe(self.shared_export.write_frame,kinds=['update','monitor'],
+                                         post=post,name='shared memory')
+            except OSError as e:
+                error('Shared memory export of {} not available'.format(self.name),e)
+        self.raw_locked = None
+        self.mean_voltage = float('nan')
+        self.integrator = None
+        monitor = getattr(self.main_gui,'monitor_hub',None)
+        if monitor is not None:
+            self.trace_bus.subscribe(monitor.publish_trace,kinds=['update','monitor'],post=post,
+                                     name='monitor')
+        self.unlock_predictor = UnlockPredictor(warning_time=self.settings['unlock warning time [s]'])
+        self.relock_logic = RelockLogic(self.settings,self.lock_state)
+        self.poller = AdaptivePoller(self.settings['autoupdate interval [s]'],
+                                     self.settings['max autoupdate interval [s]'],
+                                     self.settings['safe margin'])
+        self.lock_margin = None
+        self.headroom = None
+        self.template_path = archive_dir(self.name,'templates.npz')
+        try:
+            self.template_library = TemplateLibrary.load(self.template_path)
+        except FileNotFoundError:
+            self.template_library = None
+        self.resonance_map = ResonanceMap.load(self.name+'.resonances.json')
+        self.resonance_map_saved = self.clock.time()
 
-        self.rp = RedPitaya(self,self.ip)
+        self.rp = RedPitaya(self,self.ip,clock=self.clock)
 
         self._create_header()
         self._create_on_off_buttons()
@@ -76,10 +134,105 @@ class laser(QWidget):
         self.IOSettingsButton = QPushButton("I/O settings")
         self.layout.addWidget(self.IOSettingsButton)
 
+        self.stateDebugButton = QPushButton("State debug")
+        self.layout.addWidget(self.stateDebugButton)
+
         self._createActions()
         self._connectActions()
 
+        self.lock_state.subscribe(self._state_changed)
+        if getattr(self.main_gui,'telemetry',None) is not None:
+            self.lock_state.subscribe(self._log_transition)
+        self.export_status()
         self.set_settings()
+
+    @property
+    def pid_enabled(self):
+        return self.lock_state.pid_enabled
+
+    @property
+    def sweep_enabled(self):
+        return self.lock_state.sweep_enabled
+
+    @property
+    def is_locked(self):
+        return self.lock_state.is_locked
+
+    @property
+    def is_relocking(self):
+        return self.lock_state.is_relocking
+
+    @property
+    def autorelock(self):
+        return self.lock_state.autorelock
+
+    @property
+    def relock_guard(self):
+        return self.relock_logic.guard
+
+    @property
+    def relock_candidate(self):
+        return self.relock_logic.candidate
+
+    @property
+    def board(self):
+        return self.ip
+
+    @property
+    def dependencies(self):
+        return self.settings['relock after']
+
+    def run_action(self,action,done):
+        """Runs a lock, relock, pre-emptive relock or unlock for the relock
+        coordinator and calls done(success) once it has finished."""
+        if action == 'lock':
+            self.set_pid_state(True)
+            done(self.pid_enabled)
+        elif action == 'unlock':
+            if self.lock_state.can('pid off'):
+                self.set_pid_state(False)
+                done(not self.pid_enabled)
+            elif self.is_relocking:
+                print('{} not unlocked, a relock is still running'.format(self.name))
+                done(False)
+            else: # already off
+                done(True)
+        elif (action == 'relock') and self.is_locked:
+            done(True)
+        elif not self.lock_state.can('relock'):
+            done(False)
+        else:
+            def finished(transition):
+                if transition.event in ['relock succeeded','relock failed','pid off']:
+                    self.lock_state.unsubscribe(finished)
+                    done(transition.event == 'relock succeeded')
+            self.lock_state.subscribe(finished)
+            self.relock()
+
+    def request_relock(self,action='relock'):
+        """Automatic relock, queued with the relock coordinator so that it 
+        waits for the lasers this one relocks after and for other relocks on
+        the same Red Pitaya. A 'pre-emptive relock' also relocks the laser
+        if it is still locked."""
+        self.main_gui.relock_coordinator.submit(self,action)
+
+    def may_autorelock(self):
+        """Whether the relock coordinator may relock this laser as a
+        dependency of another one, i.e. autorelock is on and it is neither
+        parked nor backing off."""
+        return (self.autorelock and (self.lock_state.state != 'parked')
+                and self.relock_guard.may_relock(self.clock.time()))
+
+    def relock_skipped(self,action):
+        """Backs off after an automatic relock was skipped because a laser
+        this one relocks after failed, as after a failed relock."""
+        if action not in ['relock','pre-emptive relock']:
+            return
+        self.relock_guard.back_off(self.clock.time())
+        if self.relock_guard.parked and self.lock_state.can('park'):
+            print('{} parked after {} failed relocks'.format(self.name,self.relock_guard.failures))
+            self.transition('park')
+        self.update_locked_display()
     
     def _createActions(self):
         self.openPISettingsAction = QAction(self)
@@ -90,16 +243,19 @@ class laser(QWidget):
         self.openRelockSettingsAction.setText("Open relock settings")
         self.openIOSettingsAction = QAction(self)
         self.openIOSettingsAction.setText("Open IO settings")
+        self.openStateDebugAction = QAction(self)
+        self.openStateDebugAction.setText("Open state debug")
 
     def _connectActions(self):
         self.pid_button.clicked.connect(self.manual_set_pid_state)
         self.sweep_button.clicked.connect(self.set_sweep_state)
         self.update_graph_button.clicked.connect(self.get_scope_trace)
-        self.dump_trace_button.clicked.connect(self.dump_trace)
+        self.dump_trace_button.clicked.connect(lambda: self.dump_trace())
         self.offset_line.sigPositionChangeFinished.connect(self.update_offset_point_from_graph)
         self.offset_box.returnPressed.connect(self.update_offset_point_from_box)
+        self.use_suggested_button.clicked.connect(self.use_suggested_lock_point)
         self.autoupdate_button.clicked.connect(self.set_autoupdate)
-        self.relock_button.clicked.connect(self.relock)
+        self.relock_button.clicked.connect(self.manual_relock)
         self.autorelock_button.clicked.connect(self.set_autorelock)
         self.PISettingsButton.clicked.connect(self.openPISettingsAction.trigger)
         self.openPISettingsAction.triggered.connect(self.open_pi_settings_window)
@@ -109,6 +265,8 @@ class laser(QWidget):
         self.openRelockSettingsAction.triggered.connect(self.open_relock_settings_window)
         self.IOSettingsButton.clicked.connect(self.openIOSettingsAction.trigger)
         self.openIOSettingsAction.triggered.connect(self.open_io_settings_window)
+        self.stateDebugButton.clicked.connect(self.openStateDebugAction.trigger)
+        self.openStateDebugAction.triggered.connect(self.open_state_debug_window)
 
     def _create_log_dir(self):
         """Creates a log directory used for saving the lockbox state if it 
@@ -163,6 +321,19 @@ class laser(QWidget):
         self.last_lock_line.setPen({'color': "#0000FF", 'width': 2})
         self.scope_plot.addItem(self.last_lock_line)
 
+        self.suggested_lock_line = pg.InfiniteLine(pos=0,angle=90)
+        self.suggested_lock_line.setMovable(False)
+        self.suggested_lock_line.setPen({'color': "#00AA00", 'width': 2, 'style': Qt.DashLine})
+        self.suggested_lock_line.setVisible(False)
+        self.scope_plot.addItem(self.suggested_lock_line)
+
+        lock_point_layout = QHBoxLayout()
+        self.use_suggested_button = QtWidgets.QPushButton("use suggested lock point")
+        self.auto_lock_point_button = QtWidgets.QPushButton("auto lock point")
+        self.auto_lock_point_button.setCheckable(True)
+        lock_point_layout.addWidget(self.use_suggested_button)
+        lock_point_layout.addWidget(self.auto_lock_point_button)
+
         offset_layout = QFormLayout()
         self.offset_box = QLineEdit()
         offset_layout.addRow('manual lock point [V]', self.offset_box)
@@ -178,6 +349,7 @@ class laser(QWidget):
         layout.addWidget(self.scope_plot)
         layout.addWidget(self.update_graph_button)
         layout.addLayout(dump_layout)
+        layout.addLayout(lock_point_layout)
         layout.addLayout(offset_layout)
         self.layout.addLayout(layout)
         
@@ -235,12 +407,33 @@ class laser(QWidget):
             "offset [V]": 0,
             "integrator": 0,
             "autoupdate interval [s]": 1,
+            "max autoupdate interval [s]": MAX_INTERVAL,
+            "adaptive autoupdate": True,
+            "safe margin": SAFE_MARGIN,
             "relock interval [s]": 1,
             "scope duration [s]": 1,
             "max voltage [V]": 1,
             "min voltage [V]": -1,
             "last lock voltage [V]": 0,
+            "lock threshold [V]": LOCK_THRESHOLD,
+            "lock window [s]": LOCK_WINDOW,
             "relock setting": "manual",
+            "relock search step [V]": 0.02,
+            "last locked voltage [V]": None,
+            "relock probe duration [s]": 0.01,
+            "relock probes": 3,
+            "relock retries": 3,
+            "unlock warning time [s]": WARNING_TIME,
+            "relock when at risk": False,
+            "lock debounce": backoff.DEBOUNCE,
+            "relock backoff [s]": backoff.BACKOFF,
+            "max relock backoff [s]": backoff.MAX_BACKOFF,
+            "park after failed relocks": backoff.PARK_AFTER,
+            "relock hold time [s]": backoff.HOLD_TIME,
+            "recentre lock": False,
+            "recentre threshold [V]": 0.05,
+            "recentre step [V]": 0.005,
+            "relock after": [],
             "sweep max [V]": 1,
             "sweep min [V]": -1,
             "sweep frequency [Hz]": 50
@@ -276,10 +469,14 @@ class laser(QWidget):
         self.io_settings_window.setWindowModality(Qt.ApplicationModal)
         self.io_settings_window.show()
 
+    def open_state_debug_window(self):
+        self.state_debug_window = StateDebugWindow(self)
+        self.state_debug_window.show()
+
     def update_io(self):
         self.io_settings_window = None
         if self.settings['ip'] != self.ip:
-            self.rp = RedPitaya(self,self.settings['ip'])
+            self.rp = RedPitaya(self,self.settings['ip'],clock=self.clock)
         self.ip = self.settings['ip']
         self.set_settings()
 
@@ -296,6 +493,9 @@ class laser(QWidget):
         if self.pid_enabled:
             if offset_override is None:
                 offset = self.settings['offset [V]']
+            else:
+                offset = offset_override
+            self.applied_offset = offset
             self.rp.set_asg_value(self.settings['asg_index'],'output','off')
             self.rp.set_asg_value(self.settings['asg_index'],'waveform','dc')
             self.rp.set_asg_value(self.settings['asg_index'],'offset',offset)
@@ -322,7 +522,10 @@ class laser(QWidget):
         else:
             self.rp.set_pid_value(self.settings['pid_index'],'output','off')
             self.rp.set_asg_value(self.settings['asg_index'],'output','off')
+        manual_offset = self.settings['offset [V]']
         self.get_settings()
+        if offset_override is not None:
+            self.settings['offset [V]'] = manual_offset
         self.write_settings_to_file()
         
     def get_settings(self):
@@ -360,89 +563,313 @@ class laser(QWidget):
             for widget in self.pid_widgets:
                 widget.setEnabled(self.pid_controls_unlocked)
     
+    def transition(self,event,handler=None,*args):
+        """Fires event on the lock state machine and runs handler(*args) to 
+        do the hardware operations of the transition, recording how many
+        hardware calls they took. Returns the transition."""
+        transition = self.lock_state.fire(event)
+        calls = self.rp.hardware_calls
+        if handler is not None:
+            handler(*args)
+        self.lock_state.finish(transition,self.rp.hardware_calls - calls)
+        return transition
+
+    def _state_changed(self,transition):
+        """Updates the buttons and lock display after every transition."""
+        print('{}: {} --{}--> {} ({} hardware calls)'.format(self.name,transition.old,
+              transition.event,transition.new,transition.hardware_calls))
+        self.export_status()
+        pid_on = self.pid_enabled
+        self.pid_button.setChecked(pid_on)
+        self.pid_button.setEnabled(not self.is_relocking)
+        self.sweep_button.setChecked(self.sweep_enabled)
+        self.sweep_button.setEnabled(self.lock_state.state in ['off','sweeping'])
+        self.offset_line.setMovable(not (pid_on or self.is_relocking))
+        self.offset_box.setReadOnly(pid_on or self.is_relocking)
+        if (transition.new in ['relocking','verifying','unlocked']) or (transition.event == 'relock succeeded'):
+            self.poller.mark_unstable(self.clock.time())
+            if getattr(self,'autoupdate_thread',None) is not None:
+                self.autoupdate_thread.refresh_time = min(self.autoupdate_thread.refresh_time,
+                                                          self.poller.min_interval)
+        self.update_locked_display()
+        self._refresh_debug_window()
+
+    def _log_transition(self,transition):
+        """Logs every transition, including relocks, to the telemetry log."""
+        time = self.clock.time() if transition.time is None else transition.time
+        self.main_gui.telemetry.event(self.name,time,transition.event,
+                                      '{} -> {}'.format(transition.old,transition.new))
+
+    def log_telemetry(self):
+        """Adds the result of a lock check to the telemetry log."""
+        telemetry = getattr(self.main_gui,'telemetry',None)
+        if telemetry is None:
+            return
+        std = None if self.asg_trace is None else float(np.nanstd(self.asg_trace))
+        telemetry.record(self.name,self.clock.time(),self.lock_state.state,self.raw_locked,
+                         self.mean_voltage,std,self.applied_offset,
+                         self.integrator if self.raw_locked else None)
+
+    def export_status(self):
+        """Writes the lock status to the sequencer's lock gate, the 
+        monitoring server and to shared memory, if exported."""
+        gate = getattr(self.main_gui,'lock_gate',None)
+        if gate is not None:
+            gate.update(self.name,self.lock_state.state,self.autorelock,self.clock.time())
+        monitor = getattr(self.main_gui,'monitor_hub',None)
+        if monitor is not None:
+            relocks = sum(count for (_, event, _), (count, _) in self.lock_state.stats.items()
+                          if event == 'relock')
+            monitor.update_status(self.name,self.clock.time(),state=self.lock_state.state,
+                                  locked=self.is_locked,autorelock=self.autorelock,
+                                  mean=self.mean_voltage,margin=self.lock_margin,
+                                  offset=self.applied_offset,integrator=self.integrator,
+                                  time_to_rail=self.unlock_predictor.time_to_rail,relocks=relocks)
+        if self.shared_export is None:
+            return
+        margin = float('nan') if self.lock_margin is None else self.lock_margin
+        self.shared_export.write_status(self.clock.time(),self.lock_state.state,self.is_locked,
+                                        self.raw_locked,self.autorelock,self.mean_voltage,margin)
+
+    def release_exports(self):
+        """Removes the laser from the lock gate and monitoring server, 
+        closes its shared memory export and saves the resonance map."""
+        self.resonance_map.save()
+        gate = getattr(self.main_gui,'lock_gate',None)
+        if gate is not None:
+            gate.remove(self.name)
+        monitor = getattr(self.main_gui,'monitor_hub',None)
+        if monitor is not None:
+            monitor.remove(self.name)
+        if self.shared_export is not None:
+            self.shared_export.close()
+            self.shared_export = None
+
+    def _apply_lock(self,offset,integrator=None):
+        self.applied_offset = offset
+        self.rp.apply_lock(self.settings['pid_index'],self.settings['asg_index'],offset,
+                           self.settings['max voltage [V]'],self.settings['min voltage [V]'],
+                           self.settings['output'],integrator)
+
+    def _apply_sweep(self):
+        asg_max = min(self.settings['sweep max [V]'],self.settings['max voltage [V]'])
+        asg_min = max(self.settings['sweep min [V]'],self.settings['min voltage [V]'])
+        self.rp.apply_sweep(self.settings['pid_index'],self.settings['asg_index'],
+                            (asg_max+asg_min)/2,abs(asg_max-asg_min)/2,
+                            self.settings['sweep frequency [Hz]'],self.settings['output'])
+
+    def _outputs_off(self):
+        self.rp.outputs_off(self.settings['pid_index'],self.settings['asg_index'])
+
     def set_sweep_state(self,state=None):
         print('sweep state {}'.format(self.settings['output']))
         if state is None:
             state = self.sweep_button.isChecked()
-        else:
-            self.sweep_button.setChecked(state)
-        if state:
-            self.pid_enabled = False
-            self.pid_button.setChecked(self.pid_enabled)
-            self.pid_button.setEnabled(False)
-        else:
-            self.pid_button.setEnabled(True)
-            self.pid_button.setChecked(self.pid_enabled)
-        self.sweep_enabled = state
-        self.set_settings()
+        event = 'sweep on' if state else 'sweep off'
+        if not self.lock_state.can(event):
+            self.sweep_button.setChecked(self.sweep_enabled)
+            return
         if state:
+            self.transition(event,self._apply_sweep)
             self.get_scope_trace()
+        else:
+            self.transition(event,self._outputs_off)
     
     def manual_set_pid_state(self):
+        self.lock_history.clear()
+        self.unlock_predictor.reset()
+        self.relock_guard.reset()
         self.set_pid_state(manual_trig=True)
 
     def set_pid_state(self,state=None,offset_override=None,manual_trig=False):
+        """Enables the PID at the manual lock point (or offset_override) or
+        disables it. Only the registers needed for the change are written."""
         print('pid state, {}'.format(state))
         if state == None:
             state = self.pid_button.isChecked()
-        else:
-            self.pid_button.setChecked(state)
-        print('output',self.settings['output'])
+        event = 'pid on' if state else 'pid off'
+        if not self.lock_state.can(event):
+            self.pid_button.setChecked(self.pid_enabled)
+            return
+        was_sweeping = self.sweep_enabled
         if state:
-            print('predump, {}'.format(manual_trig))
-            self.sweep_enabled = False
-            self.sweep_button.setChecked(self.sweep_enabled)
-            self.sweep_button.setEnabled(False)
-            self.offset_line.setMovable(False)
-            self.offset_box.setReadOnly(True)
-            # TODO: INSERT SOMETHING HERE TO SAVE TRACE BEFORE MANUAL LOCK WITH LOCK POINT TO TRAIN PATTERN RECOGNITION
             if manual_trig:
                 print('dump')
-                dump = [self.times,self.asg_trace,self.input_trace,self.settings]
-                now = datetime.now() # current date and time
-                filename = r'.\trace dumps\{}\manual pid enabling\{}.pickle'.format(self.name,now.strftime("%Y.%m.%d.%H.%M.%S.%f"))
-                os.makedirs(os.path.dirname(filename), exist_ok=True)
-                with open(filename, 'wb') as file:
-                    pickle.dump(dump,file)
+                self.dump_trace(event='manual')
+                if was_sweeping:
+                    self.learn_lock_point()
+            offset = self.settings['offset [V]'] if offset_override is None else offset_override
+            self.transition(event,self._apply_lock,offset,self.settings['integrator'])
         else:
-            self.sweep_button.setEnabled(True)
-            self.sweep_button.setChecked(self.sweep_enabled)
-            self.offset_line.setMovable(True)
-            self.offset_box.setReadOnly(False)
-        self.pid_enabled = state
-        self.set_settings(offset_override)
-        self.get_scope_trace()
+            self.transition(event,self._outputs_off)
 
     def set_autorelock(self,state=None):
         if state is None:
             state = self.autorelock_button.isChecked()
         else:
             self.autorelock_button.setChecked(state)
-        self.autorelock = state
+        self.lock_state.autorelock = state
+        self.export_status()
+
+    def manual_relock(self):
+        """Relock from the relock button. Clears any backoff or parking."""
+        self.relock_guard.reset(locked=False)
+        self.relock()
 
     def relock(self):
         """Triggers a single relock event. Relock event will only trigger iff 
-        the laser is currently not locked or relocking.
+        the lock state allows it, i.e. not while relocking.
+
+        If the PID is already enabled the fast path is used, which only writes
+        the registers that have to change (PID output off, integrator reset 
+        and the offset if it has moved). Otherwise the PID is enabled at the
+        candidate offset at the end of the relock interval.
         """
-        if not self.is_relocking:
-            self.set_pid_state(state=False)
-            self.pid_button.setEnabled(False)
-            self.sweep_button.setEnabled(False)
-            self.relock_thread = counter_thread(refresh_time=self.settings['relock interval [s]'])
-            self.relock_thread.signal.connect(self.refresh_relock_bar)
-            self.relock_thread.start()
+        if not self.lock_state.can('relock'):
+            return
+        self.unlock_predictor.reset()
+        strategy = make_strategy(self.settings,self.expected_lock_point())
+        if self.pid_enabled:
+            self.fast_relock = True
+            self.relock_hw_time = 0
+            self.relock_logic.start(self.clock.time(),strategy,self.lock_history.warm_state())
+            self.transition('relock',self._begin_relock_candidate)
+        else:
+            self.fast_relock = False
+            self.relock_logic.start(self.clock.time(),strategy)
+            self.relock_logic.next_candidate()
+            self.transition('relock')
+        self.relock_thread = counter_thread(refresh_time=self.settings['relock interval [s]'],clock=self.clock)
+        self.relock_thread.signal.connect(self.refresh_relock_bar)
+        self.relock_thread.start()
+
+    def _begin_relock_candidate(self):
+        """First candidate of a fast relock: a warm start from the lock 
+        history if it is healthy, otherwise the relock strategy's offset."""
+        candidate = self.relock_logic.next_candidate()
+        if candidate is None:
+            return
+        self.relock_hw_time = self._begin_relock(candidate)
+
+    def _begin_relock(self,candidate):
+        """Fast relock to a candidate state, only moving the offset if needed.
+        Returns the hardware time taken [s]."""
+        if candidate['offset'] == self.applied_offset:
+            return self.rp.begin_relock(self.settings['pid_index'],self.settings['asg_index'],
+                                        integrator=candidate['integrator'])
+        self.applied_offset = candidate['offset']
+        return self.rp.begin_relock(self.settings['pid_index'],self.settings['asg_index'],
+                                    candidate['offset'],self.settings['max voltage [V]'],
+                                    self.settings['min voltage [V]'],candidate['integrator'])
             
     def _finish_relock(self):
-        """Triggers a single relock event regardless of the locked status, but 
-        will still not allow triggering if a relocking event is currently in 
-        progress.
+        """Re-engages the PID at the end of the relock interval and starts 
+        actively verifying the lock.
+        """
+        if self.relock_candidate is None:
+            self.transition('engage')
+            self._end_relock_attempt(False,None)
+            return
+        self.transition('engage',self._engage)
+        self._start_relock_verification()
+
+    def _engage(self):
+        if self.fast_relock:
+            self.relock_hw_time += self.rp.end_relock(self.settings['pid_index'],
+                                                      self.settings['output'])
+            self.relock_timings.append(self.relock_hw_time)
+            print('relock hardware time {:.1f} ms'.format(self.relock_hw_time*1000))
+        else:
+            self._apply_lock(self.relock_candidate['offset'],self.relock_candidate['integrator'])
+
+    def _retry_relock(self,candidate):
+        self.relock_hw_time = self._begin_relock(candidate)
+        self.relock_hw_time += self.rp.end_relock(self.settings['pid_index'],
+                                                  self.settings['output'])
+
+    def _start_relock_verification(self):
+        self.relock_logic.start_attempt(self.clock.time(),self.applied_offset)
+        self._queue_relock_probe()
+
+    def _queue_relock_probe(self):
+        self.rp.queue_scope_trace(self.settings['output'],self.settings['input'],
+                                  self.settings['relock probe duration [s]'],
+                                  callback=self._relock_probe)
+
+    def _relock_probe(self,times,datas,duration):
+        """Short scope trace taken right after re-engaging the PID. The relock
+        succeeds after 'relock probes' consecutive locked probes; a single 
+        unlocked probe fails the attempt and the next candidate offset is 
+        tried straight away until 'relock retries' is exhausted.
         """
-        if (self.settings['relock setting'] == 'prev') and (self.prev_lock_point is not None):
-            self.set_pid_state(state=True,offset_override=self.prev_lock_point)
+        if (self.relock_logic.attempt is None) or (self.lock_state.state != 'verifying'):
+            return
+        locked, mean_voltage = check_lock(datas[0],self.settings,times)
+        success = self.relock_logic.probe(locked)
+        if success is None:
+            self._queue_relock_probe()
         else:
-            self.set_pid_state(state=True)
-        self.pid_button.setEnabled(True)
-        self.sweep_button.setEnabled(self.sweep_enabled)
+            self._end_relock_attempt(success,mean_voltage)
+
+    def _end_relock_attempt(self,success,mean_voltage):
+        attempt = self.relock_logic.end_attempt(self.clock.time(),success,mean_voltage)
+        if attempt is None:
+            self._end_relock(False,mean_voltage)
+            return
+        self.relock_attempts.append(attempt)
+        self.lock_history.record_start(attempt['start'],success)
+        self._log_relock_attempt(attempt)
+        print('{} {} relock {} after {:.3f} s at offset {}'.format(attempt['strategy'],
+              attempt['start'],'succeeded' if success else 'failed',
+              attempt['latency [s]'],attempt['offset']))
+        if not success:
+            candidate = self.relock_logic.retry()
+            if candidate is not None:
+                self.transition('retry',self._retry_relock,candidate)
+                self._start_relock_verification()
+                return
+        self._end_relock(success,mean_voltage)
+
+    def _end_relock(self,success,mean_voltage):
+        events = self.relock_logic.end(self.clock.time(),success)
+        if success:
+            self.last_locked_time = self.clock.localtime()
+            self.prev_lock_point = mean_voltage
+            self.settings['last locked voltage [V]'] = mean_voltage
+            self.previous_lock_box.setText(str(mean_voltage))
+            self.last_lock_line.setValue(mean_voltage)
+        elif 'park' in events:
+            print('{} parked after {} failed relocks'.format(self.name,self.relock_guard.failures))
+        for event in events:
+            self.transition(event)
+
+    def _log_relock_attempt(self,attempt):
+        """Appends a relock attempt to logs/<name>/relock attempts.csv so the 
+        strategies can be compared over time."""
+        log_dir = Path.cwd()/Path("logs/"+self.name)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        path = log_dir/'relock attempts.csv'
+        fields = ['time','strategy','start','offset','success','probes',
+                  'latency [s]','time to lock [s]']
+        new_file = not path.exists()
+        with open(path, 'a', newline='') as csv_file:
+            w = csv.DictWriter(csv_file, fields, extrasaction='ignore')
+            if new_file:
+                w.writeheader()
+            w.writerow(attempt)
+
+    def relock_strategy_stats(self):
+        """Returns {strategy: (attempts, successes, mean time to lock [s])} 
+        for the relock attempts of this session."""
+        stats = {}
+        for attempt in self.relock_attempts:
+            attempts, successes, times = stats.get(attempt['strategy'],(0,0,[]))
+            if attempt['success']:
+                successes += 1
+                times = times + [attempt['time to lock [s]']]
+            stats[attempt['strategy']] = (attempts+1,successes,times)
+        return {strategy: (attempts,successes,sum(times)/len(times) if times else None)
+                for strategy, (attempts,successes,times) in stats.items()}
 
     def refresh_relock_bar(self, msg):
         """Controlling function for the progress bar. When complete, progress
@@ -458,28 +885,188 @@ class laser(QWidget):
         duration = 0.1
         self.rp.queue_scope_trace(self.settings['output'],self.settings['input'],duration)
 
-    def dump_trace(self):
-        dump = [self.times,self.asg_trace,self.input_trace,self.settings]
-        now = datetime.now() # current date and time
-        filename = r'.\trace dumps\{}\general dumps\{}.pickle'.format(self.name,now.strftime("%Y.%m.%d.%H.%M.%S.%f"))
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        with open(filename, 'wb') as file:
-            pickle.dump(dump,file)
+    @property
+    def packs_acquisitions(self):
+        """Whether autoupdates only need the output channel, which the scope
+        arbiter can then acquire together with another laser's."""
+        return ((getattr(self.main_gui,'scope_arbiter',None) is not None) and
+                (self.lock_state.state in ['locked','unlocked','parked']))
 
-    def update_scope_trace(self,times,datas,duration):
+    def autoupdate_scope_trace(self):
+        if self.packs_acquisitions:
+            self.main_gui.scope_arbiter.request(self,0.1)
+        else:
+            self.get_scope_trace()
+
+    def dump_trace(self,event='general'):
+        """Appends the current trace and settings to the laser's trace 
+        archive. Use relocker.traces.TraceIndex to query the archives."""
+        input_trace = self.input_trace
+        if (input_trace is None) and (self.asg_trace is not None):
+            input_trace = np.full(len(self.asg_trace),np.nan) # monitor trace without the input
+        self.trace_store.append(self.name,self.clock.time(),event,self.times,
+                                self.asg_trace,input_trace,self.settings)
+
+    def plot_trace(self,frame):
+        """Trace bus subscriber that plots each trace."""
         self.scope_plot.clear()
+        self.scope_plot.plot(frame.output,frame.input, pen=pg.mkPen(color=(0,0,0),width=2))
+        self.scope_plot.addItem(self.offset_line)
+        self.scope_plot.addItem(self.last_lock_line)
+        self.scope_plot.addItem(self.suggested_lock_line)
+
+    def dump_frame(self,frame):
+        """Trace bus subscriber that archives each trace if save trace on 
+        update is checked. Monitor traces are archived with a NaN input."""
+        if not self.save_trace_on_update_button.isChecked():
+            return
+        input_trace = frame.input
+        if (input_trace is None) and (frame.output is not None):
+            input_trace = np.full(len(frame.output),np.nan)
+        pool = getattr(self.main_gui,'analysis_pool',None)
+        args = (self.name,frame.time,'general',frame.times,frame.output,input_trace,dict(self.settings))
+        if pool is None:
+            self.trace_store.append(*args)
+        else:
+            pool.submit('dump',self.trace_store.append,*args)
+
+    def analyse_frame(self,frame):
+        """Trace bus subscriber for the lock logic."""
+        self.update_scope_trace(frame.times,frame.datas,frame.duration)
+
+    def update_scope_trace(self,times,datas,duration):
+        """Analyses a trace, checks the lock and relocks if needed."""
         self.times = times
         self.asg_trace = datas[0]
         self.input_trace = datas[1]
-        self.scope_plot.plot(datas[0],datas[1], pen=pg.mkPen(color=(0,0,0),width=2))
-        self.scope_plot.addItem(self.offset_line)
-        self.scope_plot.addItem(self.last_lock_line)
-        if self.save_trace_on_update_button.isChecked():
-                self.dump_trace()
-        self.check_if_locked()
-        if self.pid_enabled and self.autorelock and (not self.is_locked) and (not self.is_relocking):
-            self.relock()
+        pool = getattr(self.main_gui,'analysis_pool',None)
+        if self.sweep_enabled:
+            args = (self.times,self.asg_trace,self.input_trace,self.settings['setpoint [V]'])
+            if pool is None:
+                self.sweep_analysed(analyse_sweep(*args))
+            else:
+                pool.submit('sweep analysis',analyse_sweep,*args,
+                            key=(self.name,'sweep'),callback=self.sweep_analysed)
+        elif self.pid_enabled and (pool is not None):
+            pool.submit('lock analysis',analyse_lock,self.times,self.asg_trace,self.input_trace,
+                        key=(self.name,'lock'),callback=self.lock_analysed)
+        batch = getattr(self.main_gui,'lock_batch',None)
+        if (batch is not None) and (self.lock_state.state in ['locked','unlocked','parked']):
+            batch.add(self,self.asg_trace,self.settings,self.times)
+        else:
+            self.check_if_locked()
+            self.finish_update()
+
+    def sweep_analysed(self,result):
+        """Result of the analysis of a sweep trace."""
+        self.trace_stats = result['spectrum']
+        if self.sweep_enabled:
+            self.find_lock_point(result['resonances'])
+        self._refresh_debug_window()
+
+    def lock_analysed(self,result):
+        """Result of the analysis of a trace while locked."""
+        if result['spectrum'] is not None:
+            self.trace_stats = result['spectrum']
+        self.output_stats = result['output spectrum']
+        self._refresh_debug_window()
+
+    def _refresh_debug_window(self):
+        if getattr(self,'state_debug_window',None) is not None:
+            self.state_debug_window.refresh()
+
+    def lock_checked(self,locked,mean_voltage):
+        """Result of a batched lock check of the last trace."""
+        self.check_if_locked((locked,mean_voltage))
+        self.finish_update()
+
+    def finish_update(self):
+        """Adapts the autoupdate interval and relocks if needed once the lock
+        check of a trace is done."""
+        self.poller.update(self.clock.time(),self.is_locked,
+                           self.headroom if self.is_locked else None,
+                           self.unlock_predictor.at_risk)
+        if self.relock_logic.wants_relock(self.clock.time()):
+            self.request_relock()
     
+    def find_lock_point(self,resonances=None):
+        """Finds the resonances in the current sweep trace (unless already 
+        found by the analysis pool) and tracks the suggested lock point (green
+        line) from sweep to sweep. If auto lock point is on the manual lock 
+        point follows it, so that enabling the PID locks to the tracked 
+        resonance.
+        """
+        if resonances is None:
+            resonances = find_resonances(self.asg_trace,self.input_trace,
+                                         self.settings['setpoint [V]'])
+        self.resonances = resonances
+        hint = None
+        if self.resonance_tracker.acquiring:
+            hint = self.recognise_lock_point()
+            if hint is None:
+                hint = self.expected_lock_point()
+        point = self.resonance_tracker.update(self.clock.time(),*self.resonances,hint=hint)
+        self.observe_resonances([peak.position for peak in self.resonances[0]],'peak')
+        self.observe_resonances([edge.position for edge in self.resonances[1]],'edge')
+        self.suggested_lock_line.setVisible(point is not None)
+        if point is None:
+            return
+        self.suggested_lock_line.setValue(point)
+        if self.auto_lock_point_button.isChecked():
+            self.use_suggested_lock_point()
+
+    def recognise_lock_point(self):
+        """Lock point the operator chose for the most similar previous sweep,
+        or None if there is no sufficiently good match in the template 
+        library."""
+        if self.template_library is None:
+            return None
+        match = self.template_library.match(self.asg_trace,self.input_trace)
+        if (match is None) or (match[1] < MIN_SCORE):
+            return None
+        return match[0]
+
+    def learn_lock_point(self):
+        """Adds the current sweep and manual lock point to the template 
+        library."""
+        if self.asg_trace is None:
+            return
+        if self.template_library is None:
+            self.template_library = TemplateLibrary(self.settings['min voltage [V]'],
+                                                    self.settings['max voltage [V]'])
+        if self.template_library.add(self.asg_trace,self.input_trace,
+                                     self.settings['offset [V]'],self.clock.time()):
+            os.makedirs(os.path.dirname(self.template_path),exist_ok=True)
+            self.template_library.save(self.template_path)
+
+    def expected_lock_point(self):
+        """Lock point expected from the resonance map nearest to the manual 
+        lock point, or None if the map has no prediction."""
+        point = self.resonance_map.expected_lock_point(self.clock.time(),
+                                                       near=self.settings['offset [V]'])
+        if (point is None) or not (self.settings['min voltage [V]'] <= point <= self.settings['max voltage [V]']):
+            return None
+        return point
+
+    def observe_resonances(self,positions,kind):
+        """Adds resonance positions to the resonance map, saving the map at 
+        most every RESONANCE_MAP_SAVE_INTERVAL."""
+        self.resonance_map.observe(self.clock.time(),positions,kind)
+        if self.clock.time() - self.resonance_map_saved >= RESONANCE_MAP_SAVE_INTERVAL:
+            self.resonance_map.save()
+            self.resonance_map_saved = self.clock.time()
+
+    def use_suggested_lock_point(self):
+        """Moves the manual lock point to the tracked resonance, or to the 
+        lock point expected from the resonance map if nothing is tracked 
+        (e.g. before the first sweep)."""
+        point = self.resonance_tracker.position
+        if point is None:
+            point = self.expected_lock_point()
+        if (point is not None) and self.offset_line.movable:
+            self.offset_line.setValue(point)
+            self.update_offset_point_from_graph()
+
     def update_offset_point_from_graph(self):
         self.settings['offset [V]'] = self.offset_line.value()
         self.offset_box.setText(str(self.settings['offset [V]']))
@@ -493,7 +1080,7 @@ class laser(QWidget):
         bar counting iff it does not already exist and is counting.
         """
         if self.autoupdate_button.isChecked() and self.autoupdate_bar.value() <= 0:
-            self.autoupdate_thread = counter_thread(refresh_time=self.settings['autoupdate interval [s]'])
+            self.autoupdate_thread = counter_thread(refresh_time=self.next_autoupdate_interval(),clock=self.clock)
             self.autoupdate_thread.signal.connect(self.refresh_autoupdate_bar)
             self.autoupdate_thread.start()
 
@@ -506,46 +1093,117 @@ class laser(QWidget):
         if self.autoupdate_bar.value() >= 100:
             self.autoupdate_bar.setValue(0)
             if self.autoupdate_button.isChecked():
-                self.get_scope_trace()
+                self.autoupdate_scope_trace()
+                self.autoupdate_thread.refresh_time = self.next_autoupdate_interval()
                 self.autoupdate_thread.start()
 
-    def check_if_locked(self):
+    def next_autoupdate_interval(self):
+        """Time [s] until the next autoupdate: the adaptive interval (or the 
+        fixed 'autoupdate interval [s]'), delayed if needed to keep within 
+        the acquisition budget of the board."""
+        if self.settings['adaptive autoupdate']:
+            interval = self.poller.interval
+        else:
+            interval = self.settings['autoupdate interval [s]']
+        now = self.clock.time()
+        cost = 0.5 if self.packs_acquisitions else 1
+        return self.main_gui.acquisition_budget.reserve(self.ip,now+interval,now,cost) - now
+
+    def check_if_locked(self,result=None):
         """Attempts to determine whether the laser is locked by seeing if the 
         the mean of the output signal is within a threshold value of the 
-        maximum or minimum voltage.
+        maximum or minimum voltage. The lock state only changes after 'lock 
+        debounce' consecutive traces agree. result is (locked, mean_voltage)
+        if the trace has already been checked as part of a batch.
         """
-        if not self.pid_enabled:
-            self.is_locked = False
-        elif (not self.is_relocking) and (not self.has_just_relocked):
-            output = self.asg_trace
-            output = [value for value in output if not math.isnan(value)]
-            mean_voltage = sum(output)/len(output)
-            max_voltage = self.settings['max voltage [V]']
-            min_voltage = self.settings['min voltage [V]']
-            threshold = 0.05
-            #threshold = 10
-            if ((abs(mean_voltage - max_voltage) < threshold) or 
-                (abs(mean_voltage - min_voltage) < threshold)):
-                self.is_locked = False
+        state = self.lock_state.state
+        if state in ['locked','unlocked','parked']:
+            if result is None:
+                result = check_lock(self.asg_trace,self.settings,self.times)
+            locked, mean_voltage = result
+            self.raw_locked = locked
+            self.mean_voltage = mean_voltage
+            self.lock_margin = lock_margin(mean_voltage,self.settings['max voltage [V]'],
+                                           self.settings['min voltage [V]'])
+            event = self.relock_logic.check(self.clock.time(),locked)
+            if event is not None:
+                self.transition(event)
+            if not locked:
+                self.headroom = None
+                self.log_telemetry()
+                self.export_status()
             else:
-                self.is_locked = True
-                self.last_locked_time = time.localtime()
+                self.last_locked_time = self.clock.localtime()
+                self.prev_lock_point = mean_voltage
+                integrator = self.rp.get_pid_value(self.settings['pid_index'],'integrator')
+                self.lock_history.add(self.clock.time(),self.applied_offset,integrator,
+                                      self.settings['max voltage [V]'],self.settings['min voltage [V]'])
                 self.settings['last locked voltage [V]'] = mean_voltage
                 self.previous_lock_box.setText(str(mean_voltage))
                 self.last_lock_line.setValue(mean_voltage)
+                self.observe_resonances([mean_voltage],'edge')
+                if self.settings['recentre lock']:
+                    integrator = self.recentre_lock(integrator)
+                self.unlock_predictor.update(self.clock.time(),mean_voltage,
+                                             self.settings['max voltage [V]'],
+                                             self.settings['min voltage [V]'],
+                                             integrator,self.applied_offset)
+                self.integrator = integrator
+                self.headroom = None
+                if (integrator is not None) and (self.applied_offset is not None):
+                    self.headroom = integrator_headroom(integrator,self.applied_offset,
+                                                        self.settings['max voltage [V]'],
+                                                        self.settings['min voltage [V]'])
+                self.log_telemetry()
+                self.export_status()
+                if (self.unlock_predictor.at_risk and self.settings['relock when at risk'] 
+                        and self.autorelock and self.relock_guard.may_relock(self.clock.time())):
+                    print('lock at risk ({:.1f} s to rail), relocking'.format(self.unlock_predictor.time_to_rail))
+                    self.request_relock('pre-emptive relock')
+                    return
         self.update_locked_display()
 
+    def recentre_lock(self,integrator):
+        """Bumpless re-centering while locked. If the integrator is more than
+        'recentre threshold [V]' from zero the ASG offset is moved towards it
+        by at most 'recentre step [V]' and the integrator and PID limits by 
+        the opposite amount, so the total output is unchanged and the PID 
+        drifts back to mid-range over successive updates. Returns the new 
+        integrator value.
+        """
+        if (integrator is None) or (self.applied_offset is None):
+            return integrator
+        if abs(integrator) <= self.settings['recentre threshold [V]']:
+            return integrator
+        step = self.settings['recentre step [V]']
+        offset = self.applied_offset + max(-step,min(step,integrator))
+        offset = max(self.settings['min voltage [V]'],min(self.settings['max voltage [V]'],offset))
+        integrator -= offset - self.applied_offset
+        self.rp.recentre(self.settings['pid_index'],self.settings['asg_index'],offset,
+                         integrator,self.settings['max voltage [V]'],
+                         self.settings['min voltage [V]'])
+        self.applied_offset = offset
+        return integrator
+
     def update_locked_display(self):
         if self.is_relocking:
             self.locked_label.setText("<h2>Relocking</h2>")
             self.locked_label.setStyleSheet("background: yellow")
-        elif self.has_just_relocked:
-            self.locked_label.setText("<h2>Locked?</h2>")
-            self.locked_label.setStyleSheet("background: gray")
-            self.has_just_relocked = False
+        elif self.lock_state.state == 'parked':
+            self.locked_label.setText("<h2>Parked ({} failed relocks)</h2>".format(
+                                      self.relock_guard.failures))
+            self.locked_label.setStyleSheet("background: purple; color: white")
+        elif self.is_locked and self.unlock_predictor.at_risk:
+            self.locked_label.setText("<h2>Locked (at risk: {:.0f} s to rail)</h2>".format(
+                                      self.unlock_predictor.time_to_rail))
+            self.locked_label.setStyleSheet("background: orange")
         elif self.is_locked:
             self.locked_label.setText("<h2>Locked</h2>")
             self.locked_label.setStyleSheet("background: green")
+        elif self.relock_guard.wait(self.clock.time()) > 0:
+            self.locked_label.setText("<h2>Not locked (relock in {:.0f} s)</h2>".format(
+                                      self.relock_guard.wait(self.clock.time())))
+            self.locked_label.setStyleSheet("background: red")
         else:
             self.locked_label.setText("<h2>Not locked</h2>")
             self.locked_label.setStyleSheet("background: red")    
@@ -716,42 +1374,113 @@ class RelockSettingsWindow(QWidget):
 
     def _create_relock_controls(self):
         layout = QtWidgets.QGridLayout()
-        relock_v_label = QtWidgets.QLabel("relock voltage")
-        self.initial_relock_v_button = QtWidgets.QRadioButton("manual lock point")
-        self.prev_relock_v_button = QtWidgets.QRadioButton("value at last lock")
-        # self.custom_relock_v_button = QtWidgets.QRadioButton("custom [V]")
-        # self.custom_relock_v_box = QtWidgets.QLineEdit()
-        # self.custom_relock_v_box.setValidator(QtGui.QDoubleValidator())
-        self.initial_relock_v_button.setStyleSheet("color: #ff0000")
-        self.prev_relock_v_button.setStyleSheet("color: #0000ff")
-        layout.addWidget(self.initial_relock_v_button,0,1,1,3)
-        layout.addWidget(self.prev_relock_v_button,1,1,1,3)
-        # layout.addWidget(self.custom_relock_v_button,2,1,1,1)
-        # layout.addWidget(self.custom_relock_v_box,2,2,2,1)
-        layout.addWidget(relock_v_label,0,0,2,1)
+        relock_v_label = QtWidgets.QLabel("relock strategy")
+        self.strategy_buttons = {}
+        for i, (name, strategy) in enumerate(STRATEGIES.items()):
+            button = QtWidgets.QRadioButton(strategy.label)
+            layout.addWidget(button,i,1,1,3)
+            self.strategy_buttons[name] = button
+        self.strategy_buttons['manual'].setStyleSheet("color: #ff0000")
+        self.strategy_buttons['prev'].setStyleSheet("color: #0000ff")
+        layout.addWidget(relock_v_label,0,0,len(STRATEGIES),1)
         self.layout.addLayout(layout)
 
-        if self.laser.settings['relock setting'] == 'manual':
-            self.initial_relock_v_button.setChecked(True)
-        else:
-            self.prev_relock_v_button.setChecked(True)
+        self.strategy_buttons.get(self.laser.settings['relock setting'],
+                                  self.strategy_buttons['manual']).setChecked(True)
 
     def _create_additional_options(self):
         layout = QtWidgets.QFormLayout()
         self.autoupdate_duration_box = QtWidgets.QLineEdit()
         self.autoupdate_duration_box.setValidator(QtGui.QDoubleValidator())
+        self.max_autoupdate_box = QtWidgets.QLineEdit()
+        self.max_autoupdate_box.setValidator(QtGui.QDoubleValidator())
+        self.adaptive_box = QtWidgets.QCheckBox()
+        self.safe_margin_box = QtWidgets.QLineEdit()
+        self.safe_margin_box.setValidator(QtGui.QDoubleValidator())
         self.relock_duration_box = QtWidgets.QLineEdit()
         self.relock_duration_box.setValidator(QtGui.QDoubleValidator())
         self.scope_duration_box = QtWidgets.QLineEdit()
         self.scope_duration_box.setValidator(QtGui.QDoubleValidator())
+        self.lock_threshold_box = QtWidgets.QLineEdit()
+        self.lock_threshold_box.setValidator(QtGui.QDoubleValidator())
+        self.lock_window_box = QtWidgets.QLineEdit()
+        self.lock_window_box.setValidator(QtGui.QDoubleValidator())
+        self.probe_duration_box = QtWidgets.QLineEdit()
+        self.probe_duration_box.setValidator(QtGui.QDoubleValidator())
+        self.probes_box = QtWidgets.QLineEdit()
+        self.probes_box.setValidator(QtGui.QIntValidator())
+        self.retries_box = QtWidgets.QLineEdit()
+        self.retries_box.setValidator(QtGui.QIntValidator())
+        self.search_step_box = QtWidgets.QLineEdit()
+        self.search_step_box.setValidator(QtGui.QDoubleValidator())
+        self.warning_time_box = QtWidgets.QLineEdit()
+        self.warning_time_box.setValidator(QtGui.QDoubleValidator())
+        self.relock_at_risk_box = QtWidgets.QCheckBox()
+        self.debounce_box = QtWidgets.QLineEdit()
+        self.debounce_box.setValidator(QtGui.QIntValidator())
+        self.backoff_box = QtWidgets.QLineEdit()
+        self.backoff_box.setValidator(QtGui.QDoubleValidator())
+        self.max_backoff_box = QtWidgets.QLineEdit()
+        self.max_backoff_box.setValidator(QtGui.QDoubleValidator())
+        self.park_after_box = QtWidgets.QLineEdit()
+        self.park_after_box.setValidator(QtGui.QIntValidator())
+        self.hold_time_box = QtWidgets.QLineEdit()
+        self.hold_time_box.setValidator(QtGui.QDoubleValidator())
+        self.recentre_box = QtWidgets.QCheckBox()
+        self.recentre_threshold_box = QtWidgets.QLineEdit()
+        self.recentre_threshold_box.setValidator(QtGui.QDoubleValidator())
+        self.recentre_step_box = QtWidgets.QLineEdit()
+        self.recentre_step_box.setValidator(QtGui.QDoubleValidator())
+        self.relock_after_box = QtWidgets.QLineEdit()
+        self.relock_after_box.setToolTip('comma separated names of the lasers to lock before this one')
         layout.addRow('autoupdate interval [s]:', self.autoupdate_duration_box)
+        layout.addRow('adaptive autoupdate:', self.adaptive_box)
+        layout.addRow('max autoupdate interval [s]:', self.max_autoupdate_box)
+        layout.addRow('safe margin:', self.safe_margin_box)
         layout.addRow('relock interval [s]:', self.relock_duration_box)
         layout.addRow('scope duration [s]:', self.scope_duration_box)
+        layout.addRow('lock threshold [V]:', self.lock_threshold_box)
+        layout.addRow('lock window [s]:', self.lock_window_box)
+        layout.addRow('relock probe duration [s]:', self.probe_duration_box)
+        layout.addRow('relock probes:', self.probes_box)
+        layout.addRow('relock retries:', self.retries_box)
+        layout.addRow('relock search step [V]:', self.search_step_box)
+        layout.addRow('unlock warning time [s]:', self.warning_time_box)
+        layout.addRow('relock when at risk:', self.relock_at_risk_box)
+        layout.addRow('lock debounce:', self.debounce_box)
+        layout.addRow('relock backoff [s]:', self.backoff_box)
+        layout.addRow('max relock backoff [s]:', self.max_backoff_box)
+        layout.addRow('park after failed relocks:', self.park_after_box)
+        layout.addRow('relock hold time [s]:', self.hold_time_box)
+        layout.addRow('recentre lock:', self.recentre_box)
+        layout.addRow('recentre threshold [V]:', self.recentre_threshold_box)
+        layout.addRow('recentre step [V]:', self.recentre_step_box)
+        layout.addRow('relock after:', self.relock_after_box)
         self.layout.addLayout(layout)
 
         self.autoupdate_duration_box.setText(str(self.laser.settings['autoupdate interval [s]']))
+        self.adaptive_box.setChecked(self.laser.settings['adaptive autoupdate'])
+        self.max_autoupdate_box.setText(str(self.laser.settings['max autoupdate interval [s]']))
+        self.safe_margin_box.setText(str(self.laser.settings['safe margin']))
         self.relock_duration_box.setText(str(self.laser.settings['relock interval [s]']))
         self.scope_duration_box.setText(str(self.laser.settings['scope duration [s]']))
+        self.lock_threshold_box.setText(str(self.laser.settings['lock threshold [V]']))
+        self.lock_window_box.setText(str(self.laser.settings['lock window [s]']))
+        self.probe_duration_box.setText(str(self.laser.settings['relock probe duration [s]']))
+        self.probes_box.setText(str(self.laser.settings['relock probes']))
+        self.retries_box.setText(str(self.laser.settings['relock retries']))
+        self.search_step_box.setText(str(self.laser.settings['relock search step [V]']))
+        self.warning_time_box.setText(str(self.laser.settings['unlock warning time [s]']))
+        self.relock_at_risk_box.setChecked(self.laser.settings['relock when at risk'])
+        self.debounce_box.setText(str(self.laser.settings['lock debounce']))
+        self.backoff_box.setText(str(self.laser.settings['relock backoff [s]']))
+        self.max_backoff_box.setText(str(self.laser.settings['max relock backoff [s]']))
+        self.park_after_box.setText(str(self.laser.settings['park after failed relocks']))
+        self.hold_time_box.setText(str(self.laser.settings['relock hold time [s]']))
+        self.recentre_box.setChecked(self.laser.settings['recentre lock'])
+        self.recentre_threshold_box.setText(str(self.laser.settings['recentre threshold [V]']))
+        self.recentre_step_box.setText(str(self.laser.settings['recentre step [V]']))
+        self.relock_after_box.setText(', '.join(self.laser.settings['relock after']))
 
     def _createActions(self):
         self.saveAction = QAction(self)
@@ -762,18 +1491,50 @@ class RelockSettingsWindow(QWidget):
         self.saveAction.triggered.connect(self.save_settings)
     
     def save_settings(self):
-        if self.initial_relock_v_button.isChecked():
-            self.laser.settings['relock setting'] = 'manual'
-        else:
-            self.laser.settings['relock setting'] = 'prev'
+        for name, button in self.strategy_buttons.items():
+            if button.isChecked():
+                self.laser.settings['relock setting'] = name
 
         self.laser.settings['autoupdate interval [s]'] = float(self.autoupdate_duration_box.text())
         try:
             self.laser.autoupdate_thread.refresh_time = float(self.autoupdate_duration_box.text())
         except:
             pass
+        self.laser.settings['adaptive autoupdate'] = self.adaptive_box.isChecked()
+        self.laser.settings['max autoupdate interval [s]'] = float(self.max_autoupdate_box.text())
+        self.laser.settings['safe margin'] = float(self.safe_margin_box.text())
+        self.laser.poller.min_interval = self.laser.settings['autoupdate interval [s]']
+        self.laser.poller.max_interval = self.laser.settings['max autoupdate interval [s]']
+        self.laser.poller.safe_margin = self.laser.settings['safe margin']
         self.laser.settings['relock interval [s]'] = float(self.relock_duration_box.text())
         self.laser.settings['scope duration [s]'] = float(self.scope_duration_box.text())
+        self.laser.settings['lock threshold [V]'] = float(self.lock_threshold_box.text())
+        self.laser.settings['lock window [s]'] = float(self.lock_window_box.text())
+        self.laser.settings['relock probe duration [s]'] = float(self.probe_duration_box.text())
+        self.laser.settings['relock probes'] = int(self.probes_box.text())
+        self.laser.settings['relock retries'] = int(self.retries_box.text())
+        self.laser.settings['relock search step [V]'] = float(self.search_step_box.text())
+        self.laser.settings['unlock warning time [s]'] = float(self.warning_time_box.text())
+        self.laser.unlock_predictor.warning_time = self.laser.settings['unlock warning time [s]']
+        self.laser.settings['relock when at risk'] = self.relock_at_risk_box.isChecked()
+        self.laser.settings['lock debounce'] = int(self.debounce_box.text())
+        self.laser.settings['relock backoff [s]'] = float(self.backoff_box.text())
+        self.laser.settings['max relock backoff [s]'] = float(self.max_backoff_box.text())
+        self.laser.settings['park after failed relocks'] = int(self.park_after_box.text())
+        self.laser.settings['relock hold time [s]'] = float(self.hold_time_box.text())
+        self.laser.relock_guard.configure(self.laser.settings)
+        self.laser.settings['recentre lock'] = self.recentre_box.isChecked()
+        self.laser.settings['recentre threshold [V]'] = float(self.recentre_threshold_box.text())
+        self.laser.settings['recentre step [V]'] = float(self.recentre_step_box.text())
+        relock_after = [name.strip() for name in self.relock_after_box.text().split(',') if name.strip()]
+        old_relock_after = self.laser.settings['relock after']
+        self.laser.settings['relock after'] = relock_after
+        try:
+            check_dependencies(self.laser.main_gui.lasers)
+        except ValueError as e:
+            error('Relock dependencies of {} not updated'.format(self.laser.name),e)
+            self.laser.settings['relock after'] = old_relock_after
+            self.relock_after_box.setText(', '.join(old_relock_after))
         self.laser.set_settings()
 
 class PISettingsWindow(QWidget):
@@ -839,3 +1600,60 @@ class PISettingsWindow(QWidget):
         self.laser.settings['integrator'] = float(self.int_box.text())
         self.laser.set_settings()
 
+
+class StateDebugWindow(QWidget):
+    """Current lock state, the number of each transition so far with the 
+    hardware calls it took, and the most recent transitions."""
+    def __init__(self,laser):
+        super().__init__()
+
+        self.laser = laser
+        name = self.laser.settings['name']
+        self.setWindowTitle(name+" state debug")
+
+        self.layout = QVBoxLayout()
+        self.setLayout(self.layout)
+
+        self.state_label = QtWidgets.QLabel()
+        self.layout.addWidget(self.state_label)
+        self.analysis_label = QtWidgets.QLabel()
+        self.layout.addWidget(self.analysis_label)
+        self.stats_table = QtWidgets.QTableWidget(0,5)
+        self.stats_table.setHorizontalHeaderLabels(['from','event','to','count',
+                                                    'hardware calls (mean)'])
+        self.layout.addWidget(self.stats_table)
+        self.log_box = QTextEdit()
+        self.log_box.setReadOnly(True)
+        self.layout.addWidget(self.log_box)
+
+        self.refresh()
+
+    def refresh(self):
+        lock_state = self.laser.lock_state
+        self.state_label.setText("<h3>{} (autorelock {}, {} hardware calls in total)</h3>".format(
+                                 lock_state.state,'on' if lock_state.autorelock else 'off',
+                                 self.laser.rp.hardware_calls))
+        self.stats_table.setRowCount(len(lock_state.stats))
+        for row, ((old, event, new), (count, calls)) in enumerate(sorted(lock_state.stats.items())):
+            for column, value in enumerate([old,event,new,count,'{} ({:.1f})'.format(calls,calls/count)]):
+                self.stats_table.setItem(row,column,QtWidgets.QTableWidgetItem(str(value)))
+        self.log_box.setPlainText('\n'.join(
+            '{}\t{} --{}--> {}\t{} calls'.format(datetime.fromtimestamp(t.time).strftime('%H:%M:%S.%f'),
+                                                 t.old,t.event,t.new,t.hardware_calls)
+            for t in reversed(lock_state.log)))
+        self.analysis_label.setText('\n'.join(self._analysis_lines()))
+
+    def _analysis_lines(self):
+        lines = []
+        for label, stats in [('input',getattr(self.laser,'trace_stats',None)),
+                             ('output',getattr(self.laser,'output_stats',None))]:
+            if stats is not None:
+                lines.append('{}: rms {:.4f} V, strongest component {:.4f} V at {:.1f} Hz'.format(
+                             label,stats['rms'],stats['peak amplitude'],stats['peak frequency [Hz]']))
+        pool = getattr(self.laser.main_gui,'analysis_pool',None)
+        if pool is not None:
+            lines.append('analysis queue depth {} ({} replaced)'.format(pool.depth,pool.replaced))
+            for name, (count,mean,longest,last) in sorted(pool.stats().items()):
+                lines.append('{}: {} tasks, {:.2f} ms mean, {:.2f} ms max, {:.2f} ms last'.format(
+                             name,count,mean*1e3,longest*1e3,last*1e3))
+        return lines
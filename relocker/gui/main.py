@@ -4,7 +4,7 @@ import threading
 os.system("color")
 import inspect
 
-from qtpy.QtCore import Qt
+from qtpy.QtCore import Qt, QTimer
 from qtpy.QtWidgets import (QMainWindow,QHBoxLayout,QVBoxLayout,QWidget,
                             QAction,QListWidget,QFormLayout,QComboBox,QLineEdit,
                             QTextEdit,QPushButton,QFileDialog,QAbstractItemView,
@@ -13,11 +13,70 @@ from qtpy.QtGui import QIcon,QIntValidator,QDoubleValidator,QColor
 
 from .laser_widget import laser
 from .strtypes import error, warning, info
+from ..clock import get_clock
+from ..locking.polling import AcquisitionBudget, ACQUISITIONS_PER_BOARD
+from ..locking.coordinator import RelockCoordinator
+from ..locking.batch import LockBatch
+from ..locking.analysis import AnalysisPool, WORKERS
+from .helpers import result_poster, qt_call_later
+from ..redpitaya.arbiter import ScopeArbiter
+from ..gate import LockGateWriter, PATH as LOCK_GATE_PATH
+from ..monitor import MonitorHub, MonitorServer
+from ..telemetry import TelemetryLogger, DIRECTORY as TELEMETRY_DIRECTORY
+
+LOCK_BATCH_INTERVAL = 0.05 # [s] between batched lock checks of all lasers
 
 # Subclass QMainWindow to customize your application's main window
 class MainWindow(QMainWindow):
-    def __init__(self,dev_mode=False):
+    def __init__(self,dev_mode=False,clock=None,acquisitions_per_board=ACQUISITIONS_PER_BOARD,
+                 lock_batch_interval=LOCK_BATCH_INTERVAL,analysis_workers=WORKERS,
+                 pack_acquisitions=True,shared_memory_export=True,
+                 lock_gate_path=LOCK_GATE_PATH,monitor_port=None,
+                 telemetry_directory=TELEMETRY_DIRECTORY):
         super().__init__()
+        self.clock = get_clock() if clock is None else clock
+        self.result_poster = result_poster()
+        if self.clock.is_virtual:
+            self.clock.post = self.result_poster.call # callbacks run on the GUI thread
+        self.acquisition_budget = AcquisitionBudget(acquisitions_per_board)
+        self.relock_coordinator = RelockCoordinator(lambda: self.lasers)
+        self.scope_arbiter = None
+        if pack_acquisitions: # virtual clock callbacks are posted to the GUI thread already
+            self.scope_arbiter = ScopeArbiter(self.clock,
+                                              call_later=None if self.clock.is_virtual else qt_call_later,
+                                              budget=self.acquisition_budget)
+        self.shared_memory_export = shared_memory_export
+        self.lock_gate = None
+        if lock_gate_path is not None:
+            try:
+                self.lock_gate = LockGateWriter(lock_gate_path)
+            except OSError as e:
+                error('Lock gate not available',e)
+        self.monitor_hub = None
+        self.monitor_server = None
+        if monitor_port is not None:
+            self.monitor_hub = MonitorHub()
+            try:
+                self.monitor_server = MonitorServer(self.monitor_hub,monitor_port).start()
+                info('Monitoring server on http://127.0.0.1:{}/'.format(monitor_port))
+            except OSError as e:
+                error('Monitoring server not started',e)
+                self.monitor_hub = None
+        self.telemetry = None
+        if telemetry_directory is not None:
+            try:
+                self.telemetry = TelemetryLogger(telemetry_directory,clock=self.clock)
+            except OSError as e:
+                error('Telemetry will not be logged',e)
+        self.analysis_pool = None
+        if analysis_workers:
+            self.analysis_pool = AnalysisPool(analysis_workers,post=self.result_poster.post)
+        self.lock_batch = None
+        if lock_batch_interval:
+            self.lock_batch = LockBatch()
+            self.lock_batch_timer = QTimer(self)
+            self.lock_batch_timer.timeout.connect(self.check_locks)
+            self.lock_batch_timer.start(int(lock_batch_interval*1000))
 
         self.setWindowTitle("Lockbox control")
         
@@ -56,6 +115,15 @@ class MainWindow(QMainWindow):
         self.removeLasers = QAction(self)
         self.removeLasers.setText("Remove lasers")
 
+        self.lockAll = QAction(self)
+        self.lockAll.setText("Lock all")
+
+        self.relockAll = QAction(self)
+        self.relockAll.setText("Relock all")
+
+        self.unlockAll = QAction(self)
+        self.unlockAll.setText("Unlock all")
+
     def _createMenuBar(self):
         menuBar = self.menuBar()
 
@@ -70,6 +138,10 @@ class MainWindow(QMainWindow):
         laserMenu = menuBar.addMenu("Lasers")
         laserMenu.addAction(self.addLaser)
         laserMenu.addAction(self.removeLasers)
+        laserMenu.addSeparator()
+        laserMenu.addAction(self.lockAll)
+        laserMenu.addAction(self.relockAll)
+        laserMenu.addAction(self.unlockAll)
 
     def _connectActions(self):
         self.saveState.triggered.connect(self.save_state_dialogue)
@@ -80,6 +152,9 @@ class MainWindow(QMainWindow):
         
         self.addLaser.triggered.connect(self.open_add_laser_window)
         self.removeLasers.triggered.connect(self.open_remove_lasers_window)
+        self.lockAll.triggered.connect(lambda: self.run_all('lock'))
+        self.relockAll.triggered.connect(lambda: self.run_all('relock'))
+        self.unlockAll.triggered.connect(lambda: self.run_all('unlock'))
 
     def open_add_laser_window(self):
         self.add_laser_window = AddLaserWindow(self)
@@ -112,8 +187,44 @@ class MainWindow(QMainWindow):
         indices_to_delete.sort(reverse=True)
         for i in indices_to_delete:
             self.lasers[i].setParent(None)
+            if self.lock_batch is not None:
+                self.lock_batch.discard(self.lasers[i])
+            self.lasers[i].release_exports()
             del self.lasers[i]
 
+    def check_locks(self):
+        """Evaluates the traces waiting in the lock batch, on the analysis 
+        pool if there is one."""
+        if self.analysis_pool is None:
+            self.lock_batch.flush()
+            return
+        entries = self.lock_batch.take()
+        if entries:
+            self.analysis_pool.submit('lock check',self.lock_batch.evaluate,entries,
+                                      callback=self.lock_batch.dispatch)
+
+    def closeEvent(self,event):
+        if self.analysis_pool is not None:
+            self.analysis_pool.close()
+        for laser_widget in self.lasers:
+            laser_widget.release_exports()
+        if self.lock_gate is not None:
+            self.lock_gate.close()
+        if self.monitor_server is not None:
+            self.monitor_server.stop()
+        if self.telemetry is not None:
+            self.telemetry.close()
+        super().closeEvent(event)
+
+    def run_all(self,action):
+        """Locks, relocks or unlocks all lasers through the relock 
+        coordinator, respecting the 'relock after' dependencies of each 
+        laser and relocking one laser at a time on each Red Pitaya."""
+        try:
+            self.relock_coordinator.submit_all(self.lasers,action)
+        except ValueError as e:
+            error('Cannot {} all lasers'.format(action),e)
+
     def add_rp(self,ip):
         self.add_rp_window = None
         if ip not in self.rps:
@@ -0,0 +1,16 @@
+"""locking:
+Lock detection and relock decision logic, independent of the GUI and hardware
+"""
+from .detection import LOCK_THRESHOLD, LOCK_WINDOW, mean_output, is_locked, check_lock, should_relock
+from .history import LockHistory
+from .strategies import RelockStrategy, STRATEGIES, make_strategy
+from .resonances import Resonance, find_resonances, best_lock_point, ResonanceTracker
+from .templates import TemplateLibrary
+from .resonance_map import ResonanceMap
+from .trend import LinearTrend, UnlockPredictor
+from .backoff import RelockGuard
+from .state import LockStateMachine, TransitionError
+from .relock import RelockLogic
+from .coordinator import RelockCoordinator, check_dependencies
+from .batch import LockBatch
+from .analysis import AnalysisPool
@@ -0,0 +1,141 @@
+"""
+*   Trace analysis off the GUI thread. Resonance finding, spectral statistics
+    and the batched lock checks run on a small pool of worker threads (NumPy
+    releases the GIL for the heavy lifting) on read-only views of the trace
+    arrays, and each result is posted back to a callback, e.g. on the Qt
+    main thread, which then only has to render it.
+
+    The pool keeps at most one waiting task per key, so a laser whose
+    analysis falls behind has its older traces replaced by the newest
+    instead of building up a queue.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .resonances import find_resonances
+
+WORKERS = 2
+
+def read_only(array):
+    """Read-only view of an array (or None), so that workers cannot modify
+    the traces shared with the GUI."""
+    if array is None:
+        return None
+    view = np.asarray(array).view()
+    view.flags.writeable = False
+    return view
+
+def spectral_stats(times,y):
+    """rms of y about its mean and the frequency [Hz] and amplitude of its
+    strongest Fourier component."""
+    y = np.asarray(y,dtype=float)
+    if len(y) < 4:
+        return {'rms': float('nan'), 'peak frequency [Hz]': float('nan'), 'peak amplitude': float('nan')}
+    y = y - np.nanmean(y)
+    y = np.nan_to_num(y)
+    spectrum = np.abs(np.fft.rfft(y))*2/len(y)
+    dt = (times[-1] - times[0])/(len(times) - 1) if (times is not None and len(times) > 1) else 1
+    peak = int(np.argmax(spectrum[1:])) + 1
+    return {'rms': float(np.sqrt(np.mean(y**2))),
+            'peak frequency [Hz]': float(np.fft.rfftfreq(len(y),dt)[peak]),
+            'peak amplitude': float(spectrum[peak])}
+
+def analyse_sweep(times,output,input_trace,setpoint):
+    """Resonances in a sweep trace and spectral statistics of the input."""
+    return {'resonances': find_resonances(output,input_trace,setpoint),
+            'spectrum': spectral_stats(times,input_trace)}
+
+def analyse_lock(times,output,input_trace):
+    """Spectral statistics of the PID output and input (if acquired) while
+    locked."""
+    return {'output spectrum': spectral_stats(times,output),
+            'spectrum': None if input_trace is None else spectral_stats(times,input_trace)}
+
+class AnalysisPool():
+    """Worker threads running analysis tasks.
+
+    submit(name,function,*args,key=...,callback=...) runs function(*args) on
+    a worker, with any array arguments passed as read-only views, and then
+    post(callback,result). post defaults to calling the callback straight
+    from the worker; the GUI passes one that hands the result to the main
+    thread. Task times are kept per name for stats().
+    """
+    def __init__(self,workers=WORKERS,post=None):
+        self.post = post
+        self.waiting = OrderedDict() # key: (name, function, args, callback)
+        self.running = 0
+        self.replaced = 0
+        self.times = {} # name: [count, total time, max time, last time]
+        self.condition = threading.Condition()
+        self.closed = False
+        self.order = 0
+        self.threads = [threading.Thread(target=self._work,daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    @property
+    def depth(self):
+        """Number of tasks waiting or running."""
+        with self.condition:
+            return len(self.waiting) + self.running
+
+    def submit(self,name,function,*args,key=None,callback=None):
+        """Queues a task. A waiting task with the same key is replaced; tasks
+        without a key are never replaced."""
+        args = tuple(read_only(arg) if isinstance(arg,np.ndarray) else arg for arg in args)
+        with self.condition:
+            if key is None:
+                key = ('_unique',self.order)
+                self.order += 1
+            elif key in self.waiting:
+                del self.waiting[key]
+                self.replaced += 1
+            self.waiting[key] = (name,function,args,callback)
+            self.condition.notify()
+
+    def stats(self):
+        """{name: (count, mean time [s], max time [s], last time [s])}."""
+        with self.condition:
+            return {name: (count,total/count,longest,last)
+                    for name, (count,total,longest,last) in self.times.items()}
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.waiting.clear()
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                while (not self.waiting) and (not self.closed):
+                    self.condition.wait()
+                if self.closed:
+                    return
+                _, (name,function,args,callback) = self.waiting.popitem(last=False)
+                self.running += 1
+            start = time.perf_counter()
+            try:
+                result = function(*args)
+                failed = False
+            except Exception as e:
+                print('analysis task "{}" failed: {}'.format(name,e))
+                failed = True
+            elapsed = time.perf_counter() - start
+            with self.condition:
+                self.running -= 1
+                entry = self.times.setdefault(name,[0,0,0,0])
+                entry[0] += 1
+                entry[1] += elapsed
+                entry[2] = max(entry[2],elapsed)
+                entry[3] = elapsed
+            if failed or (callback is None):
+                continue
+            if self.post is None:
+                callback(result)
+            else:
+                self.post(callback,result)
@@ -0,0 +1,101 @@
+"""
+*   Relock thrash suppression. Lock state changes are debounced over several
+    consecutive observations, failed relocks back off exponentially up to a
+    cap, and after too many consecutive failures the laser is parked until
+    the operator intervenes. A relock that loses lock again within the hold
+    time counts as failed, so a lock that keeps dropping straight after each
+    relock backs off as well.
+"""
+
+DEBOUNCE = 2 # consecutive observations to change the lock state
+BACKOFF = 1 # [s] hold-off after the first failed relock, doubled after each failure
+MAX_BACKOFF = 300 # [s]
+PARK_AFTER = 10 # consecutive failed relocks
+HOLD_TIME = 60 # [s] a relock has to hold for to count as successful
+
+class RelockGuard():
+    """Debounced lock state and relock backoff for one laser."""
+    def __init__(self,debounce=DEBOUNCE,backoff=BACKOFF,max_backoff=MAX_BACKOFF,
+                 park_after=PARK_AFTER,hold_time=HOLD_TIME):
+        self.debounce = debounce
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.park_after = park_after
+        self.hold_time = hold_time
+        self.reset()
+
+    @classmethod
+    def from_settings(cls,settings):
+        guard = cls()
+        guard.configure(settings)
+        return guard
+
+    def configure(self,settings):
+        """Takes the parameters from a laser settings dictionary, keeping the
+        current state."""
+        self.debounce = settings.get('lock debounce',DEBOUNCE)
+        self.backoff = settings.get('relock backoff [s]',BACKOFF)
+        self.max_backoff = settings.get('max relock backoff [s]',MAX_BACKOFF)
+        self.park_after = settings.get('park after failed relocks',PARK_AFTER)
+        self.hold_time = settings.get('relock hold time [s]',HOLD_TIME)
+
+    def reset(self,locked=True):
+        """Clears the failures and parking, e.g. after the operator has
+        enabled the PID by hand."""
+        self.locked = locked
+        self.count = 0
+        self.failures = 0
+        self.parked = False
+        self.next_relock = None
+        self.relocked_at = None
+
+    def observe(self,time,locked):
+        """Adds a lock check and returns the debounced lock state."""
+        if locked == self.locked:
+            self.count = 0
+            return self.locked
+        self.count += 1
+        if self.count >= self.debounce:
+            self.locked = locked
+            self.count = 0
+            if (not locked) and (self.relocked_at is not None):
+                if time - self.relocked_at < self.hold_time:
+                    self.relock_failed(time)
+                else:
+                    self.failures = 0
+                self.relocked_at = None
+        return self.locked
+
+    def may_relock(self,time):
+        """Whether an automatic relock is allowed at time."""
+        if self.parked:
+            return False
+        return (self.next_relock is None) or (time >= self.next_relock)
+
+    def relock_failed(self,time):
+        self.locked = False
+        self.count = 0
+        self.back_off(time)
+
+    def back_off(self,time):
+        """Counts a failed relock for the backoff and parking without
+        changing the debounced lock state, e.g. for a relock that was
+        skipped because a laser it relocks after failed."""
+        self.failures += 1
+        if self.failures >= self.park_after:
+            self.parked = True
+            self.next_relock = None
+        else:
+            self.next_relock = time + min(self.max_backoff,self.backoff*2**(self.failures-1))
+
+    def relock_succeeded(self,time):
+        self.locked = True
+        self.count = 0
+        self.next_relock = None
+        self.relocked_at = time
+
+    def wait(self,time):
+        """Remaining backoff [s] at time."""
+        if self.next_relock is None:
+            return 0
+        return max(0,self.next_relock - time)
@@ -0,0 +1,160 @@
+"""
+*   Batched lock checks. Instead of every laser judging its own trace with
+    check_lock as it arrives, traces are gathered into a LockBatch and the
+    lock state of all lasers is evaluated in one NumPy pass per tick, with
+    the results handed back to each laser. The rules are the same as
+    check_lock, so both paths agree.
+
+    The two paths can be compared with
+        python -m relocker.locking.batch --lasers 10 50 100
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from .detection import LOCK_THRESHOLD, LOCK_WINDOW, check_lock
+
+def pack(traces,dtype=float):
+    """Packs traces into one 2-D array, padding shorter traces with zeros.
+    Returns (array, lengths)."""
+    lengths = np.array([len(trace) for trace in traces],dtype=int)
+    if len(traces) and np.all(lengths == lengths[0]):
+        return np.array(traces,dtype=dtype).reshape(len(traces),-1), lengths
+    packed = np.zeros((len(traces),lengths.max() if len(traces) else 0),dtype=dtype)
+    for row, trace in zip(packed,traces):
+        row[:len(trace)] = trace
+    return packed, lengths
+
+def _masked_means(outputs,lengths,times,windows):
+    """Means ignoring NaN samples, padding and samples before the window."""
+    valid = ~np.isnan(outputs) & (np.arange(outputs.shape[1]) < lengths[:,None])
+    if times is not None:
+        last = times[np.arange(len(outputs)),np.maximum(lengths,1)-1]
+        with np.errstate(invalid='ignore'):
+            valid &= (times >= (last - windows)[:,None]) | (windows <= 0)[:,None]
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.where(valid,outputs,0).sum(axis=1)/valid.sum(axis=1)
+
+def evaluate(outputs,max_voltages,min_voltages,thresholds=LOCK_THRESHOLD,
+             times=None,windows=LOCK_WINDOW,lengths=None):
+    """Lock check of many traces at once. outputs (and times, if given) are
+    2-D arrays with one trace per row, padded beyond lengths, and the other
+    arguments are scalars or one value per row. Returns arrays (locked,
+    mean_voltages, margins) where the margin is as lock_margin.
+
+    Rows are summed in one pass; only rows containing NaN or using a lock
+    window take the slower masked mean."""
+    outputs = np.asarray(outputs,dtype=float)
+    n, samples = outputs.shape
+    lengths = np.full(n,samples) if lengths is None else np.asarray(lengths)
+    max_voltages = np.broadcast_to(np.asarray(max_voltages,dtype=float),(n,))
+    min_voltages = np.broadcast_to(np.asarray(min_voltages,dtype=float),(n,))
+    thresholds = np.broadcast_to(np.asarray(thresholds,dtype=float),(n,))
+    windows = np.broadcast_to(np.asarray(windows,dtype=float),(n,))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        means = outputs.sum(axis=1)/lengths
+    slow = ~np.isfinite(means)
+    if times is not None:
+        slow |= windows > 0
+    if np.any(slow):
+        means[slow] = _masked_means(outputs[slow],lengths[slow],
+                                    None if times is None else np.asarray(times,dtype=float)[slow],
+                                    windows[slow])
+    locked = ~((np.abs(means - max_voltages) < thresholds) |
+               (np.abs(means - min_voltages) < thresholds))
+    locked &= np.isfinite(means) # e.g. a trace of NaN from a dead channel
+    margins = np.minimum(max_voltages - means, means - min_voltages)/((max_voltages - min_voltages)/2)
+    return locked, means, margins
+
+class LockBatch():
+    """Traces waiting for a lock check. Lasers add their trace with add()
+    and flush() evaluates them all and calls
+    laser.lock_checked(locked,mean_voltage) on each. A laser adding a second
+    trace before the flush replaces its first.
+    """
+    def __init__(self):
+        self.pending = {} # id(laser): (laser, output, settings, times)
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self,laser,output,settings,times=None):
+        self.pending[id(laser)] = (laser,output,settings,times)
+
+    def discard(self,laser):
+        self.pending.pop(id(laser),None)
+
+    def take(self):
+        """Removes and returns the pending traces."""
+        entries, self.pending = list(self.pending.values()), {}
+        return entries
+
+    def evaluate(self,entries=None):
+        """Evaluates the given entries (by default the pending traces, which
+        are cleared), returning a list of (laser, locked, mean_voltage,
+        margin)."""
+        if entries is None:
+            entries = self.take()
+        if not entries:
+            return []
+        outputs, lengths = pack([entry[1] for entry in entries])
+        settings = [entry[2] for entry in entries]
+        windows = [s.get('lock window [s]',LOCK_WINDOW) for s in settings]
+        times = None
+        if any(windows) and all(entry[3] is not None for entry in entries):
+            times, _ = pack([entry[3] for entry in entries])
+        locked, means, margins = evaluate(outputs,
+                            [s['max voltage [V]'] for s in settings],
+                            [s['min voltage [V]'] for s in settings],
+                            [s.get('lock threshold [V]',LOCK_THRESHOLD) for s in settings],
+                            times,windows if times is not None else 0,lengths)
+        return [(entry[0],bool(l),float(m),float(g))
+                for entry, l, m, g in zip(entries,locked,means,margins)]
+
+    @staticmethod
+    def dispatch(results):
+        for laser, locked, mean_voltage, _ in results:
+            laser.lock_checked(locked,mean_voltage)
+
+    def flush(self):
+        """Evaluates the pending traces and dispatches the results."""
+        results = self.evaluate()
+        self.dispatch(results)
+        return len(results)
+
+def benchmark(n_lasers,samples=1024,repeats=20,seed=0):
+    """Times the lock check of n_lasers traces with check_lock per laser and
+    with one batch. Returns (per laser [s], batched [s]) per tick."""
+    rng = np.random.default_rng(seed)
+    settings = {'max voltage [V]': 1, 'min voltage [V]': -1}
+    levels = rng.choice([0,1],n_lasers)
+    traces = [level + 0.001*rng.standard_normal(samples) for level in levels]
+    start = time.perf_counter()
+    for _ in range(repeats):
+        single = [check_lock(trace,settings) for trace in traces]
+    per_laser = (time.perf_counter() - start)/repeats
+    batch = LockBatch()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for i, trace in enumerate(traces):
+            batch.add(i,trace,settings)
+        batched = batch.evaluate()
+    batched_time = (time.perf_counter() - start)/repeats
+    assert [s[0] for s in single] == [b[1] for b in batched]
+    return per_laser, batched_time
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m relocker.locking.batch')
+    parser.add_argument('--lasers',type=int,nargs='+',default=[10,50,100])
+    parser.add_argument('--samples',type=int,default=1024)
+    parser.add_argument('--repeats',type=int,default=20)
+    args = parser.parse_args(argv)
+    print('lasers\tper laser [ms]\tbatched [ms]\tspeed up')
+    for n in args.lasers:
+        per_laser, batched = benchmark(n,args.samples,args.repeats)
+        print('{}\t{:.3f}\t\t{:.3f}\t\t{:.1f}'.format(n,per_laser*1e3,batched*1e3,per_laser/batched))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""
+*   Coordination of lock, relock and unlock actions across lasers. Each laser
+    lists the lasers it has to be locked after (e.g. a cooler after its
+    repump). Actions on lasers on different boards run in parallel, but only
+    one runs at a time on each board, so that relocks do not compete for the
+    board's scope. Lasers wait for their dependencies to lock or relock
+    first, and are unlocked before them.
+
+    A laser only needs the attributes name, board, dependencies, is_locked
+    and a method run_action(action,done) that calls done(success) once the
+    action has finished. A 'pre-emptive relock' relocks the laser even if it
+    is still locked, e.g. when its lock is at risk. Optionally, a laser has
+    may_autorelock() telling whether it may be relocked automatically now
+    (not parked or backing off), and relock_skipped(action) which is called
+    when its job is skipped because a dependency failed.
+"""
+
+from functools import partial
+
+ACTIONS = ['lock','relock','pre-emptive relock','unlock']
+LOCK_ACTIONS = ['lock','relock','pre-emptive relock']
+
+def check_dependencies(lasers):
+    """Raises ValueError if the dependencies of lasers form a cycle, otherwise
+    returns the laser names in an order that respects them."""
+    graph = {laser.name: [d for d in laser.dependencies if d != laser.name] for laser in lasers}
+    order, visiting, done = [], set(), set()
+    def visit(name,path):
+        if name in done or name not in graph:
+            return
+        if name in visiting:
+            raise ValueError('circular laser dependencies: {}'.format(' -> '.join(path+[name])))
+        visiting.add(name)
+        for dependency in graph[name]:
+            visit(dependency,path+[name])
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+    for name in graph:
+        visit(name,[])
+    return order
+
+class RelockCoordinator():
+    """Queue of actions on lasers. Jobs start in the order they were
+    submitted as soon as their board is free and no other queued or running
+    job is still to finish on a laser they wait on, whatever order the jobs
+    were submitted in. If queued jobs of different actions wait on each
+    other (e.g. an unlock of a repump and a relock of its cooler) and
+    nothing is running, the earliest of them goes first, so the queue
+    cannot deadlock. A job whose dependency failed to lock is skipped
+    (reported as failed) unless the dependency is locked again.
+
+    known_lasers is an optional function returning all the lasers, so that
+    a relock (e.g. an autorelock of a cooler) first queues relocks of any
+    unlocked dependencies that may be relocked automatically.
+    """
+    def __init__(self,known_lasers=None):
+        self.known_lasers = known_lasers
+        self.queue = [] # [laser, action] waiting to start
+        self.running = {} # board: [laser, action]
+        self.lasers = {}
+        self.failed = set() # names whose last lock or relock failed
+        self.history = [] # (laser name, action, success)
+
+    def submit(self,laser,action):
+        """Queues an action on laser. Returns False if the laser already has
+        a queued or running job."""
+        if action not in ACTIONS:
+            raise ValueError('unknown action "{}"'.format(action))
+        self.lasers[laser.name] = laser
+        if self._has_job(laser.name):
+            return False
+        if action in LOCK_ACTIONS:
+            if action == 'pre-emptive relock':
+                action_dependencies = 'relock' # they are not locked
+            else:
+                action_dependencies = action
+            self._submit_dependencies(laser,action_dependencies,set([laser.name]))
+        self.queue.append([laser,action])
+        self._dispatch()
+        return True
+
+    def submit_all(self,lasers,action):
+        """Queues an action on all lasers, checking the dependencies first.
+        Lasers are queued in dependency order (reversed to unlock)."""
+        order = check_dependencies(lasers)
+        if action == 'unlock':
+            order.reverse()
+        by_name = {laser.name: laser for laser in lasers}
+        for name in order:
+            self.submit(by_name[name],action)
+
+    def _submit_dependencies(self,laser,action,seen):
+        """Queues the action on the unlocked dependencies of laser (and theirs)
+        that may be relocked automatically, so that they go first. Parked
+        dependencies and ones backing off are left alone."""
+        if self.known_lasers is None:
+            return
+        known = {other.name: other for other in self.known_lasers()}
+        for name in self._waits_on(laser,action):
+            dependency = known.get(name)
+            if (dependency is None) or (name in seen) or dependency.is_locked:
+                continue
+            seen.add(name)
+            if self._may_autorelock(dependency) and not self._has_job(name):
+                self._submit_dependencies(dependency,action,seen)
+                self.lasers[name] = dependency
+                self.queue.append([dependency,action])
+
+    def _may_autorelock(self,laser):
+        may_autorelock = getattr(laser,'may_autorelock',None)
+        if may_autorelock is None:
+            return getattr(laser,'autorelock',True)
+        return may_autorelock()
+
+    def _has_job(self,name):
+        return (any(job[0].name == name for job in self.queue) or
+                any(job[0].name == name for job in self.running.values()))
+
+    def _waits_on(self,laser,action):
+        """Names of the lasers that have to finish before this job."""
+        if action == 'unlock':
+            return [other.name for other in self.lasers.values() if laser.name in other.dependencies]
+        return [name for name in laser.dependencies if name != laser.name]
+
+    def _blocked(self,job,position,earlier_only=False):
+        """Whether a job waits on another queued or running job (or, with
+        earlier_only, on one queued before it)."""
+        laser, action = job
+        waits_on = self._waits_on(laser,action)
+        queued = self.queue[:position] if earlier_only else self.queue[:position] + self.queue[position+1:]
+        others = [other for other, _ in queued] + [other for other, _ in self.running.values()]
+        return any(other.name in waits_on for other in others)
+
+    def _skip(self,job):
+        laser, action = job
+        if action == 'unlock':
+            return False
+        for name in self._waits_on(laser,action):
+            dependency = self.lasers.get(name)
+            if (name in self.failed) and not (dependency is not None and dependency.is_locked):
+                return True
+        return False
+
+    def _dispatch(self):
+        started = True
+        while started:
+            started = self._dispatch_one(False)
+            if not (started or self.running):
+                started = self._dispatch_one(True) # queued jobs wait on each other
+
+    def _dispatch_one(self,earlier_only):
+        """Starts (or skips) the first job that is not blocked and returns
+        whether there was one."""
+        for position, job in enumerate(self.queue):
+            laser = job[0]
+            if laser.board in self.running or self._blocked(job,position,earlier_only):
+                continue
+            del self.queue[position]
+            if self._skip(job):
+                print('{} {} skipped, a dependency failed'.format(job[1],laser.name))
+                self._record(job,False)
+                relock_skipped = getattr(laser,'relock_skipped',None)
+                if relock_skipped is not None:
+                    relock_skipped(job[1])
+            else:
+                self._start(job)
+            return True
+        return False
+
+    def _start(self,job):
+        laser, action = job
+        self.running[laser.board] = job
+        laser.run_action(action,partial(self._done,job))
+
+    def _done(self,job,success):
+        laser, action = job
+        if self.running.get(laser.board) is job:
+            del self.running[laser.board]
+        self._record(job,success)
+        self._dispatch()
+
+    def _record(self,job,success):
+        laser, action = job
+        self.history.append((laser.name,action,success))
+        if action in LOCK_ACTIONS:
+            if success:
+                self.failed.discard(laser.name)
+            else:
+                self.failed.add(laser.name)
@@ -0,0 +1,42 @@
+"""
+*   Lock detection and autorelock decisions. These functions are used both by
+    the laser widget and by the offline replay so that recorded traces are
+    judged by exactly the same rules as live ones.
+"""
+
+import numpy as np
+
+LOCK_THRESHOLD = 0.05 # distance of the output mean from a rail [V]
+LOCK_WINDOW = 0 # length of the end of the trace to average over [s], 0 for all
+
+def mean_output(output,times=None,window=LOCK_WINDOW):
+    """Mean of the PID output trace ignoring any NaN samples. If a window is
+    given only the last window seconds of the trace are used."""
+    output = np.asarray(output,dtype=float)
+    if window and (times is not None):
+        times = np.asarray(times,dtype=float)
+        output = output[times >= times[-1] - window]
+    return float(np.nanmean(output))
+
+def is_locked(mean_voltage,max_voltage,min_voltage,threshold=LOCK_THRESHOLD):
+    """The laser is considered unlocked if the mean output voltage is within
+    threshold of either the maximum or minimum voltage, or is not finite
+    (e.g. a trace of NaN from a dead channel)."""
+    if not np.isfinite(mean_voltage):
+        return False
+    return not ((abs(mean_voltage - max_voltage) < threshold) or 
+                (abs(mean_voltage - min_voltage) < threshold))
+
+def check_lock(output,settings,times=None):
+    """Returns (is_locked, mean_voltage) for an output trace using the voltage 
+    limits and detector parameters in a laser settings dictionary."""
+    threshold = settings.get('lock threshold [V]',LOCK_THRESHOLD)
+    window = settings.get('lock window [s]',LOCK_WINDOW)
+    mean_voltage = mean_output(output,times,window)
+    locked = is_locked(mean_voltage,settings['max voltage [V]'],
+                       settings['min voltage [V]'],threshold)
+    return locked, mean_voltage
+
+def should_relock(pid_enabled,autorelock,is_locked,is_relocking):
+    """Decides whether a relock should be triggered after a lock check."""
+    return pid_enabled and autorelock and (not is_locked) and (not is_relocking)
@@ -0,0 +1,69 @@
+"""
+*   Rolling history of healthy lock samples used to warm-start relocks from
+    the ASG offset and integrator value of the last known-good lock.
+"""
+
+from collections import deque
+
+HEALTHY_FRACTION = 0.5 # min. integrator headroom of a healthy sample
+
+def integrator_headroom(integrator,offset,max_voltage,min_voltage):
+    """How far the integrator can still move before it reaches a PID limit,
+    as a fraction of the distance from the offset to that limit (the PID
+    limits are the output rails less the ASG offset). 1 with the integrator
+    at zero, wherever the offset is, and 0 at a limit."""
+    upper = max_voltage - offset
+    lower = offset - min_voltage
+    if integrator >= 0:
+        return max(0,(upper - integrator)/upper) if upper > 0 else 0
+    return max(0,(lower + integrator)/lower) if lower > 0 else 0
+
+class LockHistory():
+    """Keeps the last maxlen healthy (offset, integrator) samples of a lock. A
+    sample is healthy if the integrator has at least HEALTHY_FRACTION of its
+    headroom left, i.e. the offset is close to the lock point and the PID is
+    far from its limits, wherever the lock point is in the output range.
+
+    Also counts the outcome of warm and cold relock starts.
+    """
+    def __init__(self,maxlen=20,healthy_fraction=HEALTHY_FRACTION):
+        self.samples = deque(maxlen=maxlen)
+        self.healthy_fraction = healthy_fraction
+        self.starts = {'warm': [0,0], 'cold': [0,0]} # [successes, attempts]
+
+    def is_healthy(self,offset,integrator,max_voltage,min_voltage):
+        return integrator_headroom(integrator,offset,max_voltage,min_voltage) >= self.healthy_fraction
+
+    def add(self,time,offset,integrator,max_voltage,min_voltage):
+        """Adds a sample taken while locked if it is healthy. Returns whether
+        the sample was kept."""
+        if (offset is None) or (integrator is None):
+            return False
+        if not self.is_healthy(offset,integrator,max_voltage,min_voltage):
+            return False
+        self.samples.append((time,offset,integrator))
+        return True
+
+    def clear(self):
+        self.samples.clear()
+
+    def warm_state(self):
+        """Returns the (offset, integrator) of the healthy sample with the
+        median offset (the lower of the two middle ones for an even count),
+        so that the pair was actually observed together, or None if there
+        are no healthy samples."""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples,key=lambda sample: sample[1])
+        _, offset, integrator = ordered[(len(ordered)-1)//2]
+        return (offset,integrator)
+
+    def record_start(self,kind,success):
+        """Records the outcome of a 'warm' or 'cold' relock attempt."""
+        self.starts[kind][1] += 1
+        if success:
+            self.starts[kind][0] += 1
+
+    def success_rate(self,kind):
+        successes, attempts = self.starts[kind]
+        return successes/attempts if attempts else None
@@ -0,0 +1,76 @@
+"""
+*   Adaptive autoupdate scheduling. Each laser polls at its minimum interval
+    while the integrator headroom (see history.integrator_headroom) is small, during and after relocks and for a while
+    after any instability, and otherwise backs off gradually towards its
+    maximum interval. The scope of each board is shared between its lasers,
+    so acquisitions are also spaced to a global budget per board.
+"""
+
+import math
+
+MAX_INTERVAL = 10 # [s]
+ACQUISITIONS_PER_BOARD = 10 # [1/s]
+SAFE_MARGIN = 0.5 # integrator headroom above which polling backs off
+SETTLE_TIME = 60 # [s] time after instability to keep polling fast
+GROWTH = 1.5 # factor the interval grows by per stable update
+
+def lock_margin(mean_voltage,max_voltage,min_voltage):
+    """Distance of the output mean from the nearest rail as a fraction of
+    half the output range (1 in the middle, 0 at a rail)."""
+    return min(max_voltage - mean_voltage, mean_voltage - min_voltage)/((max_voltage - min_voltage)/2)
+
+class AdaptivePoller():
+    """Chooses the interval until the next autoupdate of one laser."""
+    def __init__(self,min_interval,max_interval=MAX_INTERVAL,safe_margin=SAFE_MARGIN,
+                 settle_time=SETTLE_TIME,growth=GROWTH):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.safe_margin = safe_margin
+        self.settle_time = settle_time
+        self.growth = growth
+        self.interval = min_interval
+        self.unstable_time = None
+
+    def mark_unstable(self,time):
+        """Polls fast for settle_time from time, e.g. after a relock."""
+        self.unstable_time = time
+        self.interval = self.min_interval
+
+    def update(self,time,locked,margin=None,at_risk=False):
+        """Returns the next interval [s] after an update with the (debounced)
+        lock state and the integrator headroom (margin), if known."""
+        if (not locked) or at_risk:
+            self.mark_unstable(time)
+        elif (margin is None) or (margin < self.safe_margin):
+            self.interval = self.min_interval
+        elif (self.unstable_time is not None) and (time - self.unstable_time < self.settle_time):
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval,max(self.min_interval,self.interval*self.growth))
+        return self.interval
+
+class AcquisitionBudget():
+    """Spaces scope acquisitions on each board to at most rate per second.
+    Time is divided into slots of 1/rate and each acquisition reserves the
+    first free slot at or after the time it asks for, so lasers polling
+    slowly do not hold up lasers polling quickly. An acquisition can take a
+    fraction of a slot (cost), e.g. a half for a lock monitoring channel 
+    packed with another laser's into one acquisition.
+    """
+    def __init__(self,rate=ACQUISITIONS_PER_BOARD):
+        self.rate = rate
+        self.slots = {} # board: {slot number: fraction reserved}
+
+    def reserve(self,board,time,now=None,cost=1):
+        """Reserves an acquisition on board at or after time and returns the
+        reserved time. Slots before now are forgotten."""
+        slots = self.slots.setdefault(board,{})
+        if (now is not None) and len(slots) > 4*self.rate:
+            oldest = math.floor(now*self.rate)
+            for slot in [slot for slot in slots if slot < oldest]:
+                del slots[slot]
+        slot = math.ceil(time*self.rate)
+        while slots.get(slot,0) + cost > 1:
+            slot += 1
+        slots[slot] = slots.get(slot,0) + cost
+        return slot/self.rate
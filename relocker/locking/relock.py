@@ -0,0 +1,140 @@
+"""
+*   Lock checking and relock sequencing of one laser, without Qt or hardware.
+    The laser widget, the offline replay and the simulation all drive a
+    RelockLogic, so that they take the same decisions: debounced lock
+    checks, relock backoff and parking, warm and cold start candidates from
+    the relock strategy, verification probes and retries.
+
+    The logic only decides. It returns the lock state machine events to fire
+    and the caller fires them, doing any hardware operations on the way.
+    A relock goes
+        start(...)              'relock' fired by the caller
+        next_candidate()        candidate state to re-engage the PID at
+        start_attempt(...)      after 'engage' has been fired
+        probe(locked)           until it returns True or False
+        end_attempt(...)        then retry() for the next candidate ('retry')
+        end(...)                events to fire to finish the relock
+"""
+
+from .detection import should_relock
+from .backoff import RelockGuard
+
+RETRIES = 3 # further candidates tried after a failed attempt
+PROBES = 3 # consecutive locked probes for a relock to succeed
+
+class RelockLogic():
+    """Lock decisions of one laser, kept alongside its LockStateMachine."""
+    def __init__(self,settings,lock_state,guard=None):
+        self.settings = settings
+        self.lock_state = lock_state
+        self.guard = RelockGuard.from_settings(settings) if guard is None else guard
+        self.strategy = None
+        self.warm_state = None
+        self.retries = 0
+        self.start_time = None
+        self.candidate = None
+        self.attempt = None
+
+    def check(self,time,locked):
+        """Debounces the lock check of a trace taken with the PID on and
+        returns the event to fire ('lock lost' or 'lock found') or None."""
+        state = self.lock_state.state
+        debounced = self.guard.observe(time,locked)
+        if (state == 'locked') and not debounced:
+            return 'lock lost'
+        if (state in ['unlocked','parked']) and debounced:
+            return 'lock found'
+        return None
+
+    def wants_relock(self,time):
+        """Whether an autorelock should be started now."""
+        lock_state = self.lock_state
+        return (should_relock(lock_state.pid_enabled,lock_state.autorelock,lock_state.is_locked,
+                              lock_state.is_relocking)
+                and self.guard.may_relock(time))
+
+    def start(self,time,strategy,warm_state=None):
+        """Starts a relock with a relock strategy and optionally a warm start
+        (offset, integrator) to try first."""
+        self.start_time = time
+        self.strategy = strategy
+        self.warm_state = warm_state
+        self.retries = self.settings.get('relock retries',RETRIES)
+        self.candidate = None
+        self.attempt = None
+
+    def next_candidate(self):
+        """Next state to relock to, or None if there is nothing left to try.
+        The warm start (if any) is tried first, after which the relock
+        strategy proposes cold-start offsets."""
+        if self.warm_state is not None:
+            offset, integrator = self.warm_state
+            self.warm_state = None
+            self.candidate = {'offset': offset, 'integrator': integrator, 'start': 'warm'}
+        else:
+            offset = self.strategy.next_offset()
+            if offset is None:
+                self.candidate = None
+            else:
+                self.candidate = {'offset': offset, 'integrator': self.settings.get('integrator',0),
+                                  'start': 'cold'}
+        return self.candidate
+
+    def start_attempt(self,time,offset):
+        """Starts verifying the PID engaged at offset."""
+        self.attempt = {'time': time,
+                        'offset': offset,
+                        'start': self.candidate['start'],
+                        'strategy': self.strategy.name,
+                        'probes': 0,
+                        'locked probes': 0}
+        return self.attempt
+
+    def probe(self,locked):
+        """Adds the lock check of a verification probe. Returns None while
+        more probes are needed, otherwise whether the attempt succeeded: it
+        succeeds after 'relock probes' consecutive locked probes and fails on
+        the first unlocked one."""
+        attempt = self.attempt
+        attempt['probes'] += 1
+        if not locked:
+            return False
+        attempt['locked probes'] += 1
+        if attempt['locked probes'] >= self.settings.get('relock probes',PROBES):
+            return True
+        return None
+
+    def end_attempt(self,time,success,mean_voltage):
+        """Finishes the current attempt, gives the strategy its outcome and
+        returns the attempt (None if no attempt was started)."""
+        attempt = self.attempt
+        if attempt is None:
+            return None
+        attempt['success'] = success
+        attempt['latency [s]'] = time - attempt['time']
+        attempt['time to lock [s]'] = time - self.start_time if success else None
+        self.attempt = None
+        if attempt['start'] == 'cold':
+            self.strategy.feedback(attempt['offset'],success,mean_voltage)
+        return attempt
+
+    def retry(self):
+        """Next candidate after a failed attempt, or None once 'relock
+        retries' is exhausted or there is nothing left to try."""
+        if self.retries <= 0:
+            return None
+        candidate = self.next_candidate()
+        if candidate is not None:
+            self.retries -= 1
+        return candidate
+
+    def end(self,time,success):
+        """Updates the backoff and returns the events that finish the relock,
+        with 'park' after too many failed relocks."""
+        if success:
+            self.guard.relock_succeeded(time)
+            return ['relock succeeded']
+        self.guard.relock_failed(time)
+        if self.guard.parked:
+            return ['relock failed','park']
+        return ['relock failed']
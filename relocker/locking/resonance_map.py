@@ -0,0 +1,129 @@
+"""
+*   Persistent map of the resonances of one laser. Resonance positions seen
+    in sweeps (and the output voltage of good locks) are matched to known
+    resonances and each resonance keeps an exponentially weighted linear fit
+    of position against time (a LinearTrend), so the expected position can
+    be predicted after hours or days without a fresh sweep. Resonances not
+    seen for a time constant are forgotten and the map keeps at most
+    MAX_RESONANCES, dropping the least observed. The map is saved as
+    <name>.resonances.json next to the <name>.json settings.
+"""
+
+import json
+import math
+
+from .trend import LinearTrend
+
+DRIFT_TIME_CONSTANT = 7*24*3600 # [s] decay time of old observations
+MIN_DRIFT_SPAN = 600 # [s] min. spread of observation times to fit a drift rate
+MAX_RESONANCES = 100
+
+class MappedResonance():
+    """A resonance in the map, with a LinearTrend of its position."""
+    def __init__(self,kind,trend,count=0):
+        self.kind = kind
+        self.trend = trend
+        self.count = count
+
+    def __repr__(self):
+        return 'MappedResonance({}, {:.4f} V, {:.2e} V/s)'.format(self.kind,
+                    self.predict(self.trend.last_time),self.trend.rate())
+
+    def observe(self,time,position):
+        self.trend.add(time,position)
+        self.count += 1
+
+    def predict(self,time):
+        """Expected position [V] at time."""
+        return self.trend.predict(time)
+
+    def to_dict(self):
+        return {'kind': self.kind, 'count': self.count, **self.trend.to_dict()}
+
+    @classmethod
+    def from_dict(cls,d,time_constant=DRIFT_TIME_CONSTANT):
+        return cls(d['kind'],LinearTrend(time_constant,MIN_DRIFT_SPAN,d['t0'],d['sums'],
+                                         d['last time']),d['count'])
+
+class ResonanceMap():
+    """Resonances of one laser. Observations within match_range of the
+    expected position of a known resonance of the same kind update it,
+    others add a new resonance.
+    """
+    def __init__(self,path=None,match_range=0.05,time_constant=DRIFT_TIME_CONSTANT,
+                 max_resonances=MAX_RESONANCES):
+        self.path = path
+        self.match_range = match_range
+        self.time_constant = time_constant
+        self.max_resonances = max_resonances
+        self.resonances = []
+
+    def __len__(self):
+        return len(self.resonances)
+
+    def nearest(self,time,position,kind=None):
+        """Known resonance (of kind, if given) expected nearest to position,
+        and its distance."""
+        best, distance = None, math.inf
+        for resonance in self.resonances:
+            if (kind is not None) and (resonance.kind != kind):
+                continue
+            d = abs(resonance.predict(time) - position)
+            if d < distance:
+                best, distance = resonance, d
+        return best, distance
+
+    def observe(self,time,positions,kind):
+        """Adds the positions [V] of resonances of kind ('peak' or 'edge')
+        seen at time."""
+        for position in positions:
+            resonance, distance = self.nearest(time,position,kind)
+            if distance > self.match_range:
+                resonance = MappedResonance(kind,LinearTrend(self.time_constant,MIN_DRIFT_SPAN))
+                self.resonances.append(resonance)
+            resonance.observe(time,position)
+        self.prune(time)
+
+    def prune(self,time):
+        """Forgets resonances not seen for time_constant, then the least
+        observed (and least recently seen) beyond max_resonances."""
+        self.resonances = [r for r in self.resonances
+                           if time - r.trend.last_time <= self.time_constant]
+        if len(self.resonances) > self.max_resonances:
+            self.resonances.sort(key=lambda r: (r.count,r.trend.last_time),reverse=True)
+            del self.resonances[self.max_resonances:]
+
+    def expected_lock_point(self,time,near=None,min_count=3):
+        """Expected position of the most observed lock point (setpoint
+        crossings, or peaks if there are none) seen at least min_count
+        times, or of the one expected nearest to near. None if there are no
+        such resonances."""
+        for kind in ['edge','peak']:
+            candidates = [r for r in self.resonances if r.kind == kind and r.count >= min_count]
+            if not candidates:
+                continue
+            if near is None:
+                return max(candidates,key=lambda r: r.count).predict(time)
+            return min(candidates,key=lambda r: abs(r.predict(time)-near)).predict(time)
+        return None
+
+    def save(self,path=None):
+        path = self.path if path is None else path
+        with open(path,'w') as f:
+            json.dump({'match range [V]': self.match_range,
+                       'time constant [s]': self.time_constant,
+                       'resonances': [r.to_dict() for r in self.resonances]},f,indent=4)
+
+    @classmethod
+    def load(cls,path):
+        """Loads the map at path, or returns an empty map saving to path if
+        there is none."""
+        try:
+            with open(path,'r') as f:
+                d = json.load(f)
+        except FileNotFoundError:
+            return cls(path)
+        resonance_map = cls(path,d['match range [V]'],d['time constant [s]'])
+        resonance_map.resonances = [MappedResonance.from_dict(r,resonance_map.time_constant)
+                                    for r in d['resonances']]
+        return resonance_map
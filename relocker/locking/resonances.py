@@ -0,0 +1,178 @@
+"""
+*   Resonance finding on sweep traces. The input signal is averaged into bins
+    of the swept output voltage, then peaks (with widths) and crossings of the
+    PID setpoint (edges) are located with sub-sample interpolation. All of the
+    per-sample work is vectorised with numpy so it can run on every sweep.
+"""
+
+import numpy as np
+
+class Resonance():
+    """A feature of a sweep: a 'peak' of the input signal or an 'edge' where
+    the input crosses the setpoint."""
+    def __init__(self,kind,position,width=None,height=None,slope=None):
+        self.kind = kind
+        self.position = position
+        self.width = width
+        self.height = height
+        self.slope = slope
+
+    def __repr__(self):
+        return 'Resonance({}, {:.4f} V)'.format(self.kind,self.position)
+
+def sweep_profile(x,y,bins=512,smoothing=3,x_range=None):
+    """Averages y into equal bins of x (ignoring NaNs), interpolates across
+    empty bins and applies a moving average of smoothing bins. Returns the bin
+    centres and the profile. The bins span x_range=(lo,hi) if given,
+    otherwise the range of x. Both are empty if there are no finite samples."""
+    x = np.asarray(x,dtype=float)
+    y = np.asarray(y,dtype=float)
+    valid = np.isfinite(x) & np.isfinite(y)
+    if not valid.any():
+        return np.array([]), np.array([])
+    x, y = x[valid], y[valid]
+    lo, hi = (x.min(), x.max()) if x_range is None else x_range
+    if hi <= lo:
+        return np.array([lo]), np.array([y.mean()])
+    inside = (x >= lo) & (x <= hi)
+    x, y = x[inside], y[inside]
+    idx = ((x-lo)/(hi-lo)*bins).astype(int).clip(0,bins-1)
+    counts = np.bincount(idx,minlength=bins)
+    sums = np.bincount(idx,weights=y,minlength=bins)
+    centres = lo + (np.arange(bins)+0.5)*(hi-lo)/bins
+    filled = counts > 0
+    if not filled.any():
+        return centres, np.zeros(bins)
+    profile = np.interp(centres,centres[filled],sums[filled]/counts[filled])
+    if smoothing > 1:
+        kernel = np.ones(smoothing)/smoothing
+        profile = np.convolve(np.pad(profile,smoothing//2,mode='edge'),kernel,mode='valid')[:bins]
+    return centres, profile
+
+def find_peaks(centres,profile,prominence=None):
+    """Local maxima standing more than prominence above the median baseline
+    (default five times the median absolute deviation). Positions and heights
+    use parabolic interpolation, widths are the full width at half maximum
+    from linear interpolation. Peaks closer than the width of a higher peak
+    are dropped."""
+    if len(profile) < 3:
+        return []
+    dx = centres[1] - centres[0]
+    baseline = np.median(profile)
+    if prominence is None:
+        prominence = max(5*1.4826*np.median(np.abs(profile-baseline)),1e-9)
+    mid = profile[1:-1]
+    i = np.flatnonzero((mid > profile[:-2]) & (mid >= profile[2:]) & (mid-baseline > prominence)) + 1
+    if len(i) == 0:
+        return []
+    a, b, c = profile[i-1], profile[i], profile[i+1]
+    denom = a - 2*b + c
+    delta = np.where(denom != 0, 0.5*(a-c)/np.where(denom != 0,denom,1), 0)
+    positions = centres[i] + delta*dx
+    heights = b - 0.25*(a-c)*delta
+    peaks = []
+    for k in np.argsort(-heights):
+        level = baseline + (heights[k]-baseline)/2
+        below = profile < level
+        left = np.flatnonzero(below[:i[k]])
+        right = np.flatnonzero(below[i[k]:]) + i[k]
+        x_left = centres[0] if len(left) == 0 else _crossing(centres,profile,left[-1],level)
+        x_right = centres[-1] if len(right) == 0 else _crossing(centres,profile,right[0]-1,level)
+        width = x_right - x_left
+        if any(abs(positions[k]-p.position) < max(p.width,width)/2 for p in peaks):
+            continue
+        peaks.append(Resonance('peak',float(positions[k]),float(width),float(heights[k])))
+    return peaks
+
+def _crossing(centres,profile,j,level):
+    """x where the profile crosses level between samples j and j+1."""
+    y0, y1 = profile[j], profile[j+1]
+    if y1 == y0:
+        return centres[j]
+    return centres[j] + (level-y0)/(y1-y0)*(centres[j+1]-centres[j])
+
+def find_edges(centres,profile,setpoint=0,min_slope_fraction=0.2):
+    """Crossings of the setpoint, linearly interpolated. Crossings with a
+    slope smaller than min_slope_fraction of the steepest one are treated as
+    noise and dropped."""
+    s = profile - setpoint
+    j = np.flatnonzero(np.signbit(s[:-1]) != np.signbit(s[1:]))
+    if len(j) == 0:
+        return []
+    dx = centres[1] - centres[0]
+    positions = centres[j] + s[j]/(s[j]-s[j+1])*dx
+    slopes = (s[j+1]-s[j])/dx
+    keep = np.abs(slopes) >= min_slope_fraction*np.abs(slopes).max()
+    return [Resonance('edge',float(p),slope=float(m)) for p, m in zip(positions[keep],slopes[keep])]
+
+def find_resonances(x,y,setpoint=0,bins=512):
+    """Returns (peaks, edges) of the input y swept against the output x,
+    which are empty if there is no input trace or no finite samples."""
+    if y is None:
+        return [], []
+    centres, profile = sweep_profile(x,y,bins)
+    if len(profile) == 0:
+        return [], []
+    return find_peaks(centres,profile), find_edges(centres,profile,setpoint)
+
+def best_lock_point(peaks,edges,near=None):
+    """Chooses a lock point: the steepest setpoint crossing, or the highest
+    peak if there are no crossings. If near is given the closest of the
+    crossings at least half as steep as the steepest is chosen instead."""
+    if edges:
+        steepest = max(abs(edge.slope) for edge in edges)
+        candidates = [edge for edge in edges if abs(edge.slope) >= steepest/2]
+        if near is None:
+            return max(candidates,key=lambda edge: abs(edge.slope)).position
+        return min(candidates,key=lambda edge: abs(edge.position-near)).position
+    if peaks:
+        if near is None:
+            return peaks[0].position
+        return min(peaks,key=lambda peak: abs(peak.position-near)).position
+    return None
+
+class ResonanceTracker():
+    """Follows one lock point from sweep to sweep. Each update moves to the
+    nearest candidate within capture_range of the current position, and an
+    exponential average of the drift rate is kept. If nothing is in range for
+    max_misses sweeps the tracker re-acquires the best lock point.
+    """
+    def __init__(self,capture_range=0.05,max_misses=5,smoothing=0.2):
+        self.capture_range = capture_range
+        self.max_misses = max_misses
+        self.smoothing = smoothing
+        self.reset()
+
+    def reset(self):
+        self.position = None
+        self.time = None
+        self.drift_rate = 0 # [V/s]
+        self.misses = 0
+
+    @property
+    def acquiring(self):
+        """Whether the next update (re-)acquires the lock point."""
+        return self.position is None or self.misses >= self.max_misses
+
+    def update(self,time,peaks,edges,hint=None):
+        """Returns the tracked lock point after a new sweep. When acquiring,
+        the candidate nearest to hint is chosen if a hint is given."""
+        if self.acquiring:
+            position = best_lock_point(peaks,edges,near=hint)
+            self.drift_rate = 0
+        else:
+            expected = self.position
+            if self.time is not None:
+                expected += self.drift_rate*(time-self.time)
+            position = best_lock_point(peaks,edges,near=expected)
+            if (position is None) or (abs(position-expected) > self.capture_range):
+                self.misses += 1
+                return self.position
+            if (self.time is not None) and (time > self.time):
+                rate = (position-self.position)/(time-self.time)
+                self.drift_rate += self.smoothing*(rate-self.drift_rate)
+        if position is not None:
+            self.misses = 0
+            self.position = position
+            self.time = time
+        return self.position
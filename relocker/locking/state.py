@@ -0,0 +1,123 @@
+"""
+*   Explicit lock state machine. A laser is in exactly one of the STATES and
+    only moves between them through the events in TRANSITIONS, so that e.g.
+    a relock cannot be started while one is already running. Every
+    transition is logged with the number of hardware calls made while
+    handling it and passed to any subscribers.
+
+        off --sweep on--> sweeping --pid on--> locked --lock lost--> unlocked
+        unlocked/locked --relock--> relocking --engage--> verifying
+        verifying --relock succeeded--> locked
+        verifying --relock failed--> unlocked --park--> parked
+"""
+
+from collections import deque
+
+STATES = ['off','sweeping','locked','unlocked','relocking','verifying','parked']
+
+TRANSITIONS = {
+    ('off','sweep on'): 'sweeping',
+    ('off','pid on'): 'locked',
+    ('off','relock'): 'relocking',
+    ('sweeping','sweep off'): 'off',
+    ('sweeping','pid on'): 'locked',
+    ('sweeping','relock'): 'relocking',
+    ('locked','pid off'): 'off',
+    ('locked','lock lost'): 'unlocked',
+    ('locked','relock'): 'relocking',
+    ('unlocked','pid off'): 'off',
+    ('unlocked','lock found'): 'locked',
+    ('unlocked','relock'): 'relocking',
+    ('unlocked','park'): 'parked',
+    ('relocking','engage'): 'verifying',
+    ('verifying','retry'): 'verifying',
+    ('verifying','relock succeeded'): 'locked',
+    ('verifying','relock failed'): 'unlocked',
+    ('verifying','pid off'): 'off',
+    ('parked','pid off'): 'off',
+    ('parked','relock'): 'relocking',
+    ('parked','lock found'): 'locked',
+    }
+
+PID_STATES = ['locked','unlocked','verifying','parked'] # states with the PID output on
+RELOCK_STATES = ['relocking','verifying']
+
+class TransitionError(ValueError):
+    pass
+
+class Transition():
+    """A transition that has happened, with the hardware calls made while
+    handling it."""
+    def __init__(self,time,old,event,new,hardware_calls=0):
+        self.time = time
+        self.old = old
+        self.event = event
+        self.new = new
+        self.hardware_calls = hardware_calls
+
+    def __repr__(self):
+        return 'Transition({} --{}--> {}, {} hardware calls)'.format(self.old,
+                    self.event,self.new,self.hardware_calls)
+
+class LockStateMachine():
+    """Lock state of one laser. Autorelock is a mode rather than a state and
+    is kept alongside.
+
+    fire(event) moves to the next state and returns the Transition, raising
+    TransitionError if the event is not allowed in the current state. The
+    caller then does the hardware operations for the transition and reports
+    how many calls they took with finish(transition,calls), after which
+    subscribers are called with the transition.
+    """
+    def __init__(self,state='off',clock=None,history=200):
+        self.state = state
+        self.clock = clock
+        self.autorelock = False
+        self.log = deque(maxlen=history)
+        self.stats = {} # (old, event, new): [count, hardware calls]
+        self.subscribers = []
+
+    def can(self,event):
+        return (self.state,event) in TRANSITIONS
+
+    def fire(self,event):
+        try:
+            new = TRANSITIONS[(self.state,event)]
+        except KeyError:
+            raise TransitionError('"{}" is not allowed in state "{}"'.format(event,self.state))
+        time = None if self.clock is None else self.clock.time()
+        transition = Transition(time,self.state,event,new)
+        self.state = new
+        return transition
+
+    def finish(self,transition,hardware_calls=0):
+        transition.hardware_calls = hardware_calls
+        self.log.append(transition)
+        stats = self.stats.setdefault((transition.old,transition.event,transition.new),[0,0])
+        stats[0] += 1
+        stats[1] += hardware_calls
+        for callback in list(self.subscribers): # callbacks may unsubscribe
+            callback(transition)
+
+    def subscribe(self,callback):
+        """Calls callback(transition) after every transition."""
+        self.subscribers.append(callback)
+
+    def unsubscribe(self,callback):
+        self.subscribers.remove(callback)
+
+    @property
+    def pid_enabled(self):
+        return self.state in PID_STATES
+
+    @property
+    def sweep_enabled(self):
+        return self.state == 'sweeping'
+
+    @property
+    def is_locked(self):
+        return self.state == 'locked'
+
+    @property
+    def is_relocking(self):
+        return self.state in RELOCK_STATES
@@ -0,0 +1,134 @@
+"""
+*   Relock strategies. A strategy proposes the ASG offsets to re-engage the
+    PID at, one attempt at a time, and is told the outcome of each attempt so
+    that it can adapt its search. The strategy for each laser is chosen by
+    its 'relock setting'.
+"""
+
+class RelockStrategy():
+    """Base class for relock strategies. Subclasses implement next_offset()
+    and optionally feedback()."""
+    name = None
+    label = None
+
+    def __init__(self,settings,expected=None):
+        self.settings = settings
+        self.expected = expected
+        self.max_voltage = settings['max voltage [V]']
+        self.min_voltage = settings['min voltage [V]']
+        self.step = settings.get('relock search step [V]',0.02)
+
+    def last_good_offset(self):
+        """Output voltage at the last good lock, falling back to the manual
+        lock point."""
+        last_locked = self.settings.get('last locked voltage [V]')
+        if last_locked is None:
+            return self.settings['offset [V]']
+        return last_locked
+
+    def in_range(self,offset):
+        return self.min_voltage <= offset <= self.max_voltage
+
+    def next_offset(self):
+        """Returns the next offset to try, or None when the strategy has
+        nothing left to try."""
+        raise NotImplementedError
+
+    def feedback(self,offset,success,mean_voltage):
+        """Called with the outcome of the attempt at offset."""
+        pass
+
+class ManualStrategy(RelockStrategy):
+    """Relocks at the manual lock point (red line)."""
+    name = 'manual'
+    label = 'manual lock point'
+
+    def __init__(self,settings,expected=None):
+        super().__init__(settings,expected)
+        self.tried = False
+
+    def next_offset(self):
+        if self.tried:
+            return None
+        self.tried = True
+        return self.settings['offset [V]']
+
+class LastGoodStrategy(ManualStrategy):
+    """Relocks at the output voltage of the last good lock (blue line)."""
+    name = 'prev'
+    label = 'value at last lock'
+
+    def next_offset(self):
+        if self.tried:
+            return None
+        self.tried = True
+        return self.last_good_offset()
+
+class SpiralStrategy(RelockStrategy):
+    """Expanding search around the last good offset: c, c+s, c-s, c+2s, ...
+    skipping any offsets outside the voltage limits."""
+    name = 'spiral'
+    label = 'spiral search around last lock'
+
+    def __init__(self,settings,expected=None):
+        super().__init__(settings,expected)
+        self.centre = self.last_good_offset()
+        self.n = 0
+
+    def next_offset(self):
+        while True:
+            k = (self.n+1)//2
+            sign = 1 if self.n % 2 else -1
+            offset = self.centre + sign*k*self.step
+            self.n += 1
+            if self.in_range(offset):
+                return offset
+            if (self.centre - k*self.step < self.min_voltage) and (self.centre + k*self.step > self.max_voltage):
+                return None
+
+class BisectionStrategy(RelockStrategy):
+    """Bisection between the rails. Assumes that a failed lock runs the
+    output into the rail on the side of the lock point, so hitting the
+    upper rail moves the search above the attempted offset and vice versa.
+    Stops when the interval is narrower than the search step.
+    """
+    name = 'bisection'
+    label = 'bisection between rails'
+
+    def __init__(self,settings,expected=None):
+        super().__init__(settings,expected)
+        self.lo = self.min_voltage
+        self.hi = self.max_voltage
+
+    def next_offset(self):
+        if self.hi - self.lo < self.step:
+            return None
+        return (self.lo + self.hi)/2
+
+    def feedback(self,offset,success,mean_voltage):
+        if success or (mean_voltage is None):
+            return
+        if mean_voltage >= offset:
+            self.lo = offset
+        else:
+            self.hi = offset
+
+class MapStrategy(SpiralStrategy):
+    """Spiral search around the position of the lock point expected from the
+    laser's resonance map, or around the last good offset if the map has no
+    prediction."""
+    name = 'map'
+    label = 'expected resonance from map'
+
+    def __init__(self,settings,expected=None):
+        super().__init__(settings,expected)
+        if (expected is not None) and self.in_range(expected):
+            self.centre = expected
+
+STRATEGIES = {strategy.name: strategy for strategy in
+              [ManualStrategy,LastGoodStrategy,SpiralStrategy,BisectionStrategy,MapStrategy]}
+
+def make_strategy(settings,expected=None):
+    """Creates the relock strategy selected in a laser's settings. expected
+    is the lock point [V] predicted by the resonance map, if any."""
+    return STRATEGIES.get(settings['relock setting'],ManualStrategy)(settings,expected)
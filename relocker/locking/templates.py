@@ -0,0 +1,140 @@
+"""
+*   Lock point recognition from the operator's manual locks. Every time the
+    PID is enabled by hand from a sweep, the sweep and the chosen lock point
+    are added to the laser's template library. A new sweep is matched against
+    the library by FFT cross-correlation, and the lock point of the best
+    template shifted by the best lag is returned as the lock point the
+    operator would have chosen.
+
+    The magnitude spectrum of a profile does not change when the profile is
+    shifted, so the first few spectral magnitudes are kept as an index that
+    picks out the most similar templates before the full correlation. This
+    keeps matching fast with thousands of templates.
+"""
+
+import numpy as np
+
+from .resonances import sweep_profile
+
+TEMPLATE_BINS = 512
+INDEX_FEATURES = 32
+MIN_SPAN = 0.25 # min. sweep span as a fraction of the output range
+MIN_SCORE = 0.7 # min. normalised correlation of a usable match
+
+class TemplateLibrary():
+    """Templates of manual lock points for one laser. Sweeps are resampled
+    onto bins equal bins between min_voltage and max_voltage and normalised
+    to zero mean and unit norm, so that the correlation with a template is
+    between -1 and 1.
+    """
+    def __init__(self,min_voltage,max_voltage,bins=TEMPLATE_BINS,features=INDEX_FEATURES):
+        self.min_voltage = float(min_voltage)
+        self.max_voltage = float(max_voltage)
+        self.bins = int(bins)
+        self.features = int(features)
+        self.profiles = np.zeros((0,self.bins))
+        self.offsets = np.zeros(0)
+        self.timestamps = np.zeros(0)
+        self._spectra = np.zeros((0,self.bins+1),dtype=complex)
+        self._keys = np.zeros((0,self.features))
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def step(self):
+        """Voltage step between bins."""
+        return (self.max_voltage - self.min_voltage)/self.bins
+
+    def profile(self,x,y):
+        """Normalised sweep profile of the input y against the output x, or
+        None if the sweep is too narrow or flat to be matched."""
+        x = np.asarray(x,dtype=float)
+        if (len(x) == 0) or (np.nanmax(x) - np.nanmin(x) < MIN_SPAN*(self.max_voltage - self.min_voltage)):
+            return None
+        _, profile = sweep_profile(x,y,self.bins,x_range=(self.min_voltage,self.max_voltage))
+        profile = profile - profile.mean()
+        norm = np.linalg.norm(profile)
+        if not norm > 0:
+            return None
+        return profile/norm
+
+    def _spectrum(self,profiles):
+        # zero padded to twice the length so the correlation does not wrap
+        return np.fft.rfft(profiles,n=2*self.bins,axis=-1)
+
+    def _key(self,spectra):
+        magnitudes = np.abs(spectra[...,1:self.features+1])
+        norms = np.linalg.norm(magnitudes,axis=-1,keepdims=True)
+        return magnitudes/np.where(norms > 0,norms,1)
+
+    def add(self,x,y,offset,timestamp=0):
+        """Adds the sweep (x, y) with the operator's lock point offset.
+        Returns whether the template was added."""
+        if (offset is None) or not (self.min_voltage <= offset <= self.max_voltage):
+            return False
+        profile = self.profile(x,y)
+        if profile is None:
+            return False
+        spectrum = self._spectrum(profile)
+        self.profiles = np.vstack([self.profiles,profile])
+        self.offsets = np.append(self.offsets,float(offset))
+        self.timestamps = np.append(self.timestamps,float(timestamp))
+        self._spectra = np.vstack([self._spectra,spectrum])
+        self._keys = np.vstack([self._keys,self._key(spectrum)])
+        return True
+
+    def match(self,x,y,candidates=32):
+        """Matches the sweep (x, y) against the candidates templates with the
+        most similar index keys. Returns (offset, score, template index) for
+        the best match, or None if there is nothing to match."""
+        profile = self.profile(x,y)
+        if (profile is None) or (len(self) == 0):
+            return None
+        spectrum = self._spectrum(profile)
+        if len(self) > candidates:
+            similarity = self._keys @ self._key(spectrum)
+            rows = np.argpartition(-similarity,candidates)[:candidates]
+        else:
+            rows = np.arange(len(self))
+        # corr[i,k] = sum_n profile[n+k]*template_i[n]
+        corr = np.fft.irfft(spectrum*np.conj(self._spectra[rows]),n=2*self.bins,axis=-1)
+        i, k = np.unravel_index(np.argmax(corr),corr.shape)
+        lag = k if k < self.bins else k - 2*self.bins
+        offset = self.offsets[rows[i]] + lag*self.step
+        offset = min(max(offset,self.min_voltage),self.max_voltage)
+        return float(offset), float(corr[i,k]), int(rows[i])
+
+    def save(self,path):
+        with open(path,'wb') as f:
+            np.savez(f,profiles=self.profiles,offsets=self.offsets,timestamps=self.timestamps,
+                     voltages=[self.min_voltage,self.max_voltage],features=self.features)
+
+    @classmethod
+    def load(cls,path):
+        with np.load(path) as f:
+            min_voltage, max_voltage = f['voltages']
+            library = cls(min_voltage,max_voltage,f['profiles'].shape[1],int(f['features']))
+            library.profiles = f['profiles']
+            library.offsets = f['offsets']
+            library.timestamps = f['timestamps']
+        library._spectra = library._spectrum(library.profiles)
+        library._keys = library._key(library._spectra)
+        return library
+
+    @classmethod
+    def from_records(cls,records,min_voltage=None,max_voltage=None,bins=TEMPLATE_BINS):
+        """Builds a library from trace records (e.g. TraceIndex.query(...,
+        event='manual')). The voltage range defaults to that of the most
+        recent record. Records that are not sweeps are skipped."""
+        records = sorted(records,key=lambda record: record.timestamp)
+        if not records:
+            return None
+        if min_voltage is None:
+            min_voltage = records[-1].settings['min voltage [V]']
+        if max_voltage is None:
+            max_voltage = records[-1].settings['max voltage [V]']
+        library = cls(min_voltage,max_voltage,bins)
+        for record in records:
+            library.add(record.output,record.input,record.settings.get('offset [V]'),record.timestamp)
+        return library
@@ -0,0 +1,102 @@
+"""
+*   Online linear trends and unlock prediction. LinearTrend keeps the
+    exponentially weighted sums of a straight line fit of a value against
+    time, so each sample and each prediction is O(1). UnlockPredictor uses
+    trends of the locked output mean and integrator to predict the time until
+    the output reaches a rail, i.e. before the lock is actually lost.
+"""
+
+import math
+
+WARNING_TIME = 60 # [s] time-to-rail below which a lock is at risk
+
+class LinearTrend():
+    """Exponentially weighted straight line fit of x against t. Samples
+    decay with time_constant, and the slope is zero until the samples span
+    at least min_span seconds. Times are stored relative to t0 to keep the
+    sums well conditioned."""
+    def __init__(self,time_constant,min_span=0,t0=None,sums=None,last_time=None):
+        self.time_constant = time_constant
+        self.min_span = min_span
+        self.t0 = t0
+        self.sums = [0,0,0,0,0] if sums is None else list(sums) # w, wt, wx, wtt, wtx
+        self.last_time = last_time
+
+    def reset(self):
+        self.t0 = None
+        self.sums = [0,0,0,0,0]
+        self.last_time = None
+
+    def add(self,time,value):
+        if self.t0 is None:
+            self.t0 = self.last_time = time
+        decay = math.exp(-max(time-self.last_time,0)/self.time_constant)
+        t = time - self.t0
+        self.sums = [s*decay for s in self.sums]
+        for i, term in enumerate([1,t,value,t*t,t*value]):
+            self.sums[i] += term
+        self.last_time = max(time,self.last_time)
+
+    def _moments(self):
+        w, wt, wx, wtt, wtx = self.sums
+        mt, mx = wt/w, wx/w
+        return mt, mx, wtt/w - mt*mt, wtx/w - mt*mx
+
+    def rate(self):
+        """Fitted slope [x/s]."""
+        if self.t0 is None:
+            return 0
+        mt, mx, var_t, cov = self._moments()
+        if (var_t <= 0) or (var_t < (self.min_span/2)**2):
+            return 0
+        return cov/var_t
+
+    def predict(self,time):
+        """Fitted value at time, or None without samples."""
+        if self.t0 is None:
+            return None
+        mt, mx, var_t, cov = self._moments()
+        return mx + self.rate()*(time - self.t0 - mt)
+
+    def time_to(self,level,time):
+        """Time [s] from time until the fit reaches level, or inf if it is
+        not moving towards it."""
+        value, rate = self.predict(time), self.rate()
+        if (value is None) or (rate == 0) or ((level - value)*rate < 0):
+            return math.inf
+        return (level - value)/rate
+
+    def to_dict(self):
+        return {'t0': self.t0, 'sums': self.sums, 'last time': self.last_time}
+
+class UnlockPredictor():
+    """Predicts the time until a lock runs into the output rails from the
+    trends of the output mean and of the integrator plus the ASG offset
+    (which is continuous when the offset is re-centred). A lock is at risk
+    when either is predicted to reach a rail within warning_time.
+    """
+    def __init__(self,time_constant=10,min_span=2,warning_time=WARNING_TIME):
+        self.output = LinearTrend(time_constant,min_span)
+        self.integrator = LinearTrend(time_constant,min_span)
+        self.warning_time = warning_time
+        self.time_to_rail = math.inf
+
+    def reset(self):
+        self.output.reset()
+        self.integrator.reset()
+        self.time_to_rail = math.inf
+
+    def update(self,time,mean_voltage,max_voltage,min_voltage,integrator=None,offset=None):
+        """Adds a locked sample and returns the predicted time to rail [s]."""
+        self.output.add(time,mean_voltage)
+        times = [self.output.time_to(max_voltage,time),self.output.time_to(min_voltage,time)]
+        if (integrator is not None) and (offset is not None):
+            self.integrator.add(time,integrator+offset)
+            times += [self.integrator.time_to(max_voltage,time),
+                      self.integrator.time_to(min_voltage,time)]
+        self.time_to_rail = min(times)
+        return self.time_to_rail
+
+    @property
+    def at_risk(self):
+        return self.time_to_rail < self.warning_time
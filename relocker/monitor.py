@@ -0,0 +1,372 @@
+"""
+*   Optional localhost monitoring server, so that lock status can be watched
+    from a browser or script instead of over VNC. The GUI only stores the
+    latest status and trace of each laser in a MonitorHub (a dictionary
+    update and a reference to the immutable trace frame); each client is
+    served from its own thread, which encodes and sends what has changed at
+    the client's own rate, so viewers add no work to the control loop.
+
+        GET /            small dashboard page
+        GET /status      JSON snapshot of all lasers
+        GET /ws?rate=5&trace_rate=1&lasers=Rb%20repump,Rb%20cooler
+                         WebSocket stream of binary frames
+
+    Every binary frame starts with a 16 byte header (little endian)
+        type u8, laser id u8, count u16, sequence u32, time f8
+    followed by, for each type,
+        LASERS  JSON list of the laser names (the index is the laser id)
+        STATUS  count x (field id u8, value f8), only the fields that have
+                changed since the client's previous update (all on connect)
+        TRACE   t0 f4, dt f4 and count float32 samples each of the output
+                and input (NaN if not acquired), decimated to at most
+                MAX_POINTS
+    The field ids index FIELDS; the state is sent as its index in STATES.
+
+    Only the standard library is used so that this also runs on Python 3.6.
+"""
+
+import json
+import time
+import base64
+import struct
+import select
+import hashlib
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import numpy as np
+
+from .locking.state import STATES
+
+PORT = 8765
+MAX_RATE = 20 # [1/s] status updates per client
+MAX_TRACE_RATE = 5 # [1/s] traces per laser per client
+MAX_POINTS = 512
+MAX_CLIENTS = 64
+
+LASERS, STATUS, TRACE = 1, 2, 3
+FIELDS = ['state','locked','autorelock','mean [V]','margin','offset [V]',
+          'integrator','time to rail [s]','relocks']
+
+HEADER = struct.Struct('<BBHId')
+FIELD = struct.Struct('<Bd')
+TRACE_HEADER = struct.Struct('<ff')
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+def _number(field,value):
+    if value is None:
+        return float('nan')
+    if field == 'state':
+        return float(STATES.index(value)) if value in STATES else float('nan')
+    return float(value)
+
+class MonitorHub():
+    """Latest status and trace of each laser, shared with the client
+    threads."""
+    def __init__(self,max_points=MAX_POINTS):
+        self.max_points = max_points
+        self.lock = threading.Lock()
+        self.names = [] # the laser id is the index
+        self.status = {} # name: {field: value}
+        self.times = {} # name: time of the last status update
+        self.traces = {} # name: TraceFrame
+        self.encoded = {} # name: (sequence, bytes)
+
+    def update_status(self,laser,time,**fields):
+        """Updates some of the FIELDS of a laser (keyword arguments with
+        spaces and units dropped, e.g. mean=..., time_to_rail=...)."""
+        with self.lock:
+            if laser not in self.status:
+                self.names.append(laser)
+                self.status[laser] = {}
+            status = self.status[laser]
+            for key, value in fields.items():
+                status[_FIELD_KEYS[key]] = value
+            self.times[laser] = time
+
+    def publish_trace(self,frame):
+        """Trace bus subscriber keeping the latest frame of each laser."""
+        with self.lock:
+            if frame.laser not in self.status:
+                self.names.append(frame.laser)
+                self.status[frame.laser] = {}
+            self.traces[frame.laser] = frame
+
+    def remove(self,laser):
+        """Removes a laser. The ids of the lasers after it move down by one
+        and clients are sent the new LASERS list."""
+        with self.lock:
+            if laser in self.names:
+                self.names.remove(laser)
+            for table in [self.status,self.times,self.traces,self.encoded]:
+                table.pop(laser,None)
+
+    def snapshot(self):
+        """{name: status dict} of the current lasers."""
+        with self.lock:
+            return {name: dict(status,time=self.times.get(name))
+                    for name, status in self.status.items()}
+
+    def trace_bytes(self,laser):
+        """(sequence, encoded TRACE payload) of the latest trace, encoded
+        once and shared by all clients."""
+        with self.lock:
+            frame = self.traces.get(laser)
+            cached = self.encoded.get(laser)
+        if frame is None:
+            return None
+        if (cached is not None) and cached[0] == frame.sequence:
+            return cached
+        step = max(1,int(np.ceil(len(frame.output)/self.max_points)))
+        output = np.asarray(frame.output[::step],dtype='<f4')
+        if frame.input is None:
+            input_trace = np.full(len(output),np.nan,dtype='<f4')
+        else:
+            input_trace = np.asarray(frame.input[::step],dtype='<f4')
+        t0, dt = 0, 0
+        if (frame.times is not None) and len(frame.times) > 1:
+            t0 = frame.times[0]
+            dt = (frame.times[1] - frame.times[0])*step
+        payload = TRACE_HEADER.pack(t0,dt) + output.tobytes() + input_trace.tobytes()
+        encoded = (frame.sequence,len(output),frame.time,payload)
+        with self.lock:
+            self.encoded[laser] = encoded
+        return encoded
+
+_FIELD_KEYS = {field.split(' [')[0].replace(' ','_'): field for field in FIELDS}
+
+def encode_frame(kind,laser_id,count,sequence,time,payload=b''):
+    return HEADER.pack(kind,laser_id,count,sequence & 0xffffffff,time) + payload
+
+def _websocket_frame(payload,opcode=0x2):
+    length = len(payload)
+    if length < 126:
+        head = struct.pack('!BB',0x80|opcode,length)
+    elif length < 65536:
+        head = struct.pack('!BBH',0x80|opcode,126,length)
+    else:
+        head = struct.pack('!BBQ',0x80|opcode,127,length)
+    return head + payload
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,format,*args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/status':
+            self._send(200,'application/json',json.dumps(self.server.hub.snapshot(),
+                                                         default=str).encode('utf-8'))
+        elif url.path == '/ws':
+            self._stream(parse_qs(url.query))
+        elif url.path == '/':
+            self._send(200,'text/html',DASHBOARD.encode('utf-8'))
+        else:
+            self._send(404,'text/plain',b'not found')
+
+    def _send(self,code,content_type,body):
+        self.send_response(code)
+        self.send_header('Content-Type',content_type)
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self,query):
+        key = self.headers.get('Sec-WebSocket-Key')
+        if key is None:
+            return self._send(400,'text/plain',b'websocket upgrade expected')
+        if not self.server.add_client():
+            return self._send(503,'text/plain',b'too many clients')
+        try:
+            accept = base64.b64encode(hashlib.sha1((key+WEBSOCKET_GUID).encode()).digest())
+            self.send_response(101)
+            self.send_header('Upgrade','websocket')
+            self.send_header('Connection','Upgrade')
+            self.send_header('Sec-WebSocket-Accept',accept.decode())
+            self.end_headers()
+            self.wfile.flush()
+            rate = min(MAX_RATE,float(query.get('rate',[MAX_RATE])[0]))
+            trace_rate = min(MAX_TRACE_RATE,float(query.get('trace_rate',[1])[0]))
+            lasers = None
+            if 'lasers' in query:
+                lasers = set(query['lasers'][0].split(','))
+            MonitorClient(self.server.hub,self.connection,rate,trace_rate,lasers).run()
+        except (OSError,ValueError):
+            pass
+        finally:
+            self.server.remove_client()
+            self.close_connection = True
+
+class MonitorClient():
+    """Sends what has changed to one WebSocket client at its own rate."""
+    def __init__(self,hub,connection,rate,trace_rate,lasers=None):
+        self.hub = hub
+        self.connection = connection
+        self.interval = 1/max(rate,0.01)
+        self.trace_interval = None if trace_rate <= 0 else 1/trace_rate
+        self.lasers = lasers
+        self.sequence = 0
+        self.names = []
+        self.sent = {} # (name, field): value
+        self.sent_traces = {} # name: (sequence, time sent)
+
+    def run(self):
+        while True:
+            start = time.monotonic()
+            self.send_updates()
+            remaining = self.interval - (time.monotonic() - start)
+            if self._closed_by_client(max(0,remaining)):
+                return
+
+    def _send(self,kind,laser_id,count,sample_time,payload=b''):
+        self.sequence += 1
+        frame = encode_frame(kind,laser_id,count,self.sequence,sample_time,payload)
+        self.connection.sendall(_websocket_frame(frame))
+
+    def send_updates(self):
+        with self.hub.lock:
+            names = list(self.hub.names)
+        if names != self.names:
+            for name in set(self.names) - set(names): # resend everything if added again
+                self.sent_traces.pop(name,None)
+                for field in FIELDS:
+                    self.sent.pop((name,field),None)
+            self.names = names
+            self._send(LASERS,0,len(names),time.time(),json.dumps(names).encode('utf-8'))
+        snapshot = self.hub.snapshot()
+        now = time.monotonic()
+        for laser_id, name in enumerate(names):
+            if (self.lasers is not None) and (name not in self.lasers):
+                continue
+            status = snapshot.get(name,{})
+            changed = []
+            for field_id, field in enumerate(FIELDS):
+                if field not in status:
+                    continue
+                value = _number(field,status[field])
+                previous = self.sent.get((name,field))
+                if (previous is None) or not (value == previous or (value != value and previous != previous)):
+                    changed.append(FIELD.pack(field_id,value))
+                    self.sent[(name,field)] = value
+            if changed:
+                self._send(STATUS,laser_id,len(changed),status.get('time') or 0,b''.join(changed))
+            if self.trace_interval is None:
+                continue
+            last = self.sent_traces.get(name)
+            if (last is not None) and (now - last[1] < self.trace_interval):
+                continue
+            encoded = self.hub.trace_bytes(name)
+            if (encoded is None) or ((last is not None) and encoded[0] == last[0]):
+                continue
+            sequence, count, sample_time, payload = encoded
+            self._send(TRACE,laser_id,count,sample_time,payload)
+            self.sent_traces[name] = (sequence,now)
+
+    def _closed_by_client(self,timeout):
+        """Waits up to timeout for client frames, answering pings. Returns
+        True once the client has closed the connection."""
+        readable, _, _ = select.select([self.connection],[],[],timeout)
+        if not readable:
+            return False
+        head = self._receive(2)
+        if head is None:
+            return True
+        opcode = head[0] & 0x0f
+        length = head[1] & 0x7f
+        if length == 126:
+            length = struct.unpack('!H',self._receive(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q',self._receive(8))[0]
+        mask = self._receive(4) if head[1] & 0x80 else b'\0\0\0\0'
+        payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._receive(length) or b''))
+        if opcode == 0x8:
+            self.connection.sendall(_websocket_frame(payload[:2],0x8))
+            return True
+        if opcode == 0x9:
+            self.connection.sendall(_websocket_frame(payload,0xA))
+        return False
+
+    def _receive(self,n):
+        data = b''
+        while len(data) < n:
+            chunk = self.connection.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+class MonitorServer(socketserver.ThreadingMixIn,HTTPServer):
+    """HTTP/WebSocket server on localhost, serving a MonitorHub from a
+    background thread."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,hub,port=PORT,host='127.0.0.1',max_clients=MAX_CLIENTS):
+        super().__init__((host,port),_Handler)
+        self.hub = hub
+        self.max_clients = max_clients
+        self.clients = 0
+        self.clients_lock = threading.Lock()
+        self.thread = None
+
+    def add_client(self):
+        with self.clients_lock:
+            if self.clients >= self.max_clients:
+                return False
+            self.clients += 1
+            return True
+
+    def remove_client(self):
+        with self.clients_lock:
+            self.clients -= 1
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+DASHBOARD = """<!DOCTYPE html>
+<html><head><title>relocker</title>
+<style>body{font-family:sans-serif}td,th{padding:2px 8px;text-align:right}
+.locked{background:#8f8}.unlocked{background:#f88}.relocking,.verifying{background:#fd8}
+.parked{background:#c8f}</style></head>
+<body><h3>relocker</h3><table id="t"></table>
+<script>
+const FIELDS = %s, STATES = %s;
+let names = [], rows = {};
+const table = document.getElementById('t');
+table.innerHTML = '<tr><th>laser</th>' + FIELDS.map(f => '<th>'+f+'</th>').join('') + '</tr>';
+const ws = new WebSocket('ws://' + location.host + '/ws?rate=2&trace_rate=0');
+ws.binaryType = 'arraybuffer';
+ws.onmessage = (message) => {
+  const view = new DataView(message.data);
+  const type = view.getUint8(0), id = view.getUint8(1), count = view.getUint16(2, true);
+  if (type == 1) {
+    names = JSON.parse(new TextDecoder().decode(new Uint8Array(message.data, 16)));
+    for (const name in rows) {
+      if (!names.includes(name)) { table.deleteRow(rows[name].rowIndex); delete rows[name]; }
+    }
+  } else if (type == 2) {
+    const name = names[id];
+    if (!(name in rows)) {
+      rows[name] = table.insertRow();
+      rows[name].innerHTML = '<td>'+name+'</td>' + FIELDS.map(() => '<td></td>').join('');
+    }
+    for (let i = 0; i < count; i++) {
+      const field = view.getUint8(16 + 9*i), value = view.getFloat64(17 + 9*i, true);
+      let text = FIELDS[field] == 'state' ? STATES[value] : value.toPrecision(4);
+      rows[name].cells[field+1].textContent = text;
+      if (FIELDS[field] == 'state') rows[name].className = STATES[value];
+    }
+  }
+};
+</script></body></html>
+""" % (json.dumps(FIELDS),json.dumps(STATES))
@@ -0,0 +1,79 @@
+"""
+*   Scope arbiter packing lock monitoring acquisitions. The scope of a Red
+    Pitaya has two inputs and a normal acquisition uses both for one laser
+    (output and input). While a laser is locked its lock check only needs the
+    output, so the arbiter takes monitoring requests from the lasers on each
+    board and, when two are waiting, acquires both outputs in one trace and
+    publishes each channel on its laser's trace bus as a 'monitor' frame.
+    A request left unpaired after the pack window is acquired on its own.
+    Lasers book half an acquisition of the board's budget for a monitoring
+    request, so the arbiter books the other half for one acquired on its own.
+"""
+
+import threading
+from functools import partial
+
+PACK_WINDOW = 0.05 # [s] a monitoring request waits for a partner
+
+class ScopeArbiter():
+    """Pairs monitoring acquisitions of lasers on the same board. A laser
+    needs the attributes board, rp, settings and trace_bus.
+
+    call_later(delay,callback,*args) schedules the flush of an unpaired
+    request. It has to call back on the thread that makes the requests and
+    owns the scope (the GUI passes a QTimer based one), and defaults to
+    clock.call_later, which on the wall clock uses a timer thread.
+
+    budget is the AcquisitionBudget the lasers reserve their acquisitions in,
+    if any.
+    """
+    def __init__(self,clock,pack_window=PACK_WINDOW,call_later=None,budget=None):
+        self.clock = clock
+        self.pack_window = pack_window
+        self.call_later = clock.call_later if call_later is None else call_later
+        self.budget = budget
+        self.pending = {} # board: [laser, duration]
+        self.packed = 0 # acquisitions shared by two lasers
+        self.single = 0
+        self.lock = threading.Lock()
+
+    def request(self,laser,duration):
+        """Requests a monitoring acquisition of laser's output channel."""
+        with self.lock:
+            waiting = self.pending.get(laser.board)
+            if (waiting is not None) and (waiting[0] is laser):
+                waiting[1] = max(waiting[1],duration)
+                return
+            if waiting is None:
+                entry = [laser,duration]
+                self.pending[laser.board] = entry
+                self.call_later(self.pack_window,self._flush,laser.board,entry)
+                return
+            del self.pending[laser.board]
+        first, first_duration = waiting
+        if first.settings['output'] == laser.settings['output']:
+            self._acquire_single(first,first_duration)
+            self._acquire_single(laser,duration)
+            return
+        self.packed += 1
+        first.rp.queue_scope_trace(first.settings['output'],laser.settings['output'],
+                                   max(duration,first_duration),publish=False,
+                                   callback=partial(self._deliver,[first,laser]))
+
+    def _flush(self,board,entry):
+        with self.lock:
+            if self.pending.get(board) is not entry:
+                return
+            del self.pending[board]
+        self._acquire_single(*entry)
+
+    def _acquire_single(self,laser,duration):
+        self.single += 1
+        if self.budget is not None: # the laser only booked half an acquisition
+            now = self.clock.time()
+            self.budget.reserve(laser.board,now,now,0.5)
+        laser.rp.queue_scope_trace(laser.settings['output'],laser.settings['input'],duration)
+
+    def _deliver(self,lasers,times,datas,duration):
+        for laser, output in zip(lasers,datas):
+            laser.trace_bus.publish(times,(output,None),duration,kind='monitor')
@@ -7,17 +7,21 @@
 import time
 import queue
 from pyrpl import Pyrpl
-from qtpy import QtCore, QtTest
+from qtpy import QtCore
+
+from ..clock import get_clock
 
 class RedPitaya():
     """Wrapper class to make PyRPL functions easily accessible"""
     
-    def __init__(self,laser,hostname,config='relocker',gui=False):
+    def __init__(self,laser,hostname,config='relocker',gui=False,clock=None):
         self.laser = laser
+        self.clock = get_clock() if clock is None else clock
         self.p = Pyrpl(hostname=hostname,config=config,gui=gui)#,modules=[])
         # self.p.hide_gui()
         self.rp = self.p.rp
         self.scope = self.rp.scope
+        self.hardware_calls = 0 # register reads/writes and scope acquisitions
         
         self.scope_queue = queue.Queue()
         self.scope_queue_wait = QtCore.QWaitCondition()
@@ -36,6 +40,7 @@ class RedPitaya():
     
     def get_pid_value(self,index,setting):
         """Passes a pid value from PyRPL."""
+        self.hardware_calls += 1
         print('index',index)
         if index == 0:
             pid = self.rp.pid0
@@ -66,6 +71,7 @@ class RedPitaya():
         """Passes a pid value to PyRPL, then requests the value back before
         returning it (in case PyRPL has rounded it etc.)
         """
+        self.hardware_calls += 1
         print('index',index)
         if index == 0:
             pid = self.rp.pid0
@@ -97,6 +103,7 @@ class RedPitaya():
     
     def get_asg_value(self,index,setting):
         """Passes a pid value from PyRPL."""
+        self.hardware_calls += 1
         if index == 0:
             asg = self.rp.asg0
         elif index == 1:
@@ -120,6 +127,7 @@ class RedPitaya():
         """Passes a pid value to PyRPL, then requests the value back before
         returning it (in case PyRPL has rounded it etc.)
         """
+        self.hardware_calls += 1
         if index == 0:
             asg = self.rp.asg0
         elif index == 1:
@@ -138,25 +146,136 @@ class RedPitaya():
             asg.output_direct = value
         return self.get_asg_value(index,setting)
 
-    def queue_scope_trace(self,input1,input2,duration,mode='rolling',trigger='immediately'):
-        """Adds a scope trace request to the scope_getter worker queue.
+    def get_pid_object(self,index):
+        if index == 0:
+            return self.rp.pid0
+        elif index == 1:
+            return self.rp.pid1
+        elif index == 2:
+            return self.rp.pid2
+        else:
+            print("RP does not support pid > 2")
+
+    def get_asg_object(self,index):
+        if index == 0:
+            return self.rp.asg0
+        elif index == 1:
+            return self.rp.asg1
+        else:
+            print("RP does not support asg > 1")
+
+    def begin_relock(self,pid_index,asg_index,offset=None,max_voltage=None,
+                     min_voltage=None,integrator=0):
+        """First half of a fast relock. Turns the PID output off and resets 
+        the integrator, and only if an offset is given moves the ASG DC offset 
+        and the PID limits relative to it. There are no readbacks. Returns the 
+        time taken [s].
+        """
+        start = time.perf_counter()
+        pid = self.get_pid_object(pid_index)
+        pid.output_direct = 'off'
+        pid.ival = integrator
+        self.hardware_calls += 2
+        if offset is not None:
+            self.get_asg_object(asg_index).offset = offset
+            pid.max_voltage = max_voltage - offset
+            pid.min_voltage = min_voltage - offset
+            self.hardware_calls += 3
+        return time.perf_counter() - start
+
+    def recentre(self,pid_index,asg_index,offset,integrator,max_voltage,min_voltage):
+        """Moves the ASG DC offset and the PID integrator and limits together 
+        while the PID is running. The integrator is written first so that the
+        output only steps by the offset change for the time between register 
+        writes. There are no readbacks. Returns the time taken [s].
+        """
+        start = time.perf_counter()
+        pid = self.get_pid_object(pid_index)
+        pid.ival = integrator
+        self.get_asg_object(asg_index).offset = offset
+        pid.max_voltage = max_voltage - offset
+        pid.min_voltage = min_voltage - offset
+        self.hardware_calls += 4
+        return time.perf_counter() - start
+
+    def apply_lock(self,pid_index,asg_index,offset,max_voltage,min_voltage,output,integrator=None):
+        """Switches from any state to locking at a DC offset: ASG to DC at 
+        offset, PID limits relative to it and both outputs on, optionally
+        setting the integrator first. There are no readbacks. Returns the 
+        time taken [s].
+        """
+        start = time.perf_counter()
+        pid = self.get_pid_object(pid_index)
+        asg = self.get_asg_object(asg_index)
+        if integrator is not None:
+            pid.ival = integrator
+            self.hardware_calls += 1
+        asg.waveform = 'dc'
+        asg.amplitude = 0
+        asg.offset = offset
+        pid.max_voltage = max_voltage - offset
+        pid.min_voltage = min_voltage - offset
+        asg.output_direct = output
+        pid.output_direct = output
+        self.hardware_calls += 7
+        return time.perf_counter() - start
+
+    def apply_sweep(self,pid_index,asg_index,offset,amplitude,frequency,output):
+        """Switches to sweeping: PID output off and the ASG ramping around
+        offset. There are no readbacks."""
+        pid = self.get_pid_object(pid_index)
+        asg = self.get_asg_object(asg_index)
+        pid.output_direct = 'off'
+        asg.waveform = 'ramp'
+        asg.offset = offset
+        asg.amplitude = amplitude
+        asg.frequency = frequency
+        asg.trigger_source = 'immediately'
+        asg.output_direct = output
+        self.hardware_calls += 7
+
+    def outputs_off(self,pid_index,asg_index):
+        """Turns the PID and ASG outputs off without readbacks."""
+        self.get_pid_object(pid_index).output_direct = 'off'
+        self.get_asg_object(asg_index).output_direct = 'off'
+        self.hardware_calls += 2
+
+    def end_relock(self,pid_index,output):
+        """Second half of a fast relock: turns the PID output back on. Returns
+        the time taken [s]."""
+        start = time.perf_counter()
+        self.get_pid_object(pid_index).output_direct = output
+        self.hardware_calls += 1
+        return time.perf_counter() - start
+
+    def queue_scope_trace(self,input1,input2,duration,mode='rolling',trigger='immediately',
+                          callback=None,publish=True):
+        """Adds a scope trace request to the scope_getter worker queue. The
+        trace is published on the laser's trace bus unless publish is False, 
+        and also delivered to callback(times,datas,duration) if given 
+        (published as a 'probe').
         scope_parameters = []"""
-        scope_parameters = [input1,input2,duration,mode,trigger]
+        scope_parameters = [input1,input2,duration,mode,trigger,callback,publish]
+        self.hardware_calls += 1
         print('requesting scope trace',scope_parameters)
         self.scope_queue.put(scope_parameters)
         
     def get_scope_trace(self,scope_parameters):
-        input1,input2,duration,mode,trigger = scope_parameters
+        input1,input2,duration,mode,trigger,callback,publish = scope_parameters
         self.scope.input1 = input1
         self.scope.input2 = input2
         self.scope.duration = duration
         duration = self.scope.duration
         self.scope.trigger = trigger
         if mode == 'rolling':
-            QtTest.QTest.qWait(duration*1000)
+            self.clock.wait(duration)
             times, datas = self.scope._get_rolling_curve()
             print('delivering scope trace',scope_parameters)
-            self.laser.update_scope_trace(times,datas,duration)
+            if publish:
+                self.laser.trace_bus.publish(times,datas,duration,
+                                             kind='update' if callback is None else 'probe')
+            if callback is not None:
+                callback(times,datas,duration)
         self.scope_queue_wait.wakeAll()
         #TODO Add other scope mode functionality
 
@@ -178,7 +297,6 @@ class ScopeQueuer(QtCore.QThread):
     def run(self):
         while True:
             scope_parameters = self.queue.get()
-            input1,input2,duration,mode,trigger = scope_parameters
             self.signal.emit(scope_parameters)
             self.mutex.lock()
             self.wait_condition.wait(self.mutex)
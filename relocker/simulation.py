@@ -0,0 +1,205 @@
+"""
+*   Deterministic simulation of the autoupdate/autorelock cycle for many
+    lasers on a VirtualClock. Each simulated laser is driven through the
+    lock state machine, relock logic (locking.relock.RelockLogic) and
+    adaptive poller that the laser widget runs, following the widget's
+    update_scope_trace, check_if_locked, relock and relock verification
+    flow, with synthetic output traces from a simple random unlock model in
+    place of the Red Pitaya. Hours of autorelock behaviour run in seconds,
+    e.g.
+        python -m relocker.simulation --lasers 20 --hours 12 --seed 1
+"""
+
+import math
+import random
+import argparse
+
+from .clock import VirtualClock
+from .locking import check_lock
+from .locking.state import LockStateMachine
+from .locking.relock import RelockLogic
+from .locking.polling import AdaptivePoller, SAFE_MARGIN
+from .locking.history import integrator_headroom
+from .locking.strategies import make_strategy
+from .traces.replay import Decision
+
+DEFAULT_SETTINGS = {
+    "autoupdate interval [s]": 1,
+    "adaptive autoupdate": False,
+    "safe margin": SAFE_MARGIN,
+    "relock interval [s]": 1,
+    "relock probe duration [s]": 0.01,
+    "relock probes": 3,
+    "relock retries": 3,
+    "scope duration [s]": 0.1,
+    "max voltage [V]": 1,
+    "min voltage [V]": -1,
+    "offset [V]": 0,
+    "integrator": 0,
+    "relock setting": "manual"
+    }
+
+class SimulatedLaser():
+    """Laser that unlocks at random (unlock_rate per second while locked).
+    Every time the PID is re-engaged by a relock attempt it catches the lock
+    with probability relock_success. Every autoupdate interval a scope trace
+    of scope duration is 'acquired' and passed through the lock logic, which
+    may start a relock, and relock attempts are verified with probe traces.
+    """
+    def __init__(self,clock,name,settings=None,unlock_rate=1/3600,relock_success=0.9,
+                 seed=None,samples=16):
+        self.clock = clock
+        self.name = name
+        self.settings = {**DEFAULT_SETTINGS, **(settings or {})}
+        self.unlock_rate = unlock_rate
+        self.relock_success = relock_success
+        self.random = random.Random(seed)
+        self.samples = samples
+        self.lock_state = LockStateMachine('locked',clock=clock)
+        self.lock_state.autorelock = True
+        self.logic = RelockLogic(self.settings,self.lock_state)
+        self.poller = AdaptivePoller(self.settings['autoupdate interval [s]'],
+                                     safe_margin=self.settings['safe margin'])
+        self.truly_locked = True
+        self.last_update = clock.time()
+        self.decisions = []
+        self.unlocked_time = 0
+
+    def start(self):
+        self.clock.call_later(self.settings['autoupdate interval [s]'],self._autoupdate)
+
+    def _transition(self,event,**kwargs):
+        transition = self.lock_state.fire(event)
+        self.lock_state.finish(transition)
+        if event not in ['lock lost','lock found','engage']:
+            self.decisions.append(Decision(self.clock.time(),self.name,
+                                           {'park': 'parked'}.get(event,event),**kwargs))
+
+    def _evolve(self):
+        now = self.clock.time()
+        dt = now - self.last_update
+        if not self.truly_locked:
+            self.unlocked_time += dt
+        elif self.lock_state.pid_enabled and (self.random.random() < 1-math.exp(-self.unlock_rate*dt)):
+            self.truly_locked = False
+        self.last_update = now
+
+    def _trace(self):
+        if self.truly_locked and self.lock_state.pid_enabled:
+            level = (self.settings['max voltage [V]']+self.settings['min voltage [V]'])/2
+        else:
+            level = self.settings['max voltage [V]']
+        return [level + 0.001*self.random.gauss(0,1) for _ in range(self.samples)]
+
+    def _next_interval(self):
+        if self.settings['adaptive autoupdate']:
+            return self.poller.interval
+        return self.settings['autoupdate interval [s]']
+
+    def _autoupdate(self):
+        self.clock.call_later(self.settings['scope duration [s]'],self._acquired)
+
+    def _acquired(self):
+        """As the widget's update_scope_trace, check_if_locked and
+        finish_update."""
+        self._evolve()
+        now = self.clock.time()
+        if self.lock_state.state in ['locked','unlocked','parked']:
+            locked, mean_voltage = check_lock(self._trace(),self.settings)
+            self.decisions.append(Decision(now,self.name,'locked' if locked else 'unlocked',mean_voltage))
+            event = self.logic.check(now,locked)
+            if event is not None:
+                self._transition(event)
+            # the integrator makes up the output mean less the offset
+            margin = integrator_headroom(mean_voltage - self.settings['offset [V]'],
+                                         self.settings['offset [V]'],
+                                         self.settings['max voltage [V]'],
+                                         self.settings['min voltage [V]'])
+            self.poller.update(now,self.lock_state.is_locked,
+                               margin if self.lock_state.is_locked else None)
+            if self.logic.wants_relock(now):
+                self._relock()
+        self.clock.call_later(self._next_interval(),self._autoupdate)
+
+    def _relock(self):
+        """As the widget's relock; there is no lock history to warm start
+        from."""
+        self.logic.start(self.clock.time(),make_strategy(self.settings))
+        self.logic.next_candidate()
+        self._transition('relock')
+        self.poller.mark_unstable(self.clock.time())
+        self.clock.call_later(self.settings['relock interval [s]'],self._finish_relock)
+
+    def _engage(self):
+        """The PID is (re-)engaged at a candidate and may catch the lock."""
+        self._evolve()
+        self.truly_locked = self.random.random() < self.relock_success
+
+    def _finish_relock(self):
+        candidate = self.logic.candidate
+        self._transition('engage')
+        if candidate is None:
+            self._end_relock(False)
+            return
+        self._engage()
+        self.decisions.append(Decision(self.clock.time(),self.name,'relock finished',
+                                       offset=candidate['offset']))
+        self._start_verification(candidate)
+
+    def _start_verification(self,candidate):
+        self.logic.start_attempt(self.clock.time(),candidate['offset'])
+        self.clock.call_later(self.settings['relock probe duration [s]'],self._probe)
+
+    def _probe(self):
+        """As the widget's _relock_probe and _end_relock_attempt."""
+        self._evolve()
+        if self.lock_state.state != 'verifying':
+            return
+        locked, mean_voltage = check_lock(self._trace(),self.settings)
+        success = self.logic.probe(locked)
+        if success is None:
+            self.clock.call_later(self.settings['relock probe duration [s]'],self._probe)
+            return
+        self.logic.end_attempt(self.clock.time(),success,mean_voltage)
+        if not success:
+            candidate = self.logic.retry()
+            if candidate is not None:
+                self._transition('retry',offset=candidate['offset'])
+                self._engage()
+                self._start_verification(candidate)
+                return
+        self._end_relock(success)
+
+    def _end_relock(self,success):
+        for event in self.logic.end(self.clock.time(),success):
+            self._transition(event)
+        if success:
+            self.poller.mark_unstable(self.clock.time())
+
+def simulate(n_lasers=10,hours=1,seed=0,clock=None,**kwargs):
+    """Simulates n_lasers for a number of hours of virtual time and returns
+    the simulated lasers."""
+    clock = VirtualClock() if clock is None else clock
+    lasers = [SimulatedLaser(clock,'laser {}'.format(i),seed=seed*1000+i,**kwargs)
+              for i in range(n_lasers)]
+    for laser in lasers:
+        laser.start()
+    clock.run(until=clock.time()+hours*3600)
+    return lasers
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m relocker.simulation')
+    parser.add_argument('--lasers',type=int,default=10)
+    parser.add_argument('--hours',type=float,default=1)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--unlock-rate',type=float,default=1/3600,help='unlocks per second')
+    parser.add_argument('--relock-success',type=float,default=0.9)
+    args = parser.parse_args(argv)
+    lasers = simulate(args.lasers,args.hours,args.seed,unlock_rate=args.unlock_rate,
+                      relock_success=args.relock_success)
+    for laser in lasers:
+        relocks = len([d for d in laser.decisions if d.action == 'relock'])
+        print('{}\t{} relocks\t{:.1f} s unlocked'.format(laser.name,relocks,laser.unlocked_time))
+
+if __name__ == "__main__":
+    main()
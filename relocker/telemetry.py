@@ -0,0 +1,290 @@
+"""
+*   Lock telemetry log. Every lock check (lock state, output mean and
+    standard deviation, offset and integrator) and every lock state
+    transition, including relocks, is buffered in memory and written in
+    batches by a background thread to one SQLite file per day,
+        telemetry/2021-03-30.sqlite
+    Daily files older than keep_days are reduced to one-minute min/mean/max
+    aggregates in telemetry/aggregates.sqlite and removed, and minute
+    aggregates older than coarse_after_days are reduced again to hours, so
+    that the disk used stays bounded however long the relocker runs.
+    Transitions are kept in full. A batch that fails to be written goes back
+    into the buffer for the next flush, and the days already downsampled are
+    recorded, so that a daily file that could not be removed (e.g. while open
+    elsewhere on Windows) is not aggregated twice.
+
+    This replaces the CSV logging of the old lockbox_gui_ctrl, which reopened
+    the CSV file twice for every update and wrote all parameters each time.
+"""
+
+import os
+import re
+import time
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+
+from .locking.state import STATES
+
+DIRECTORY = 'telemetry'
+FLUSH_INTERVAL = 5 # [s]
+KEEP_DAYS = 7 # days of full resolution data
+COARSE_AFTER_DAYS = 90 # days of minute aggregates
+MAX_BUFFER = 100000 # samples held in memory if writes fall behind
+
+METRICS = ['mean','std','offset','integrator']
+DAY_FILE = re.compile(r'^(\d{4}-\d{2}-\d{2})\.sqlite$')
+
+RAW_SCHEMA = """
+CREATE TABLE IF NOT EXISTS lasers (id INTEGER PRIMARY KEY, name TEXT UNIQUE);
+CREATE TABLE IF NOT EXISTS samples (time REAL, laser INTEGER, state INTEGER, locked INTEGER,
+                                    mean REAL, std REAL, offset REAL, integrator REAL);
+CREATE TABLE IF NOT EXISTS events (time REAL, laser INTEGER, event TEXT, detail TEXT);
+CREATE INDEX IF NOT EXISTS samples_time ON samples (laser, time);
+"""
+AGGREGATE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS aggregates (start REAL, laser TEXT, period REAL, count INTEGER,
+    locked_fraction REAL, {});
+CREATE TABLE IF NOT EXISTS events (time REAL, laser TEXT, event TEXT, detail TEXT);
+CREATE TABLE IF NOT EXISTS downsampled (day TEXT PRIMARY KEY);
+CREATE INDEX IF NOT EXISTS aggregates_start ON aggregates (laser, period, start);
+""".format(', '.join('{0}_min REAL, {0}_mean REAL, {0}_max REAL'.format(m) for m in METRICS))
+
+def day_of(timestamp):
+    return time.strftime('%Y-%m-%d',time.localtime(timestamp))
+
+class TelemetryLogger():
+    """Buffers telemetry and writes it from a background thread. record()
+    and event() only append to a list, so they can be called from the GUI
+    thread on every update."""
+    def __init__(self,directory=DIRECTORY,flush_interval=FLUSH_INTERVAL,keep_days=KEEP_DAYS,
+                 coarse_after_days=COARSE_AFTER_DAYS,max_buffer=MAX_BUFFER,clock=None):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.keep_days = keep_days
+        self.coarse_after_days = coarse_after_days
+        self.max_buffer = max_buffer
+        self.clock = clock
+        self.samples = []
+        self.events = []
+        self.dropped = 0
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.day = None
+        self.connection = None
+        self.laser_ids = {}
+        os.makedirs(directory,exist_ok=True)
+        self.thread = threading.Thread(target=self._run,daemon=True)
+        self.thread.start()
+
+    def record(self,laser,timestamp,state,locked,mean=None,std=None,offset=None,integrator=None):
+        """Records one lock check."""
+        sample = (timestamp,laser,STATES.index(state) if state in STATES else None,
+                  int(bool(locked)),mean,std,offset,integrator)
+        with self.lock:
+            self.samples.append(sample)
+            self._trim()
+
+    def _trim(self):
+        excess = len(self.samples) - self.max_buffer
+        if excess > 0:
+            del self.samples[:excess]
+            self.dropped += excess
+
+    def event(self,laser,timestamp,event,detail=''):
+        """Records an event, e.g. a lock state transition."""
+        with self.lock:
+            self.events.append((timestamp,laser,event,detail))
+
+    def flush(self):
+        """Asks the background thread to write the buffer now."""
+        self.wake.set()
+
+    def close(self):
+        """Writes what is buffered and stops the background thread."""
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+
+    def _now(self):
+        return time.time() if self.clock is None else self.clock.time()
+
+    def _run(self):
+        self.maintain()
+        while True:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            closing = self.closed # everything recorded before close() is written
+            try:
+                self._write()
+            except (sqlite3.Error,OSError) as e:
+                print('telemetry not written{}: {}'.format(' (lost on closing)' if closing else '',e))
+            if closing:
+                break
+        if self.connection is not None:
+            self.connection.close()
+
+    def _write(self):
+        with self.lock:
+            samples, self.samples = self.samples, []
+            events, self.events = self.events, []
+        rows = {} # day: ([samples], [events])
+        for sample in samples:
+            rows.setdefault(day_of(sample[0]),([],[]))[0].append(sample)
+        for event in events:
+            rows.setdefault(day_of(event[0]),([],[]))[1].append(event)
+        days = sorted(rows)
+        for i, day in enumerate(days):
+            day_samples, day_events = rows[day]
+            try:
+                connection = self._connect(day)
+                with connection:
+                    connection.executemany('INSERT INTO samples VALUES (?,?,?,?,?,?,?,?)',
+                        [(s[0],self._laser_id(s[1]),*s[2:]) for s in day_samples])
+                    connection.executemany('INSERT INTO events VALUES (?,?,?,?)',
+                        [(e[0],self._laser_id(e[1]),*e[2:]) for e in day_events])
+            except (sqlite3.Error,OSError):
+                self._requeue(days[i:],rows)
+                raise
+
+    def _requeue(self,days,rows):
+        """Puts the rows of days back at the front of the buffer after a
+        failed write, and reconnects on the next one."""
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except sqlite3.Error:
+                pass
+        self.connection = None
+        self.day = None
+        self.laser_ids = {}
+        samples = [sample for day in days for sample in rows[day][0]]
+        events = [event for day in days for event in rows[day][1]]
+        with self.lock:
+            self.samples = samples + self.samples
+            self.events = events + self.events
+            self._trim()
+
+    def _connect(self,day):
+        """Connection to the file of day, rotating (and tidying up old files)
+        when the day changes."""
+        if day == self.day:
+            return self.connection
+        if self.connection is not None:
+            self.connection.close()
+        rotated = self.day is not None and day > self.day
+        self.connection = None
+        self.day = None
+        connection = sqlite3.connect(os.path.join(self.directory,day+'.sqlite'))
+        connection.executescript(RAW_SCHEMA)
+        self.connection = connection
+        self.day = day
+        self.laser_ids = dict((name,i) for i, name in self.connection.execute('SELECT id, name FROM lasers'))
+        if rotated:
+            self.maintain()
+        return self.connection
+
+    def _laser_id(self,name):
+        laser_id = self.laser_ids.get(name)
+        if laser_id is None:
+            laser_id = self.connection.execute('INSERT INTO lasers (name) VALUES (?)',(name,)).lastrowid
+            self.laser_ids[name] = laser_id
+        return laser_id
+
+    def maintain(self):
+        """Downsamples daily files older than keep_days into minute
+        aggregates and minute aggregates older than coarse_after_days into
+        hours."""
+        today = datetime.fromtimestamp(self._now())
+        oldest_kept = (today - timedelta(days=self.keep_days)).strftime('%Y-%m-%d')
+        try:
+            aggregates = sqlite3.connect(os.path.join(self.directory,'aggregates.sqlite'))
+            aggregates.executescript(AGGREGATE_SCHEMA)
+            for filename in sorted(os.listdir(self.directory)):
+                match = DAY_FILE.match(filename)
+                if match and match.group(1) < oldest_kept and match.group(1) != self.day:
+                    path = os.path.join(self.directory,filename)
+                    downsample(aggregates,path,60,match.group(1))
+                    try:
+                        os.remove(path)
+                    except OSError as e: # removed on a later run, already downsampled
+                        print('telemetry file not removed: {}'.format(e))
+            cutoff = (today - timedelta(days=self.coarse_after_days)).timestamp()
+            coarsen(aggregates,60,3600,cutoff)
+            aggregates.close()
+        except sqlite3.Error as e:
+            print('telemetry not downsampled: {}'.format(e))
+
+def _aggregate_columns(weighted):
+    """min/mean/max columns, of samples or (if weighted) of aggregates."""
+    columns = []
+    for metric in METRICS:
+        if weighted:
+            columns += ['MIN({}_min)'.format(metric),
+                        'SUM({0}_mean*count)/SUM(CASE WHEN {0}_mean IS NULL THEN 0 ELSE count END)'.format(metric),
+                        'MAX({}_max)'.format(metric)]
+        else:
+            columns += ['MIN(s.{})'.format(metric),'AVG(s.{})'.format(metric),'MAX(s.{})'.format(metric)]
+    return ', '.join(columns)
+
+def downsample(aggregates,path,period,day):
+    """Adds period [s] aggregates and the events of the daily file of day to
+    the aggregates database, in the same transaction as recording the day
+    as done. Returns False (adding nothing) if the day was done before."""
+    if aggregates.execute('SELECT 1 FROM downsampled WHERE day = ?',(day,)).fetchone():
+        return False
+    with aggregates:
+        aggregates.execute('ATTACH DATABASE ? AS raw',(path,))
+    try:
+        with aggregates:
+            aggregates.execute('INSERT INTO downsampled VALUES (?)',(day,))
+            aggregates.execute('''INSERT INTO aggregates SELECT CAST(s.time/{0} AS INTEGER)*{0},
+                l.name, {0}, COUNT(*), AVG(s.locked), {1} FROM raw.samples s
+                JOIN raw.lasers l ON s.laser = l.id GROUP BY 1, 2'''.format(period,_aggregate_columns(False)))
+            aggregates.execute('''INSERT INTO events SELECT e.time, l.name, e.event, e.detail
+                FROM raw.events e JOIN raw.lasers l ON e.laser = l.id''')
+    finally:
+        aggregates.execute('DETACH DATABASE raw')
+    return True
+
+def coarsen(aggregates,period,new_period,before):
+    """Replaces period aggregates starting before the time before with
+    new_period aggregates."""
+    before = (before//new_period)*new_period
+    with aggregates:
+        aggregates.execute('''INSERT INTO aggregates SELECT CAST(start/{0} AS INTEGER)*{0}, laser,
+            {0}, SUM(count), SUM(locked_fraction*count)/SUM(count), {1} FROM aggregates
+            WHERE period = ? AND start < ? GROUP BY 1, 2'''.format(new_period,_aggregate_columns(True)),
+            (period,before))
+        aggregates.execute('DELETE FROM aggregates WHERE period = ? AND start < ?',(period,before))
+
+def read_samples(directory,day,laser=None):
+    """Samples of a day as a list of dicts, optionally for one laser only."""
+    path = os.path.join(directory,day+'.sqlite')
+    if not os.path.exists(path):
+        return []
+    connection = sqlite3.connect(path)
+    query = '''SELECT s.time, l.name, s.state, s.locked, s.mean, s.std, s.offset, s.integrator
+               FROM samples s JOIN lasers l ON s.laser = l.id'''
+    arguments = ()
+    if laser is not None:
+        query += ' WHERE l.name = ?'
+        arguments = (laser,)
+    keys = ['time','laser','state','locked'] + METRICS
+    rows = [dict(zip(keys,row)) for row in connection.execute(query+' ORDER BY s.time',arguments)]
+    connection.close()
+    for row in rows:
+        row['state'] = STATES[row['state']] if row['state'] is not None else None
+    return rows
+
+def read_aggregates(directory,laser=None):
+    """Aggregates as a list of dicts ordered by start time."""
+    connection = sqlite3.connect(os.path.join(directory,'aggregates.sqlite'))
+    connection.executescript(AGGREGATE_SCHEMA)
+    cursor = connection.execute('SELECT * FROM aggregates' + (' WHERE laser = ?' if laser else '') +
+                                ' ORDER BY start',(laser,) if laser else ())
+    keys = [column[0] for column in cursor.description]
+    rows = [dict(zip(keys,row)) for row in cursor]
+    connection.close()
+    return rows
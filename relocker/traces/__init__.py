@@ -0,0 +1,9 @@
+"""traces:
+Storage, indexing and querying of recorded scope traces
+"""
+from .store import TraceStore, TraceRecord, archive_dir
+from .index import TraceIndex, load_columns
+from .replay import Replay, ReplayLaser, Decision, save_decisions, load_decisions
+from .sweep import sweep, choose, load_labels, write_settings
+from .bus import TraceBus, TraceFrame
+from .shared import SharedTraceExport, SharedTraceReader, SHARED_MEMORY
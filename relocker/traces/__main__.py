@@ -0,0 +1,136 @@
+"""
+*   Command line tool for the trace index, e.g.
+        python -m relocker.traces build --processes 8
+        python -m relocker.traces query --laser "Rb repump" --start 2021.06.01
+        python -m relocker.traces export columns --event manual
+        python -m relocker.traces replay --laser "Rb repump" --out decisions.jsonl
+        python -m relocker.traces sweep --labels unlocks.csv --write
+        python -m relocker.traces templates --laser "Rb repump"
+"""
+
+import os
+import argparse
+from datetime import datetime
+
+from .store import DUMP_ROOT, archive_dir
+from .index import TraceIndex
+from .replay import Replay, save_decisions, load_decisions
+from .sweep import sweep, choose, load_labels, write_settings, DEFAULT_THRESHOLDS, DEFAULT_WINDOWS
+from ..locking.templates import TemplateLibrary, TEMPLATE_BINS
+
+def _parse_time(text):
+    for fmt in ["%Y.%m.%d.%H.%M.%S","%Y.%m.%d.%H.%M","%Y.%m.%d"]:
+        try:
+            return datetime.strptime(text,fmt)
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('could not parse time "{}"'.format(text))
+
+def _add_query_arguments(parser):
+    parser.add_argument('--laser',action='append',help='laser name (repeatable)')
+    parser.add_argument('--start',type=_parse_time,help='YYYY.MM.DD[.HH.MM[.SS]]')
+    parser.add_argument('--end',type=_parse_time,help='YYYY.MM.DD[.HH.MM[.SS]]')
+    parser.add_argument('--event',choices=['general','manual'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m relocker.traces')
+    parser.add_argument('--root',default=DUMP_ROOT,help='trace dump directory')
+    commands = parser.add_subparsers(dest='command')
+    build = commands.add_parser('build',help='ingest new pickle dumps')
+    build.add_argument('--processes',type=int,default=None)
+    query = commands.add_parser('query',help='list traces')
+    _add_query_arguments(query)
+    export = commands.add_parser('export',help='write traces as .npy columns')
+    export.add_argument('directory')
+    _add_query_arguments(export)
+    replay = commands.add_parser('replay',help='replay traces through the lock logic')
+    _add_query_arguments(replay)
+    replay.add_argument('--speed',type=float,default=None,
+                        help='multiple of real time (default: as fast as possible)')
+    replay.add_argument('--out',help='save the decisions as JSON lines')
+    replay.add_argument('--compare',help='decisions file to compare against')
+    roc = commands.add_parser('sweep',help='lock detector ROC curves from labelled traces')
+    roc.add_argument('--labels',help='CSV with columns laser,start,end,label')
+    roc.add_argument('--thresholds',type=float,nargs='+',default=DEFAULT_THRESHOLDS)
+    roc.add_argument('--windows',type=float,nargs='+',default=DEFAULT_WINDOWS)
+    roc.add_argument('--processes',type=int,default=None)
+    roc.add_argument('--write',action='store_true',
+                     help='write the chosen parameters to each <laser>.json')
+    templates = commands.add_parser('templates',help='build lock point templates from manual locks')
+    templates.add_argument('--laser',action='append',help='laser name (repeatable)')
+    templates.add_argument('--start',type=_parse_time,help='YYYY.MM.DD[.HH.MM[.SS]]')
+    templates.add_argument('--end',type=_parse_time,help='YYYY.MM.DD[.HH.MM[.SS]]')
+    templates.add_argument('--bins',type=int,default=TEMPLATE_BINS)
+    args = parser.parse_args(argv)
+
+    index = TraceIndex(args.root)
+    if args.command == 'build':
+        failures = index.build(processes=args.processes)
+        for path, e in failures:
+            print('failed to ingest "{}": {}'.format(path,e))
+        print('{} traces indexed for {} lasers'.format(len(index.records),len(index.lasers())))
+    elif args.command == 'replay':
+        index.build(ingest=False)
+        event = 'general' if args.event is None else args.event
+        records = index.query(args.laser,args.start,args.end,event)
+        decisions = Replay(records,speed=args.speed).run()
+        for decision in decisions:
+            print('{}\t{}\t{}'.format(datetime.fromtimestamp(decision.time),
+                                      decision.laser,decision.action))
+        if args.out:
+            save_decisions(decisions,args.out)
+        if args.compare:
+            reference = load_decisions(args.compare)
+            changed = [i for i, (a, b) in enumerate(zip(decisions,reference)) if a != b]
+            if len(decisions) != len(reference):
+                changed.append(min(len(decisions),len(reference)))
+            if changed:
+                print('decisions differ from "{}" from index {}'.format(args.compare,changed[0]))
+            else:
+                print('decisions match "{}"'.format(args.compare))
+    elif args.command == 'sweep':
+        index.build(ingest=False)
+        labels = load_labels(args.labels) if args.labels else None
+        results = sweep(index,labels,args.thresholds,args.windows,args.processes)
+        chosen = choose(results)
+        for laser, rows in results.items():
+            print(laser)
+            print('\tthreshold [V]\twindow [s]\tTPR\tFPR\tlatency [s]\tmissed')
+            for row in rows:
+                print('\t{:.3f}\t\t{:.3f}\t\t{:.3f}\t{:.3f}\t{:.3f}\t\t{}'.format(
+                      row['lock threshold [V]'],row['lock window [s]'],
+                      row['true positive rate'],row['false positive rate'],
+                      row['mean latency [s]'],row['missed unlocks']))
+            best = chosen[laser]
+            print('\tchosen: threshold {} V, window {} s'.format(best['lock threshold [V]'],
+                                                              best['lock window [s]']))
+            if args.write:
+                print('\twritten to "{}"'.format(write_settings(laser,best)))
+    elif args.command == 'templates':
+        index.build(ingest=False)
+        for laser in (args.laser or index.lasers()):
+            records = index.query(laser,args.start,args.end,'manual')
+            library = TemplateLibrary.from_records(records,bins=args.bins)
+            if library is None:
+                print('{}\tno manual locks'.format(laser))
+                continue
+            path = archive_dir(laser,'templates.npz',args.root)
+            os.makedirs(os.path.dirname(path),exist_ok=True)
+            library.save(path)
+            print('{}\t{} templates from {} manual locks written to "{}"'.format(
+                  laser,len(library),len(records),path))
+    elif args.command in ['query','export']:
+        index.build(ingest=False)
+        records = index.query(args.laser,args.start,args.end,args.event)
+        if args.command == 'query':
+            for record in records:
+                print('{}\t{}\t{}\t{}'.format(record.laser,
+                      datetime.fromtimestamp(record.timestamp),record.event,record.length))
+        else:
+            index.to_columns(records,args.directory)
+            print('{} traces written to "{}"'.format(len(records),args.directory))
+    else:
+        parser.print_help()
+
+if __name__ == "__main__":
+    main()
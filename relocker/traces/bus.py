@@ -0,0 +1,129 @@
+"""
+*   Per-laser publish/subscribe bus for scope traces. Each acquisition is
+    published once as an immutable TraceFrame whose arrays are read-only
+    views of the acquired data, so every subscriber (plotting, lock
+    detection, dumping, remote viewers, ...) gets the same buffers without
+    copies or extra acquisitions.
+
+    Subscribers can be limited to a minimum interval between frames and/or
+    to every n-th frame. A subscriber given a post function is delivered to
+    asynchronously through a single-frame mailbox: if it has not taken the
+    previous frame by the time the next arrives, the older frame is dropped,
+    so a slow subscriber never holds up acquisition.
+"""
+
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+def _frozen(array):
+    if array is None:
+        return None
+    view = np.asarray(array).view()
+    view.flags.writeable = False
+    return view
+
+class TraceFrame(namedtuple('TraceFrame',['laser','sequence','time','kind','times',
+                                          'output','input','duration'])):
+    """One published acquisition. kind is 'update' for autoupdate and
+    manual traces and 'probe' for relock probes."""
+    __slots__ = ()
+
+    @property
+    def datas(self):
+        return (self.output,self.input)
+
+class Subscription():
+    """A subscriber of a TraceBus. delivered, skipped (by the rate limit or
+    decimation) and dropped (while the subscriber was busy) count frames."""
+    def __init__(self,bus,callback,min_interval=0,decimation=1,kinds=None,post=None,name=None):
+        self.bus = bus
+        self.callback = callback
+        self.min_interval = min_interval
+        self.decimation = max(1,int(decimation))
+        self.kinds = kinds
+        self.post = post
+        self.name = name
+        self.seen = 0
+        self.last_time = None
+        self.delivered = 0
+        self.skipped = 0
+        self.dropped = 0
+        self._pending = None
+        self._lock = threading.Lock()
+
+    def offer(self,frame):
+        """Passes a frame to the subscriber unless it is filtered out."""
+        if (self.kinds is not None) and (frame.kind not in self.kinds):
+            return
+        self.seen += 1
+        if (self.seen - 1) % self.decimation:
+            self.skipped += 1
+            return
+        if (self.last_time is not None) and (frame.time - self.last_time < self.min_interval):
+            self.skipped += 1
+            return
+        self.last_time = frame.time
+        if self.post is None:
+            self.delivered += 1
+            self.callback(frame)
+            return
+        with self._lock:
+            busy = self._pending is not None
+            if busy:
+                self.dropped += 1
+            self._pending = frame
+        if not busy:
+            self.post(self._take,None)
+
+    def _take(self,_=None):
+        with self._lock:
+            frame, self._pending = self._pending, None
+        if frame is not None:
+            self.delivered += 1
+            self.callback(frame)
+
+    def cancel(self):
+        self.bus.unsubscribe(self)
+
+class TraceBus():
+    """Trace bus of one laser."""
+    def __init__(self,laser,clock=None):
+        self.laser = laser
+        self.clock = clock
+        self.sequence = 0
+        self.subscriptions = []
+        self.last_frame = None
+
+    def subscribe(self,callback,min_interval=0,decimation=1,kinds=None,post=None,name=None):
+        """Calls callback(frame) with published frames, at most one every
+        min_interval seconds and every decimation-th frame, only of the given
+        kinds if any. If post is given, delivery is through
+        post(function,None), e.g. to another thread, dropping frames while the
+        subscriber is busy. Returns the Subscription."""
+        subscription = Subscription(self,callback,min_interval,decimation,kinds,post,name)
+        self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self,subscription):
+        if subscription in self.subscriptions:
+            self.subscriptions.remove(subscription)
+
+    def publish(self,times,datas,duration=None,kind='update',time=None):
+        """Publishes an acquisition to all subscribers and returns the frame."""
+        if time is None:
+            time = self.clock.time() if self.clock is not None else 0
+        self.sequence += 1
+        frame = TraceFrame(self.laser,self.sequence,time,kind,_frozen(times),
+                           _frozen(datas[0]),_frozen(datas[1]),duration)
+        self.last_frame = frame
+        for subscription in list(self.subscriptions):
+            subscription.offer(frame)
+        return frame
+
+    def stats(self):
+        """{subscriber name: (delivered, skipped, dropped)}."""
+        return {subscription.name or repr(subscription.callback):
+                (subscription.delivered,subscription.skipped,subscription.dropped)
+                for subscription in self.subscriptions}
@@ -0,0 +1,179 @@
+"""
+*   Index over all recorded traces, both the pickle dumps written by older
+    versions of the laser widget and the TraceStore archives. Pickle dumps are
+    ingested once (in parallel) into per-laser archives so that later queries
+    only ever touch memory-mapped samples.
+"""
+
+import os
+import json
+import pickle
+import bisect
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .store import TraceStore, DUMP_ROOT, EVENT_FOLDERS, DTYPE, archive_dir
+
+TIMESTAMP_FORMAT = "%Y.%m.%d.%H.%M.%S.%f"
+STORES = ['archive','ingested']
+
+def timestamp_from_filename(path):
+    """Converts the timestamp in a dump filename to seconds since the epoch."""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return datetime.strptime(stem,TIMESTAMP_FORMAT).timestamp()
+
+def _to_timestamp(value):
+    if isinstance(value,datetime):
+        return value.timestamp()
+    return value
+
+def find_pickle_dumps(root=DUMP_ROOT):
+    """Yields (laser, event, path) for every pickle dump below root."""
+    try:
+        lasers = sorted(os.listdir(root))
+    except FileNotFoundError:
+        return
+    for laser in lasers:
+        for event, folder in EVENT_FOLDERS.items():
+            directory = os.path.join(root,laser,folder)
+            if not os.path.isdir(directory):
+                continue
+            for filename in sorted(os.listdir(directory)):
+                if filename.endswith('.pickle'):
+                    yield laser, event, os.path.join(directory,filename)
+
+def load_pickle_dump(path):
+    """Loads a [times, asg_trace, input_trace, settings] pickle dump."""
+    with open(path,'rb') as f:
+        times, output, input_trace, settings = pickle.load(f)
+    if times is not None:
+        times = np.asarray(times,dtype=DTYPE)
+        output = np.asarray(output,dtype=DTYPE)
+        input_trace = np.asarray(input_trace,dtype=DTYPE)
+    return times, output, input_trace, settings
+
+def _ingest_worker(path):
+    try:
+        return path, load_pickle_dump(path)
+    except Exception as e:
+        return path, e
+
+class TraceIndex():
+    """Searchable index of the traces for all lasers below a dump root.
+
+    Call build() to ingest any new pickle dumps and (re)load the archives, then
+    query() to get TraceRecords ordered by timestamp.
+    """
+    def __init__(self,root=DUMP_ROOT):
+        self.root = root
+        self.stores = {}
+        self.records = []
+        self.timestamps = []
+
+    def _store(self,laser,store):
+        key = (laser,store)
+        if key not in self.stores:
+            self.stores[key] = TraceStore(archive_dir(laser,store,self.root))
+        return self.stores[key]
+
+    def ingest(self,processes=None,chunksize=16):
+        """Loads all pickle dumps that are not yet in an 'ingested' archive
+        across a pool of processes. Returns a list of (path, exception) for
+        any dumps that could not be read.
+        """
+        pending = {}
+        ingested = {} # laser: sources already archived
+        for laser, event, path in find_pickle_dumps(self.root):
+            if laser not in ingested:
+                ingested[laser] = self._store(laser,'ingested').sources()
+            source = os.path.relpath(path,self.root)
+            if source not in ingested[laser]:
+                pending[path] = (laser,event,source)
+        failures = []
+        if not pending:
+            return failures
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            for path, result in pool.map(_ingest_worker,list(pending),chunksize=chunksize):
+                if isinstance(result,Exception):
+                    failures.append((path,result))
+                    continue
+                laser, event, source = pending[path]
+                times, output, input_trace, settings = result
+                self._store(laser,'ingested').append(laser,timestamp_from_filename(path),
+                                                     event,times,output,input_trace,
+                                                     settings,source=source)
+        return failures
+
+    def build(self,processes=None,ingest=True):
+        """Ingests new pickle dumps (optional) and reloads all archives."""
+        failures = self.ingest(processes) if ingest else []
+        try:
+            lasers = sorted(os.listdir(self.root))
+        except FileNotFoundError:
+            lasers = []
+        self.records = []
+        for laser in lasers:
+            for store in STORES:
+                if os.path.isdir(archive_dir(laser,store,self.root)):
+                    self.records += self._store(laser,store).load_index()
+        self.records.sort(key=lambda record: record.timestamp)
+        self.timestamps = [record.timestamp for record in self.records]
+        return failures
+
+    def lasers(self):
+        return sorted({record.laser for record in self.records})
+
+    def query(self,laser=None,start=None,end=None,event=None):
+        """Returns the records in the time range [start,end) for a laser (or
+        list of lasers) and event type. Timestamps may be datetimes or seconds
+        since the epoch; None leaves that filter open.
+        """
+        start, end = _to_timestamp(start), _to_timestamp(end)
+        lo = 0 if start is None else bisect.bisect_left(self.timestamps,start)
+        hi = len(self.records) if end is None else bisect.bisect_left(self.timestamps,end)
+        if isinstance(laser,str):
+            laser = [laser]
+        return [record for record in self.records[lo:hi]
+                if ((laser is None) or (record.laser in laser))
+                and ((event is None) or (record.event == event))]
+
+    def to_columns(self,records,directory):
+        """Writes records to a directory of .npy columns for bulk analysis.
+        Traces are stored as NaN-padded 2D arrays that are filled one row at
+        a time so the full dataset never has to be held in memory.
+        """
+        os.makedirs(directory, exist_ok=True)
+        n = len(records)
+        length = max([record.length for record in records],default=0)
+        np.save(os.path.join(directory,'laser.npy'),np.array([r.laser for r in records],dtype=str))
+        np.save(os.path.join(directory,'event.npy'),np.array([r.event for r in records],dtype=str))
+        np.save(os.path.join(directory,'timestamp.npy'),np.array([r.timestamp for r in records],dtype=DTYPE))
+        columns = {}
+        for column in ['times','output','input']:
+            path = os.path.join(directory,column+'.npy')
+            if n*length == 0:
+                np.save(path,np.zeros((n,length),dtype=DTYPE))
+            else:
+                columns[column] = np.lib.format.open_memmap(path,mode='w+',
+                                                            dtype=DTYPE,shape=(n,length))
+        for row, record in enumerate(records):
+            data = record.data
+            for i, column in enumerate(columns):
+                columns[column][row,:record.length] = data[i]
+                columns[column][row,record.length:] = np.nan
+        for column in columns.values():
+            column.flush()
+        with open(os.path.join(directory,'settings.jsonl'),'w') as f:
+            for record in records:
+                f.write(json.dumps(record.settings)+'\n')
+        return directory
+
+def load_columns(directory):
+    """Opens the columns written by TraceIndex.to_columns as memory-mapped
+    arrays."""
+    columns = {}
+    for filename in os.listdir(directory):
+        if filename.endswith('.npy'):
+            columns[filename[:-4]] = np.load(os.path.join(directory,filename),mmap_mode='r')
+    return columns
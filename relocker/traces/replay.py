@@ -0,0 +1,208 @@
+"""
+*   Offline replay of recorded traces through the lock detection and
+    autorelock logic of the laser widget. Time is simulated, so months of
+    recorded traces can be replayed in minutes and the resulting sequence of
+    decisions compared between versions of the lock logic.
+"""
+
+import json
+
+from ..clock import VirtualClock
+from ..locking import check_lock
+from ..locking.strategies import make_strategy
+from ..locking.state import LockStateMachine
+from ..locking.relock import RelockLogic
+
+class Decision():
+    """A single decision taken during a replay."""
+    def __init__(self,time,laser,action,mean_voltage=None,offset=None):
+        self.time = time
+        self.laser = laser
+        self.action = action
+        self.mean_voltage = mean_voltage
+        self.offset = offset
+
+    def __repr__(self):
+        return 'Decision({:.3f}, {}, {})'.format(self.time,self.laser,self.action)
+
+    def __eq__(self,other):
+        return self.to_dict() == other.to_dict()
+
+    def to_dict(self):
+        return {'time': self.time, 'laser': self.laser, 'action': self.action,
+                'mean_voltage': self.mean_voltage, 'offset': self.offset}
+
+class ReplayLaser():
+    """Runs recorded traces through the same lock state machine and relock
+    logic (locking.relock.RelockLogic) as gui.laser_widget.laser, without Qt
+    or hardware.
+
+    Traces are assumed to have been recorded with the PID enabled. Traces
+    recorded while a simulated relock has the PID off are skipped, as the
+    widget would skip them. Once the PID is re-engaged, the traces that
+    follow stand in for the widget's verification probes: each one counts
+    as one probe, and a failed probe retries the next candidate offset
+    until 'relock retries' is exhausted. Warm starts are not replayed,
+    because the integrator is not recorded with the traces.
+    """
+    def __init__(self,name,autorelock=True,pid_enabled=True,settings=None):
+        self.name = name
+        self.lock_state = LockStateMachine('locked' if pid_enabled else 'off')
+        self.lock_state.autorelock = autorelock
+        self.settings = {} if settings is None else settings
+        self.logic = None
+        self.prev_lock_point = None
+
+    @property
+    def pid_enabled(self):
+        return self.lock_state.pid_enabled
+
+    @property
+    def is_locked(self):
+        return self.lock_state.is_locked
+
+    @property
+    def is_relocking(self):
+        return self.lock_state.is_relocking
+
+    @property
+    def autorelock(self):
+        return self.lock_state.autorelock
+
+    def _fire(self,now,event,decisions,**kwargs):
+        transition = self.lock_state.fire(event)
+        self.lock_state.finish(transition)
+        action = {'park': 'parked'}.get(event,event)
+        if event not in ['lock lost','lock found','engage']:
+            decisions.append(Decision(now,self.name,action,**kwargs))
+        return transition
+
+    def update_scope_trace(self,now,output,settings,times=None):
+        """Returns the decisions made for a trace and the time at which a
+        relock (if any) will re-engage the PID."""
+        self.settings.clear()
+        self.settings.update(settings)
+        if self.logic is None:
+            self.logic = RelockLogic(self.settings,self.lock_state)
+        decisions = []
+        state = self.lock_state.state
+        if state in ['locked','unlocked','parked']:
+            locked, mean_voltage = check_lock(output,self.settings,times)
+            if locked:
+                self.prev_lock_point = mean_voltage
+            decisions.append(Decision(now,self.name,'locked' if locked else 'unlocked',mean_voltage))
+            event = self.logic.check(now,locked)
+            if event is not None:
+                self._fire(now,event,decisions)
+        elif state == 'verifying':
+            locked, mean_voltage = check_lock(output,self.settings,times)
+            decisions.append(Decision(now,self.name,'probe locked' if locked else 'probe unlocked',
+                                      mean_voltage))
+            success = self.logic.probe(locked)
+            if success is not None:
+                self._end_attempt(now,success,mean_voltage,decisions)
+        else:
+            decisions.append(Decision(now,self.name,'skipped'))
+        finish_time = None
+        if self.logic.wants_relock(now):
+            finish_time = self.relock(now,decisions)
+        return decisions, finish_time
+
+    def relock(self,now,decisions):
+        """Starts a relock like the widget's relock() and returns the time at
+        which the PID is re-engaged."""
+        settings = dict(self.settings)
+        if self.prev_lock_point is not None:
+            settings['last locked voltage [V]'] = self.prev_lock_point
+        self.logic.start(now,make_strategy(settings))
+        self.logic.next_candidate()
+        self._fire(now,'relock',decisions)
+        return now + self.settings['relock interval [s]']
+
+    def finish_relock(self,now):
+        """Re-engages the PID at the end of the relock interval and returns
+        the decisions."""
+        decisions = []
+        candidate = self.logic.candidate
+        self._fire(now,'engage',decisions)
+        if candidate is None:
+            self._end_relock(now,False,decisions)
+        else:
+            self.logic.start_attempt(now,candidate['offset'])
+            decisions.append(Decision(now,self.name,'relock finished',offset=candidate['offset']))
+        return decisions
+
+    def _end_attempt(self,now,success,mean_voltage,decisions):
+        self.logic.end_attempt(now,success,mean_voltage)
+        if not success:
+            candidate = self.logic.retry()
+            if candidate is not None:
+                self._fire(now,'retry',decisions,offset=candidate['offset'])
+                self.logic.start_attempt(now,candidate['offset'])
+                return
+        if success:
+            self.prev_lock_point = mean_voltage
+        self._end_relock(now,success,decisions)
+
+    def _end_relock(self,now,success,decisions):
+        for event in self.logic.end(now,success):
+            self._fire(now,event,decisions)
+
+class Replay():
+    """Replays records (e.g. from TraceIndex.query) in timestamp order on a
+    VirtualClock. Records need laser, timestamp, times, output and settings
+    attributes. If speed is None the replay runs as fast as possible,
+    otherwise it is paced at speed times real time.
+    """
+    def __init__(self,records,autorelock=True,speed=None):
+        self.records = [record for record in sorted(records,key=lambda record: record.timestamp)
+                        if len(record.output) > 0]
+        self.autorelock = autorelock
+        self.speed = speed
+        self.lasers = {}
+        self.decisions = []
+        self.clock = None
+
+    def _laser(self,name):
+        if name not in self.lasers:
+            self.lasers[name] = ReplayLaser(name,self.autorelock)
+        return self.lasers[name]
+
+    def _play(self,i):
+        record = self.records[i]
+        laser = self._laser(record.laser)
+        decisions, finish_time = laser.update_scope_trace(self.clock.time(),
+                                                          record.output,
+                                                          record.settings,
+                                                          record.times)
+        self.decisions += decisions
+        if finish_time is not None:
+            self.clock.call_at(finish_time,self._finish_relock,laser)
+        if i+1 < len(self.records):
+            self.clock.call_at(self.records[i+1].timestamp,self._play,i+1)
+
+    def _finish_relock(self,laser):
+        self.decisions += laser.finish_relock(self.clock.time())
+
+    def run(self):
+        """Runs the replay and returns the list of decisions."""
+        if not self.records:
+            return self.decisions
+        self.clock = VirtualClock(self.records[0].timestamp,self.speed)
+        self.clock.call_at(self.records[0].timestamp,self._play,0)
+        self.clock.run()
+        return self.decisions
+
+def save_decisions(decisions,filename):
+    """Writes decisions as JSON lines so replays can be diffed."""
+    with open(filename,'w') as f:
+        for decision in decisions:
+            f.write(json.dumps(decision.to_dict())+'\n')
+
+def load_decisions(filename):
+    decisions = []
+    with open(filename,'r') as f:
+        for line in f:
+            if line.strip():
+                decisions.append(Decision(**json.loads(line)))
+    return decisions
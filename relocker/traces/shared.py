@@ -0,0 +1,305 @@
+"""
+*   Shared-memory export of live traces and lock status for other processes
+    (experiment control, analysis scripts). Each laser gets a named
+    multiprocessing.shared_memory segment holding a header, its lock status
+    and a ring of trace slots. A reader in another process maps the segment
+    and reads frames in place, without going through the GUI process, e.g.
+        reader = SharedTraceReader('Rb repump')
+        frame = reader.wait(timeout=1)
+        reader.status()['locked']
+
+    Protocol: the header holds the sequence number of the latest complete
+    frame, written to slot sequence % slots. The writer sets the slot's begin
+    sequence, writes the samples and then sets its end sequence before
+    publishing the header sequence, so a reader knows a slot is consistent
+    if begin and end agree and still match after reading. The lock status
+    is guarded the same way by status_begin and status_end.
+
+    Like the lock gate file, a segment is left in place when the writer
+    closes and a new writer reuses it in place, carrying on its sequence
+    numbers, so that readers attached to a previous run of the GUI keep
+    receiving frames. A segment that is too small is replaced, and readers
+    have to attach again.
+
+    multiprocessing.shared_memory needs Python 3.8 or later. On older Pythons
+    (SHARED_MEMORY is False) the segment is a memory-mapped file of the same
+    name in /dev/shm (or the temporary directory where there is none), as
+    for the lock gate. On Linux that is where shared_memory keeps its
+    segments too, so writers and readers on either kind of Python can talk
+    to each other, and a reader falls back to the file if there is no
+    shared_memory segment.
+"""
+
+import os
+import re
+import mmap
+import time
+import tempfile
+
+import numpy as np
+
+from ..locking.state import STATES
+
+try:
+    from multiprocessing import shared_memory
+    SHARED_MEMORY = True
+except ImportError: # Python < 3.8
+    shared_memory = None
+    SHARED_MEMORY = False
+
+MAGIC = b'RLKR'
+VERSION = 1
+SLOTS = 8
+CAPACITY = 16384 # samples per trace, the length of a Red Pitaya scope trace
+KINDS = ['update','probe','monitor']
+
+HEADER = np.dtype([('magic','S4'),('version','<u4'),('slots','<u4'),('capacity','<u4'),
+                   ('sequence','<u8'),
+                   ('status_begin','<u8'),('time','<f8'),('state','u1'),('locked','u1'),
+                   ('raw_locked','u1'),('autorelock','u1'),('pad','u1',4),
+                   ('mean','<f8'),('margin','<f8'),('status_end','<u8')])
+SLOT = np.dtype([('begin','<u8'),('end','<u8'),('time','<f8'),('length','<u4'),
+                 ('kind','u1'),('pad','u1',3)])
+SAMPLE = np.dtype('<f4')
+
+def segment_name(laser):
+    """Name of the shared memory segment of a laser."""
+    return 'relocker_' + re.sub(r'[^A-Za-z0-9]+','_',laser)
+
+FILE_DIRECTORY = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+class _FileSegment():
+    """Memory-mapped file with the parts of the SharedMemory interface used
+    here, for Pythons without multiprocessing.shared_memory."""
+    def __init__(self,name,create=False,size=0):
+        self.path = os.path.join(FILE_DIRECTORY,name)
+        if create and not os.path.exists(self.path):
+            open(self.path,'wb').close()
+        self.file = open(self.path,'r+b' if create else 'rb')
+        if create and os.path.getsize(self.path) < size:
+            self.file.truncate(size) # grown, never shrunk under a reader's mapping
+        self.size = os.path.getsize(self.path)
+        self.buf = mmap.mmap(self.file.fileno(),self.size,
+                             access=mmap.ACCESS_WRITE if create else mmap.ACCESS_READ)
+
+    def close(self):
+        self.buf.close()
+        self.file.close()
+
+def _shared_memory(name,create=False,size=0):
+    """SharedMemory not registered with the resource tracker, which would
+    otherwise remove it when the process exits."""
+    try:
+        return shared_memory.SharedMemory(name,create=create,size=size,track=False) # Python >= 3.13
+    except TypeError:
+        shm = shared_memory.SharedMemory(name,create=create,size=size)
+        try:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(shm._name,'shared_memory')
+        except (ImportError,AttributeError,KeyError):
+            pass
+        return shm
+
+def _create(name,size):
+    """Creates the segment, or reuses an existing one of at least size."""
+    if not SHARED_MEMORY:
+        return _FileSegment(name,create=True,size=size)
+    try:
+        return _shared_memory(name,create=True,size=size)
+    except FileExistsError:
+        shm = _shared_memory(name)
+        if shm.size >= size:
+            return shm
+        shm.close() # too small, readers have to attach again
+        shm.unlink()
+        return _shared_memory(name,create=True,size=size)
+
+def _size(slots,capacity):
+    return HEADER.itemsize + slots*SLOT.itemsize + slots*3*capacity*SAMPLE.itemsize
+
+def _attach(name):
+    """Maps an existing segment, falling back to the memory-mapped file."""
+    if not SHARED_MEMORY:
+        return _FileSegment(name)
+    try:
+        return _shared_memory(name)
+    except FileNotFoundError:
+        return _FileSegment(name)
+
+class _Segment():
+    """Numpy views of the header, slot headers and samples of a segment."""
+    def _map(self,slots,capacity):
+        buffer = self.shm.buf
+        self.header = np.ndarray((),HEADER,buffer=buffer)
+        self.slot_headers = np.ndarray((slots,),SLOT,buffer=buffer,offset=HEADER.itemsize)
+        self.samples = np.ndarray((slots,3,capacity),SAMPLE,buffer=buffer,
+                                  offset=HEADER.itemsize + slots*SLOT.itemsize)
+
+    def _unmap(self):
+        self.header = self.slot_headers = self.samples = None
+
+class SharedTraceExport(_Segment):
+    """Writer side, owned by the GUI process. write_frame takes TraceFrames
+    from a laser's trace bus and write_status the lock status."""
+    def __init__(self,laser,slots=SLOTS,capacity=CAPACITY):
+        self.name = segment_name(laser)
+        self.shm = _create(self.name,_size(slots,capacity))
+        self._map(slots,capacity)
+        self.slots = slots
+        self.capacity = capacity
+        header = self.header
+        if (bytes(header['magic']) == MAGIC and int(header['version']) == VERSION and
+                int(header['slots']) == slots and int(header['capacity']) == capacity):
+            self.sequence = int(header['sequence']) # reused from a previous run
+            self.status_sequence = int(header['status_end'])
+        else:
+            self.sequence = 0
+            self.status_sequence = 0
+            header['sequence'] = 0
+            header['status_begin'] = header['status_end'] = 0
+            self.slot_headers[:] = 0
+            header['magic'] = MAGIC
+            header['version'] = VERSION
+            header['slots'] = slots
+            header['capacity'] = capacity
+
+    def write_frame(self,frame):
+        """Writes a TraceFrame to the next slot. Traces longer than the slot
+        capacity keep their last samples and a missing input is NaN. Frames
+        delivered after close() are ignored."""
+        if self.header is None:
+            return
+        self.sequence += 1
+        index = self.sequence % self.slots
+        slot = self.slot_headers[index]
+        slot['begin'] = self.sequence
+        samples = self.samples[index]
+        output = np.asarray(frame.output)[-self.capacity:]
+        length = len(output)
+        samples[1,:length] = output
+        samples[0,:length] = np.arange(length) if frame.times is None else np.asarray(frame.times)[-length:]
+        if frame.input is None:
+            samples[2,:length] = np.nan
+        else:
+            samples[2,:length] = np.asarray(frame.input)[-length:]
+        slot['time'] = frame.time
+        slot['length'] = length
+        slot['kind'] = KINDS.index(frame.kind) if frame.kind in KINDS else 255
+        slot['end'] = self.sequence
+        self.header['sequence'] = self.sequence
+
+    def write_status(self,time,state,locked,raw_locked=None,autorelock=False,
+                     mean_voltage=float('nan'),margin=float('nan')):
+        """Writes the lock status: the lock state name, the debounced and
+        raw lock check and the last output mean and lock margin."""
+        self.status_sequence += 1
+        header = self.header
+        header['status_begin'] = self.status_sequence
+        header['time'] = time
+        header['state'] = STATES.index(state) if state in STATES else 255
+        header['locked'] = bool(locked)
+        header['raw_locked'] = bool(locked if raw_locked is None else raw_locked)
+        header['autorelock'] = bool(autorelock)
+        header['mean'] = mean_voltage
+        header['margin'] = margin
+        header['status_end'] = self.status_sequence
+
+    def close(self):
+        """Closes the segment, leaving it in place for readers and the next
+        writer."""
+        self._unmap()
+        self.shm.close()
+
+class SharedTraceReader(_Segment):
+    """Reader side, for use in any process on the same machine."""
+    def __init__(self,laser):
+        self.name = segment_name(laser)
+        self.shm = _attach(self.name)
+        header = np.ndarray((),HEADER,buffer=self.shm.buf)
+        if bytes(header['magic']) != MAGIC or int(header['version']) != VERSION:
+            del header
+            self.shm.close()
+            raise ValueError('{} is not a relocker trace export'.format(self.name))
+        self.slots = int(header['slots'])
+        self.capacity = int(header['capacity'])
+        del header
+        self._map(self.slots,self.capacity)
+
+    @property
+    def sequence(self):
+        """Sequence number of the latest frame (0 before the first)."""
+        return int(self.header['sequence'])
+
+    def frame(self,sequence,copy=True):
+        """Frame with the given sequence number as a dict, or None if it has
+        been overwritten. With copy=False the arrays are read-only views of
+        the shared memory, valid until the slot is reused (check with
+        valid())."""
+        index = sequence % self.slots
+        slot = self.slot_headers[index]
+        if not (int(slot['begin']) == int(slot['end']) == sequence):
+            return None
+        length = int(slot['length'])
+        samples = self.samples[index,:,:length]
+        if copy:
+            samples = samples.copy()
+        else:
+            samples = samples.view()
+            samples.flags.writeable = False
+        kind = int(slot['kind'])
+        frame = {'sequence': sequence, 'time': float(slot['time']),
+                 'kind': KINDS[kind] if kind < len(KINDS) else None,
+                 'times': samples[0], 'output': samples[1], 'input': samples[2]}
+        if int(slot['begin']) != sequence: # overwritten while reading
+            return None
+        return frame
+
+    def valid(self,frame):
+        """Whether a frame read with copy=False has not been overwritten."""
+        slot = self.slot_headers[frame['sequence'] % self.slots]
+        return int(slot['begin']) == int(slot['end']) == frame['sequence']
+
+    def latest(self,copy=True):
+        """The latest frame, or None if there is none yet."""
+        while True:
+            sequence = self.sequence
+            if sequence == 0:
+                return None
+            frame = self.frame(sequence,copy)
+            if frame is not None:
+                return frame
+
+    def wait(self,after=None,timeout=None,poll=1e-4):
+        """Waits for a frame newer than sequence after (by default the latest
+        one now) and returns it, or None after timeout seconds."""
+        if after is None:
+            after = self.sequence
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.sequence <= after:
+            if (deadline is not None) and time.perf_counter() >= deadline:
+                return None
+            time.sleep(poll)
+        return self.latest()
+
+    def status(self):
+        """The latest lock status as a dict."""
+        header = self.header
+        while True:
+            end = int(header['status_end'])
+            state = int(header['state'])
+            status = {'sequence': end,
+                      'time': float(header['time']),
+                      'state': STATES[state] if state < len(STATES) else None,
+                      'locked': bool(header['locked']),
+                      'raw locked': bool(header['raw_locked']),
+                      'autorelock': bool(header['autorelock']),
+                      'mean [V]': float(header['mean']),
+                      'margin': float(header['margin'])}
+            if int(header['status_begin']) == end:
+                return status
+
+    def close(self):
+        """Unmaps the segment. Frames read with copy=False must have been 
+        released first."""
+        self._unmap()
+        self.shm.close()
@@ -0,0 +1,132 @@
+"""
+*   Append-only archives of scope traces. Each archive is a directory with a
+    flat binary file of samples and a JSON-lines index, so that individual
+    traces can be memory-mapped instead of unpickled one file at a time.
+"""
+
+import os
+import json
+import threading
+import numpy as np
+
+DUMP_ROOT = 'trace dumps'
+EVENT_FOLDERS = {'general': 'general dumps',
+                 'manual': 'manual pid enabling'}
+DTYPE = np.dtype('<f8')
+
+def archive_dir(name,store='archive',root=DUMP_ROOT):
+    """Returns the directory of the archive for a given laser."""
+    return os.path.join(root,name,store)
+
+def _jsonable(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+class TraceRecord():
+    """Index entry for a single trace in a TraceStore. The trace arrays are
+    read-only memory-mapped views that are only created when accessed.
+    """
+    def __init__(self,store,entry):
+        self.store = store
+        self.laser = entry['laser']
+        self.timestamp = entry['timestamp']
+        self.event = entry['event']
+        self.offset = entry['offset']
+        self.length = entry['length']
+        self.source = entry.get('source')
+        self.settings = entry['settings']
+
+    def __repr__(self):
+        return 'TraceRecord({}, {}, {}, {} samples)'.format(self.laser,
+                    self.timestamp,self.event,self.length)
+
+    @property
+    def data(self):
+        """(3,length) array of the times, output and input traces."""
+        return self.store.read(self)
+
+    @property
+    def times(self):
+        return self.data[0]
+
+    @property
+    def output(self):
+        return self.data[1]
+
+    @property
+    def input(self):
+        return self.data[2]
+
+class TraceStore():
+    """Archive of traces for one laser. Samples are appended to samples.bin
+    as contiguous (times, output, input) blocks and the position of each block
+    is recorded along with the settings in index.jsonl. Only one process
+    should write to a store at a time.
+    """
+    def __init__(self,directory):
+        self.directory = directory
+        self.samples_path = os.path.join(directory,'samples.bin')
+        self.index_path = os.path.join(directory,'index.jsonl')
+        self._map = None
+        self.records = []
+        self._write_lock = threading.Lock()
+        self.load_index()
+
+    def load_index(self):
+        self.records = []
+        self._map = None
+        try:
+            with open(self.index_path,'r') as f:
+                for line in f:
+                    if line.strip():
+                        self.records.append(TraceRecord(self,json.loads(line)))
+        except FileNotFoundError:
+            pass
+        return self.records
+
+    def sources(self):
+        """Returns the set of source files that have already been archived."""
+        return {record.source for record in self.records if record.source is not None}
+
+    def append(self,laser,timestamp,event,times,output,input_trace,settings,source=None):
+        """Appends a single trace to the archive and returns its record. Safe 
+        to call from several threads."""
+        with self._write_lock:
+            return self._append(laser,timestamp,event,times,output,input_trace,settings,source)
+
+    def _append(self,laser,timestamp,event,times,output,input_trace,settings,source):
+        if times is None:
+            block = np.zeros((3,0),dtype=DTYPE)
+        else:
+            block = np.vstack([np.asarray(times,dtype=DTYPE),
+                               np.asarray(output,dtype=DTYPE),
+                               np.asarray(input_trace,dtype=DTYPE)])
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.samples_path,'ab') as f:
+            offset = f.tell()
+            f.write(np.ascontiguousarray(block).tobytes())
+        entry = {'laser': laser,
+                 'timestamp': float(timestamp),
+                 'event': event,
+                 'offset': offset,
+                 'length': block.shape[1],
+                 'source': source,
+                 'settings': settings}
+        with open(self.index_path,'a') as f:
+            f.write(json.dumps(entry,default=_jsonable)+'\n')
+        record = TraceRecord(self,json.loads(json.dumps(entry,default=_jsonable)))
+        self.records.append(record)
+        return record
+
+    def read(self,record):
+        """Returns a read-only (3,length) view of a record's samples without
+        copying them into memory."""
+        start = record.offset//DTYPE.itemsize
+        stop = start + 3*record.length
+        if record.length == 0:
+            return np.zeros((3,0),dtype=DTYPE)
+        if (self._map is None) or (self._map.shape[0] < stop):
+            self._map = np.memmap(self.samples_path,dtype=DTYPE,mode='r')
+        return self._map[start:stop].reshape(3,record.length)
@@ -0,0 +1,136 @@
+"""
+*   Sweep of the lock detector parameters ('lock threshold [V]' and
+    'lock window [s]') over labelled traces to produce ROC curves and
+    detection latencies for each laser.
+
+    Traces recorded when the PID was manually enabled are taken as locked
+    examples. Further examples come from a labels CSV with the columns
+    laser,start,end,label where label is 'locked' or 'unlocked' and times are
+    YYYY.MM.DD.HH.MM.SS. Each unlocked interval is treated as one unlock event
+    for the detection latency.
+"""
+
+import os
+import csv
+import json
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from .store import DTYPE
+
+DEFAULT_THRESHOLDS = [0.01,0.02,0.03,0.05,0.075,0.1,0.15,0.2]
+DEFAULT_WINDOWS = [0,0.01,0.05]
+
+def load_labels(filename):
+    """Reads a labels CSV into a list of dictionaries."""
+    labels = []
+    with open(filename,'r',newline='') as f:
+        for row in csv.DictReader(f):
+            labels.append({'laser': row['laser'],
+                           'start': datetime.strptime(row['start'],"%Y.%m.%d.%H.%M.%S").timestamp(),
+                           'end': datetime.strptime(row['end'],"%Y.%m.%d.%H.%M.%S").timestamp(),
+                           'locked': row['label'].strip().lower() == 'locked'})
+    return labels
+
+def labelled_examples(index,labels=None,manual_positive=True):
+    """Returns {laser: [(record, locked, event start), ...]} from a built
+    TraceIndex. The event start is None for locked examples."""
+    examples = {}
+    if manual_positive:
+        for record in index.query(event='manual'):
+            if record.length > 0:
+                examples.setdefault(record.laser,[]).append((record,True,None))
+    for label in (labels or []):
+        for record in index.query(label['laser'],label['start'],label['end'],'general'):
+            if record.length > 0:
+                start = None if label['locked'] else label['start']
+                examples.setdefault(record.laser,[]).append((record,label['locked'],start))
+    return examples
+
+def _rail_distances(task):
+    """Worker: memory-maps each example and returns the distance of the
+    windowed output mean from the nearest rail."""
+    window, examples = task
+    maps = {}
+    distances = np.empty(len(examples))
+    for i, (path, offset, length, max_voltage, min_voltage) in enumerate(examples):
+        if path not in maps:
+            maps[path] = np.memmap(path,dtype=DTYPE,mode='r')
+        start = offset//DTYPE.itemsize
+        times, output = maps[path][start:start+2*length].reshape(2,length)
+        if window:
+            output = output[times >= times[-1] - window]
+        mean = np.nanmean(output)
+        distances[i] = min(abs(mean - max_voltage),abs(mean - min_voltage))
+    return distances
+
+def _latencies(detected_unlocked,examples):
+    """Time from the start of each unlock event to its first detection."""
+    first = {}
+    for unlocked, (record, locked, start) in zip(detected_unlocked,examples):
+        if locked:
+            continue
+        first.setdefault(start,np.inf)
+        if unlocked:
+            first[start] = min(first[start],record.timestamp - start)
+    return list(first.values())
+
+def sweep(index,labels=None,thresholds=DEFAULT_THRESHOLDS,windows=DEFAULT_WINDOWS,
+          processes=None,manual_positive=True):
+    """Evaluates every combination of threshold and window on the labelled
+    examples. Returns {laser: [result, ...]} with one result dictionary per
+    parameter combination.
+    """
+    examples = labelled_examples(index,labels,manual_positive)
+    thresholds = np.asarray(thresholds,dtype=float)
+    tasks = []
+    for laser, laser_examples in examples.items():
+        rows = [(record.store.samples_path,record.offset,record.length,
+                 record.settings['max voltage [V]'],record.settings['min voltage [V]'])
+                for record, _, _ in laser_examples]
+        for window in windows:
+            tasks.append((laser,window,rows))
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        distances = list(pool.map(_rail_distances,[(window,rows) for _, window, rows in tasks]))
+    results = {}
+    for (laser, window, _), laser_distances in zip(tasks,distances):
+        locked = np.array([label for _, label, _ in examples[laser]],dtype=bool)
+        detected = laser_distances[None,:] >= thresholds[:,None] # (thresholds,examples)
+        for threshold, row in zip(thresholds,detected):
+            latencies = _latencies(~row,examples[laser])
+            finite = [latency for latency in latencies if np.isfinite(latency)]
+            results.setdefault(laser,[]).append({
+                'lock threshold [V]': float(threshold),
+                'lock window [s]': window,
+                'true positive rate': float(row[locked].mean()) if locked.any() else float('nan'),
+                'false positive rate': float(row[~locked].mean()) if (~locked).any() else float('nan'),
+                'mean latency [s]': float(np.mean(finite)) if finite else float('nan'),
+                'missed unlocks': len(latencies) - len(finite)})
+    return results
+
+def choose(results):
+    """Picks the parameters for each laser that maximise TPR - FPR, preferring
+    the shortest detection latency when tied."""
+    chosen = {}
+    for laser, rows in results.items():
+        def score(row):
+            j = np.nan_to_num(row['true positive rate']) - np.nan_to_num(row['false positive rate'])
+            latency = row['mean latency [s]']
+            return (j, -(latency if np.isfinite(latency) else np.inf))
+        chosen[laser] = max(rows,key=score)
+    return chosen
+
+def write_settings(laser,result,directory='.'):
+    """Writes the chosen detector parameters into the laser's settings JSON."""
+    filename = os.path.join(directory,laser+'.json')
+    try:
+        with open(filename,'r') as f:
+            settings = json.load(f)
+    except FileNotFoundError:
+        settings = {'name': laser}
+    for key in ['lock threshold [V]','lock window [s]']:
+        settings[key] = result[key]
+    with open(filename,'w') as f:
+        json.dump(settings, f, sort_keys=True, indent=4)
+    return filename